@@ -3,13 +3,16 @@ from contextlib import closing
 
 import sys
 import os
+import time
+import threading
+import Queue
 from urlparse import urljoin
 import json
 from ConfigParser import ConfigParser
 
 import click
 import requests
-from clint.textui import puts, indent, colored
+from clint.textui import puts, colored
 from deploylib.plugins import load_plugins, LocalPlugin
 from deploylib.client.service import ServiceFile
 
@@ -65,41 +68,100 @@ class Api(object):
     def create(self, deploy_id):
         return self.request('put', 'create', json={'deploy_id': deploy_id})
 
-    def setup(self, deploy_id, servicefile, force=False):
+    def setup(self, deploy_id, servicefile, force=False, parallel=None):
         return self.request('post', 'setup', json={
             'deploy_id': deploy_id,
             'services': servicefile.services,
             'globals': servicefile.globals,
-            'force': force}, stream=True)
+            'force': force,
+            'parallel': parallel}, stream=True)
 
-    def upload(self, deploy_id, service_name, files, data=None):
-        return self.request('post', 'upload', files=files, data={
+    def negotiate(self, deploy_id, service_name, name, data=None):
+        return self.request('post', 'negotiate', json={
             'deploy_id': deploy_id,
             'service_name': service_name,
+            'file': name,
+            'data': data})
+
+    def upload(self, deploy_id, service_name, name, body, data=None):
+        """Upload a single file as the request body; if ``body`` is an
+        iterable of chunks, it is sent as it is generated.
+        """
+        return self.request('post', 'upload', data=body, params={
+            'deploy_id': deploy_id,
+            'service_name': service_name,
+            'file': name,
             'data': json.dumps(data)}, stream=True)
 
 
-def with_printer(event_stream):
+# Held while printing, since uploads report from several threads.
+output_lock = threading.Lock()
+
+
+def puts_prefixed(text, indent=0, prefix='', color=None):
+    """Like ``puts`` within ``indent()``, but safe to use from several
+    threads; every line starts with ``prefix``.
+    """
+    lead = prefix + ' ' * indent
+    lines = ('%s' % text).splitlines() or ['']
+    with output_lock:
+        for line in lines:
+            puts(lead + (color(line) if color else line))
+
+
+def with_printer(event_stream, prefix=''):
     """Given a stream of server events, will output the default
     one that relate to the process messages, will pass through those
     that are unknown.
+
+    Output lines start with ``prefix``, to tell apart the output of
+    streams printed at the same time.
     """
     for event in event_stream:
         if 'job' in event:
-            puts('-----> %s' % event['job'])
+            puts_prefixed('-----> %s' % event['job'], prefix=prefix)
         elif 'log' in event:
-            with indent(7):
-                puts('%s' % event['log'])
+            puts_prefixed(event['log'], 7, prefix)
         elif 'error' in event:
-            with indent(7):
-                puts(colored.red('Error: %s' % event['error']))
+            puts_prefixed('Error: %s' % event['error'], 7, prefix, colored.red)
+        elif 'span' in event:
+            # Timing information, see the trace command
+            pass
         else:
             yield event
 
 
-def print_jobs(event_stream):
+def print_waterfall(spans, width=40):
+    """Render timing spans as a waterfall diagram: one line per span, in
+    the order they started, nested spans indented.
+    """
+    if not spans:
+        return
+    total = max(s['start'] + s['duration'] for s in spans) or 1
+    spans = sorted(spans, key=lambda s: (s['start'], s['depth']))
+
+    def label(span):
+        details = [str(v) for k, v in sorted(span.items())
+                   if not k in ('span', 'start', 'duration', 'depth', 'kind')]
+        text = '  ' * span['depth'] + span['span']
+        if details:
+            text += ' (%s)' % ', '.join(details)
+        return text
+
+    labels = [label(s) for s in spans]
+    label_width = min(max(len(l) for l in labels), 60)
+    for text, span in zip(labels, spans):
+        offset = int(span['start'] / total * width)
+        length = max(int(span['duration'] / total * width), 1)
+        bar = ' ' * offset + '#' * min(length, width - offset)
+        print('%s %s %8.1fms' % (
+            text[:label_width].ljust(label_width), bar.ljust(width),
+            span['duration'] * 1000))
+
+
+def print_jobs(event_stream, prefix=''):
     """Call :meth:`with_printer`, but consume all events."""
-    for event in with_printer(event_stream):
+    for event in with_printer(event_stream, prefix):
         raise ValueError(event)
 
 
@@ -147,7 +209,7 @@ class Config(ConfigParser):
 class App(object):
 
     def __init__(self, config=None):
-        self.PLUGINS = load_plugins(LocalPlugin, self)
+        self._plugins = None
 
         self.config = config = Config(filename=config)
 
@@ -181,6 +243,13 @@ class App(object):
 
         self.api = Api(deploy_url, auth)
 
+    @property
+    def PLUGINS(self):
+        # Importing the plugins pulls in a lot; only do it once needed.
+        if self._plugins is None:
+            self._plugins = load_plugins(LocalPlugin, self)
+        return self._plugins
+
     def run_plugins(self, method_name, *args, **kwargs):
         for plugin in self.PLUGINS:
             method = getattr(plugin, method_name, None)
@@ -207,7 +276,32 @@ class App(object):
 # TODO: Get rid of this global, only used to init the CLI
 APP = App()
 
-@click.group()
+
+class PluginGroup(click.Group):
+    """Lets plugins add their commands, but only if the command asked
+    for is not one of ours.
+    """
+
+    plugins_loaded = False
+
+    def load_plugin_commands(self):
+        if not self.plugins_loaded:
+            self.plugins_loaded = True
+            APP.run_plugins('provide_cli', self)
+
+    def get_command(self, ctx, name):
+        command = click.Group.get_command(self, ctx, name)
+        if command is None:
+            self.load_plugin_commands()
+            command = click.Group.get_command(self, ctx, name)
+        return command
+
+    def list_commands(self, ctx):
+        self.load_plugin_commands()
+        return click.Group.list_commands(self, ctx)
+
+
+@click.group(cls=PluginGroup)
 @click.pass_context
 def main(ctx):
     ctx.obj = APP
@@ -216,10 +310,13 @@ def main(ctx):
 @main.command()
 @click.option('--create', default=False, is_flag=True)
 @click.option('--force', default=False, is_flag=True)
+@click.option('--parallel', type=int, default=None,
+              help='set up this many services at the same time; also '
+                   'limits the uploads, which otherwise run all at once')
 @click.argument('service-file', type=click.Path())
 @click.argument('deploy-id')
 @click.pass_obj
-def deploy(app, service_file, deploy_id, create, force):
+def deploy(app, service_file, deploy_id, create, force, parallel):
     """Take a template, deploy it to the server.
     """
     api = app.api
@@ -230,7 +327,8 @@ def deploy(app, service_file, deploy_id, create, force):
             return
 
     requested_uploads = []
-    for event in with_printer(api.setup(deploy_id, service_file, force=force)):
+    for event in with_printer(api.setup(
+            deploy_id, service_file, force=force, parallel=parallel)):
         if 'data-request' in event:
             requested_uploads.append(event)
             continue
@@ -238,19 +336,76 @@ def deploy(app, service_file, deploy_id, create, force):
             continue
         raise ValueError(event)
 
-    for event in requested_uploads:
+    upload_all(app, deploy_id, service_file, requested_uploads,
+               workers=parallel or len(requested_uploads))
+
+
+def upload_all(app, deploy_id, service_file, data_requests, workers=1):
+    """Provide the data the server asked for; ``workers`` uploads run at
+    the same time, each printing the output of the server with the name
+    of its service in front.
+    """
+    api = app.api
+    width = max([len(r['data-request']) for r in data_requests] or [0])
+    pending = Queue.Queue()
+    for event in data_requests:
+        pending.put(event)
+    failed = []
+
+    def upload(event):
+        service_name = event['data-request']
+        prefix = '%s | ' % service_name.ljust(width) if workers > 1 else ''
+
+        def negotiate(name, data):
+            try:
+                return api.negotiate(deploy_id, service_name, name, data)
+            except requests.HTTPError:
+                # The server does not support it
+                return None
+
         filedata = app.run_plugins(
-            'provide_data',
-            service_file.services[event['data-request']],
-            event['tag'])
-        files = {k: open(v[0], 'rb') for k, v in filedata.items()}
+            'provide_data', service_file.services[service_name],
+            event['tag'], negotiate)
         data = {k: v[1] for k, v in filedata.items()}
 
-        puts('-----> Service %s requested data %s, uploading...' %
-             (event['data-request'], event['tag']))
-
-        print_jobs(api.upload(
-                deploy_id, event['data-request'], data=data, files=files))
+        puts_prefixed('-----> Service %s requested data %s, uploading...' %
+                      (service_name, event['tag']), prefix=prefix)
+
+        for name, (body, info) in filedata.items():
+            if info.get('format') == 'none':
+                # The server has it already
+                body = ''
+            elif isinstance(body, basestring):
+                body = open(body, 'rb')
+            print_jobs(api.upload(
+                deploy_id, service_name, name, body, data=data), prefix)
+
+    def worker():
+        while True:
+            try:
+                event = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                upload(event)
+            except Exception as e:
+                failed.append((event['data-request'], e))
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(min(workers, len(data_requests)), 1))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # A timeout, so that Ctrl+C is not blocked
+        while thread.is_alive():
+            thread.join(1)
+
+    if len(failed) == 1 and len(data_requests) == 1:
+        raise failed[0][1]
+    if failed:
+        raise click.ClickException('Uploading failed for %s' % ', '.join(
+            '%s (%s)' % (name, e) for name, e in failed))
 
 
 @main.command()
@@ -265,6 +420,56 @@ def redeploy(app, deploy_id, service):
             'service': service}, stream=True))
 
 
+@main.command()
+@click.argument('deploy-id')
+@click.argument('service')
+@click.argument('instances', type=int)
+@click.pass_obj
+def scale(app, deploy_id, service, instances):
+    """Set the number of instances a service runs.
+    """
+    print_jobs(app.api.request('post', 'scale', json={
+            'deploy_id': deploy_id,
+            'service': service,
+            'instances': instances}, stream=True))
+
+
+@main.command()
+@click.argument('deploy-id', required=False)
+@click.option('--keep', type=int,
+              help='Number of versions to keep of each service')
+@click.pass_obj
+def prune(app, deploy_id, keep):
+    """Remove old versions of services.
+    """
+    print_jobs(app.api.request('post', 'prune', json={
+            'deploy_id': deploy_id,
+            'keep': keep}, stream=True))
+
+
+@main.command()
+@click.argument('deploy-id')
+@click.option('--all', 'show_all', default=False, is_flag=True,
+              help='Show all stored traces, not just the latest')
+@click.pass_obj
+def trace(app, deploy_id, show_all):
+    """Show where the time went during the last setup of a deployment.
+    """
+    result = app.api.request('get', 'trace', params={'deploy_id': deploy_id})
+    if 'error' in result:
+        raise click.ClickException(result['error'])
+    traces = result['traces']
+    if not traces:
+        print('No traces recorded for %s' % deploy_id)
+        return
+    if not show_all:
+        traces = traces[-1:]
+    for trace in traces:
+        print('Started %s' % time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.localtime(trace['started'])))
+        print_waterfall(trace['spans'])
+
+
 @main.command()
 @click.pass_obj
 def list(app):
@@ -279,6 +484,28 @@ def list(app):
                 print('    %s' % i)
 
 
+@main.command()
+@click.argument('deploy-id', required=False)
+@click.pass_obj
+def status(app, deploy_id):
+    """Show whether the instances are up.
+    """
+    result = app.api.request(
+        'get', 'status', params={'deploy_id': deploy_id} if deploy_id else {})
+    for name, services in sorted(result.items()):
+        print(name)
+        for service, states in sorted(services.items()):
+            print('  %s' % service)
+            for state in states:
+                since = time.strftime(
+                    '%Y-%m-%d %H:%M:%S', time.localtime(state['since']))
+                line = '    %s %s since %s' % (
+                    state['instance'], state['status'], since)
+                if state['restarts']:
+                    line += ' (%s restarts)' % state['restarts']
+                print(line)
+
+
 @main.command('add-server')
 @click.argument('name')
 @click.argument('url')
@@ -293,10 +520,6 @@ def add_server(app, name, url, auth):
     app.config.save()
 
 
-# Let plugins add more commands.
-APP.run_plugins('provide_cli', main)
-
-
 def run():
     sys.exit(main(sys.argv[1:]) or None)
 
@@ -1,6 +1,7 @@
 from functools import wraps
 import functools
 import json
+import time
 import traceback
 from flask import Flask, Blueprint, g, jsonify, request, Response, \
     stream_with_context, current_app, _app_ctx_stack, _request_ctx_stack
@@ -8,7 +9,8 @@ import transaction
 import gevent
 import gevent.queue
 import gevent.monkey
-from .context import Context, set_context, ctx
+from .context import Context, BackgroundContext, set_context, ctx
+from . import metrics
 from deploylib.plugins import load_plugins
 
 
@@ -35,6 +37,14 @@ def check_auth():
                     content_type='application/xml', status=401)
 
 
+def read_only(f):
+    """Decorator for a flask view that does not change the database;
+    the transaction of the request is aborted rather than committed.
+    """
+    f.read_only = True
+    return f
+
+
 class StreamingResponse(Context, Response):
 
     mimetype = 'text/json'
@@ -64,10 +74,39 @@ class TextStreamingResponse(StreamingResponse):
             yield '%s\n' % item['log']
         elif 'error' in item:
             yield 'Error: %s\n' % item['error']
+        elif 'span' in item:
+            # Timings are for clients that can show them
+            return
         else:
             yield json.dumps(item) + '\n'
 
 
+def save_trace(ctx):
+    """Store the spans of a streaming view with the deployment it worked
+    on, if the view said which one that is.
+    """
+    if not ctx.trace_deployment or not ctx.spans:
+        return
+    try:
+        deployment = ctx.cintf.db.deployments.get(ctx.trace_deployment)
+        if deployment is not None:
+            deployment.add_trace(ctx.started, ctx.spans)
+            metrics.commit()
+    except Exception:
+        traceback.print_exc()
+        transaction.abort()
+
+
+def request_body(request):
+    """The body of ``request`` as a stream that can be read as it comes
+    in. werkzeug would hide a chunked body, since it has no length; the
+    WSGI server decodes it for us.
+    """
+    if request.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        return request.environ['wsgi.input']
+    return request.stream
+
+
 def streaming(response_class=StreamingResponse):
     """Decorator to make a view streaming.
 
@@ -93,6 +132,7 @@ def streaming(response_class=StreamingResponse):
             from deploylib.daemon.controller import DeployError
 
             ctx = response_class(None)
+            metrics.track_stream(ctx)
 
             request = _request_ctx_stack.top.request
             app = _app_ctx_stack.top.app
@@ -103,24 +143,41 @@ def streaming(response_class=StreamingResponse):
                 set_context(ctx)
 
                 try:
+                    error = None
                     try:
                         func(request, app, *args, **kwargs)
-                        transaction.commit()
+                        with ctx.span('commit'):
+                            metrics.commit()
                     except DeployError, e:
                         traceback.print_exc()
-                        ctx.fatal('%s' % e)
-                        transaction.commit()
+                        error = '%s' % e
+                        metrics.commit()
                     except Exception, e:
                         traceback.print_exc()
-                        # Unexpected error cause a transaction rollback
+                        # Unexpected error cause a transaction rollback;
+                        # what the backend collected is not applied.
                         ctx.fatal('%s' % e)
                         transaction.abort()
+                        ctx.cintf.rollback()
+                        save_trace(ctx)
+                        return
+
+                    # Only now that the changes are committed
+                    try:
+                        ctx.cintf.flush()
+                    except Exception, e:
+                        traceback.print_exc()
+                        ctx.error('Applying the changes failed: %s' % e)
+
+                    if error:
+                        ctx.fatal(error)
                     else:
                         ctx.done()
+                    save_trace(ctx)
                 finally:
                     ctx.cintf.close()
 
-            gevent.spawn(worker, g.controller)
+            metrics.count('stream', gevent.spawn(worker, g.controller))
             return ctx
         return wrapped
     return decorator
@@ -143,6 +200,7 @@ def json_method(f):
 
 
 @api.route('/list')
+@read_only
 def list():
     """List all deployments.
     """
@@ -158,6 +216,65 @@ def list():
     return jsonify(out)
 
 
+@api.route('/storage')
+@read_only
+def storage():
+    """Size of the database, and statistics about packing it.
+    """
+    return jsonify(g.controller.packer.stats)
+
+
+@api.route('/build-cache')
+@read_only
+def build_cache():
+    """Size of the build cache, and how often builds found it filled.
+    """
+    return jsonify(g.controller.build_cache.as_dict())
+
+
+@api.route('/hosts')
+@read_only
+def hosts():
+    """The docker hosts of a multi-host backend, as last reported.
+    """
+    from deploylib.daemon.multihost import MultiHostBackend
+    backend = g.controller.backend
+    if not isinstance(backend, MultiHostBackend):
+        return jsonify({})
+    return jsonify(backend.stats())
+
+
+@api.route('/hooks')
+@read_only
+def hooks():
+    """How often each plugin hook was called, and the time spent in it.
+    """
+    out = {}
+    for (hook, plugin), (calls, seconds) in g.controller.hook_stats.items():
+        out.setdefault(hook, {})[plugin] = {
+            'calls': calls, 'seconds': round(seconds, 6)}
+    return jsonify(out)
+
+
+@api.route('/status')
+@read_only
+def status():
+    """Whether the instances are up, as tracked from the docker events.
+    """
+    return jsonify(g.controller.monitor.status(request.args.get('deploy_id')))
+
+
+@api.route('/trace')
+@read_only
+def trace():
+    """The timing spans of the most recent setups of a deployment.
+    """
+    deployment = g.cintf.db.deployments.get(request.args['deploy_id'])
+    if deployment is None:
+        return jsonify({'error': 'no such deployment'})
+    return jsonify({'traces': deployment.recent_traces()})
+
+
 @api.route('/create', methods=['PUT'])
 def create():
     """Create a new deployment.
@@ -178,6 +295,11 @@ def setup_services(request, app):
 
     - Replace the global data of the deployment.
     - Set (add or replace) one or more services within the deployment.
+
+    If ``parallel`` is given, up to that many services are set up at
+    the same time. Each of them is committed on its own once it is done,
+    so the request is no longer atomic: a failure later on does not undo
+    the services that were already set up.
     """
 
     data = request.get_json()
@@ -185,19 +307,24 @@ def setup_services(request, app):
     services = data['services']
     globals = data['globals']
     force = data['force']
+    parallel = data.get('parallel')
 
     if not deploy_id in ctx.cintf.db.deployments:
         ctx.fatal('no such deployment, create first')
         return
+    ctx.trace_deployment = deploy_id
+
+    # Pulling images takes a while, so start right away.
+    ctx.cintf.prefetch_images(services)
 
     # First, write the new version of the global environment. If it has
     # changed, we need to recreate all services.
     globals_changed = ctx.cintf.set_globals(deploy_id, globals)
 
     # Deploy the actual services.
-    for name, service in services.items():
-        ctx.cintf.set_service(deploy_id, name, service,
-                         force=force)
+    if parallel:
+        ctx.cintf.concurrency = parallel
+    ctx.cintf.set_services(deploy_id, services, force=force)
 
 
 @api.route('/run', methods=['POST'])
@@ -215,11 +342,16 @@ def run(request, app):
     ctx.job('Executing "{command}" of service {service}'.format(**data))
     service = ctx.cintf.db.deployments[deploy_id].services[sname]
 
-    runcfg, definition, _ = ctx.cintf.generate_runcfg(service, service.version)
+    runcfg, definition, port_assignments = ctx.cintf.generate_runcfg(
+        service, service.version)
     runcfg['cmd'] = [cmd]
 
     ctx.cintf.run_plugins('before_once', service, definition, runcfg)
-    exitcode = ctx.cintf.backend.once(runcfg)
+    try:
+        exitcode = ctx.cintf.backend.once(runcfg)
+    finally:
+        ctx.cintf.release_ports(
+            p['host'] for p in port_assignments.values())
     if exitcode:
         from deploylib.daemon.controller import DeployError
         raise DeployError('Run job returned exit code %s' % exitcode)
@@ -237,31 +369,89 @@ def redeploy(request, app):
     sname = data['service']
 
     service = ctx.cintf.db.deployments[deploy_id].services[sname]
+    ctx.trace_deployment = deploy_id
     ctx.cintf.set_service(deploy_id, sname, service.version.definition, force=True)
 
 
+@api.route('/scale', methods=['POST'])
+@streaming()
+def scale(request, app):
+    """Set the number of instances a service runs.
+    """
+    data = request.get_json()
+    deploy_id = data['deploy_id']
+    sname = data['service']
+
+    deployment = ctx.cintf.db.deployments.get(deploy_id)
+    if not deployment or not sname in deployment.services:
+        ctx.fatal('no such service')
+        return
+
+    ctx.job('%s - scaling to %s' % (sname, data['instances']))
+    ctx.trace_deployment = deploy_id
+    ctx.cintf.scale(deploy_id, sname, int(data['instances']))
+
+
+@api.route('/prune', methods=['POST'])
+@streaming()
+def prune(request, app):
+    """Remove old versions of the services of one or all deployments.
+    """
+    data = request.get_json() or {}
+    deploy_id = data.get('deploy_id')
+    if deploy_id and not deploy_id in ctx.cintf.db.deployments:
+        ctx.fatal('no such deployment')
+        return
+
+    ctx.job('Pruning old versions')
+    ctx.cintf.prune(deploy_id, keep=data.get('keep'))
+
+
 @api.route('/upload', methods=['POST'])
 @streaming()
 def upload(request, app):
     """Provide a binary file; usually an app that is supposed to be
     deployed.
 
-    Provide multiple files via multipart-form encoding.
-
-    You also need to provide an "info" key which has to contain a JSON
-    object with the following data (the indirection is necessary because
-    of limitations of the encoding):
+    The file is the body of the request, and is passed on while it is
+    still being received; give its name as the "file" query argument.
+    Also expected as arguments are:
 
         deploy_id
         service_name
         data = {fileid: {}}
+
+    Multiple files can still be uploaded at once via multipart-form
+    encoding, with the arguments as form fields; they are then buffered
+    until the upload is complete.
     """
 
     deploy_id = request.values['deploy_id']
     service_name = request.values['service_name']
-    data = json.loads(request.values.get('data', {}))
+    data = json.loads(request.values.get('data', '{}'))
 
-    ctx.cintf.provide_data(deploy_id, service_name, request.files, data)
+    if request.files:
+        files = request.files
+    else:
+        files = {request.args['file']: request_body(request)}
+
+    ctx.trace_deployment = deploy_id
+    ctx.cintf.provide_data(deploy_id, service_name, files, data)
+
+
+@api.route('/negotiate', methods=['POST'])
+@read_only
+@json_method
+def negotiate(deploy_id, service_name, file, data):
+    """Ask before uploading a file what the server has of it already;
+    the answer depends on the plugin that wants the file.
+    """
+    set_context(BackgroundContext(g.cintf))
+    try:
+        return g.cintf.negotiate_data(
+            deploy_id, service_name, file, data) or {}
+    finally:
+        set_context(None)
 
 
 def create_app(controller):
@@ -271,20 +461,29 @@ def create_app(controller):
 
     @app.before_request
     def before_request():
+        g.request_started = time.time()
+        view = app.view_functions.get(request.endpoint)
         g.controller = controller
-        g.cintf = controller.interface()
+        g.cintf = controller.interface(
+            read_only=getattr(view, 'read_only', False))
 
     @app.teardown_request
     def after_request(exception):
-        if exception:
-            transaction.abort()
-        else:
-            transaction.commit()
-        g.cintf.close()
+        try:
+            if exception or g.cintf.read_only:
+                transaction.abort()
+            else:
+                metrics.commit()
+            g.cintf.close()
+        finally:
+            metrics.REQUEST_SECONDS.observe(
+                time.time() - g.request_started,
+                endpoint=request.endpoint or 'unknown')
 
 
     # Register the API
     app.register_blueprint(api)
+    app.register_blueprint(metrics.metrics_api)
 
     # Let plugins contribute blueprints
     for blueprint in load_plugins(Blueprint):
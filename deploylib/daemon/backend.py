@@ -14,12 +14,23 @@ Possible backends that I can imagine right now are:
 - Pass runcfg as a job to flynn-controller (we might not have to manage
      multiple different hosts ourselves).
 - Create CoreOS fleet service files, and invoke those.
+
+For running containers on several docker hosts, see ``multihost.py``.
+
+On a single host, the containers are usually kept running by a
+supervisor; select it via the ``SUPERVISOR`` environment variable, see
+:data:`SUPERVISORS`.
 """
 
 import os
+import json
+import time
 import docker
 import docker.errors
+import gevent
 from os import path
+from deploylib.daemon.context import span
+from deploylib.daemon.metrics import InstrumentedClient
 
 
 class Backend(object):
@@ -33,15 +44,37 @@ class Backend(object):
     start(runcfg) -> instance id
         Spin up an instance of the thing in runcfg.
 
-    status(instance id)
-        Is the instance up or down.
+    status(instance id, host=None)
+        Is the instance up (True) or down (False).
+
+    restart(instance id, host=None)
+        Start the instance again after it went down.
+
+    terminate(instance id, host=None)
+        Remove the instance. ``host`` is the ``host`` key of the runcfg it
+        was started with, if the backend chose one.
 
-    terminate(instance id)
-        Remove the instance.
+    add_listener(func)
+        An optional method to have ``func(event, host=None)`` called
+        for every docker event.
+
+    host_backend(runcfg)
+        The :class:`DockerOnlyBackend` of the docker host the container
+        of ``runcfg`` runs on; for plugins that prepare its image.
+
+    flush(cintf)
+        An optional method called once the controller has committed the
+        work for a request, to apply changes the backend has collected
+        for it; that is, while called with ``ctx.cintf`` being ``cintf``.
 
     once(runcfg) - Streaming output
         Run a one-time command.
 
+    supervised
+        True if something else, like a supervisor, starts the container
+        of an instance again when it goes down; the controller then does
+        not.
+
     This design is flexible enough to allow a supervisor based backend to
     choose whether a service instance should be kept up by way of
     restarting the same container (i.e. an instance is mapped to a single
@@ -49,22 +82,125 @@ class Backend(object):
     every time the instance comes up.
     """
 
+    supervised = False
+
     def prepare(self, runcfg, service):
         pass
 
     def start(self, runcfg, service, instance_id=None):
         raise NotImplementedError()
 
-    def terminate(self, instance_id):
+    def terminate(self, instance_id, host=None):
+        raise NotImplementedError()
+
+    def status(self, instance_id, host=None):
         raise NotImplementedError()
 
-    def status(self, instance_id):
+    def restart(self, instance_id, host=None):
         raise NotImplementedError()
 
     def once(self, runcfg):
         raise NotImplementedError()
 
 
+# Backends for a single docker host, by the name of the supervisor that
+# keeps the containers running. A backend of a different package can be
+# given as "module:class". Modules are only imported when used.
+SUPERVISORS = {
+    'none': 'deploylib.daemon.backend:DockerOnlyBackend',
+    'upstart': 'deploylib.plugins.upstart:UpstartBackend',
+    'systemd': 'deploylib.plugins.systemd:SystemdBackend',
+}
+
+
+def create_backend(supervisor, docker_url):
+    from importlib import import_module
+    spec = SUPERVISORS.get(supervisor, supervisor)
+    if not ':' in spec:
+        raise ValueError('Unknown supervisor: %s' % supervisor)
+    module_name, class_name = spec.split(':', 1)
+    return getattr(import_module(module_name), class_name)(docker_url)
+
+
+def parse_memory(value):
+    """Accept a number of bytes, or a string like "512m".
+    """
+    if value is None or isinstance(value, (int, long)):
+        return value
+    units = {'k': 1024, 'm': 1024**2, 'g': 1024**3}
+    value = value.strip().lower()
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def normalize_image_ref(ref):
+    """Docker assumes the "latest" tag if none is given."""
+    if not ':' in ref.split('/')[-1]:
+        ref = '%s:latest' % ref
+    return ref
+
+
+class ImageCache(object):
+    """Remembers the metadata we need of docker images (id, entrypoint,
+    cmd and exposed ports), so we don't have to ask docker every time we
+    start a container.
+
+    Entries are keyed by image reference as well as by image id, and are
+    dropped once docker reports a change to either of them. In case
+    nobody is watching the docker event stream, entries also expire
+    after ``max_age`` seconds.
+    """
+
+    max_age = 300
+
+    def __init__(self):
+        self.by_ref = {}
+        self.refs_by_id = {}
+
+    def get(self, ref):
+        entry = self.by_ref.get(normalize_image_ref(ref))
+        if not entry:
+            return None
+        info, added = entry
+        if time.time() - added > self.max_age:
+            self.invalidate(ref)
+            return None
+        return info
+
+    def put(self, ref, inspect_result):
+        config = inspect_result.get('config') or \
+                 inspect_result.get('Config') or {}
+        info = {
+            'id': inspect_result.get('id') or inspect_result.get('Id'),
+            'entrypoint': config.get('Entrypoint'),
+            'cmd': config.get('Cmd'),
+            'ports': sorted((config.get('ExposedPorts') or {}).keys()),
+        }
+        ref = normalize_image_ref(ref)
+        self.by_ref[ref] = (info, time.time())
+        self.refs_by_id.setdefault(info['id'], set()).add(ref)
+        return info
+
+    def invalidate(self, ref_or_id):
+        for ref in self.refs_by_id.pop(ref_or_id, ()):
+            self.by_ref.pop(ref, None)
+        ref = normalize_image_ref(ref_or_id)
+        entry = self.by_ref.pop(ref, None)
+        if entry:
+            self.refs_by_id.get(entry[0]['id'], set()).discard(ref)
+
+    def clear(self):
+        self.by_ref.clear()
+        self.refs_by_id.clear()
+
+    def handle_event(self, event):
+        """Process an event from the docker event stream."""
+        if event.get('status') in ('pull', 'tag', 'untag', 'delete',
+                                   'import', 'push'):
+            self.invalidate(event.get('id', ''))
+
+
 class DockerOnlyBackend(object):
     """Simply uses the docker API to create containers and start them.
 
@@ -74,8 +210,14 @@ class DockerOnlyBackend(object):
     """
 
     def __init__(self, docker_url):
-        self.client = docker.Client(
-            base_url=docker_url, version='1.6', timeout=10)
+        self.docker_url = docker_url
+        self.client = InstrumentedClient(docker.Client(
+            base_url=docker_url, version='1.6', timeout=10))
+        self.images = ImageCache()
+        # Image pulls currently running in the background
+        self._pulls = {}
+        # Called with every docker event
+        self.listeners = []
 
     def prepare(self, runcfg, service):
         cid = self.create_container(runcfg)
@@ -94,13 +236,34 @@ class DockerOnlyBackend(object):
             port_bindings=runcfg['ports'],
             links=runcfg.get('links', {}),
             privileged=runcfg['privileged'])
-        return instance_id
+        return instance_id, runcfg['name']
+
+    def host_backend(self, runcfg):
+        return self
+
+    def terminate(self, (instance_id, name), host=None):
+        self.stop_container(instance_id)
 
-    def terminate(self, (instance_id, name)):
+    def stop_container(self, instance_id, timeout=10):
+        """Stop the container (killing it after ``timeout`` seconds), and
+        wait until it has exited, so its ports are free.
+        """
         try:
-            self.client.stop(instance_id, 10)
-        except:
-            pass
+            self.client.stop(instance_id, timeout)
+            self.client.wait(instance_id)
+        except Exception as e:
+            # It might be gone already
+            print "Stopping container %s: %s" % (instance_id, e)
+
+    def status(self, (instance_id, name), host=None):
+        try:
+            info = self.client.inspect_container(instance_id)
+        except docker.errors.APIError:
+            return False
+        return bool((info.get('State') or {}).get('Running'))
+
+    def restart(self, (instance_id, name), host=None):
+        self.client.restart(instance_id, 10)
 
     def once(self, runcfg):
         container = self.create_container(runcfg)
@@ -113,11 +276,82 @@ class DockerOnlyBackend(object):
         return self.client.wait(container)
 
     def pull_image(self, imgname):
+        """Make sure the image is available locally."""
+        self.image_info(imgname)
+
+    def image_info(self, imgname):
+        """Return the image metadata as stored by :class:`ImageCache`,
+        pulling the image first if it does not exist.
+        """
+        pending = self._pulls.get(imgname)
+        if pending:
+            pending.join()
+
+        info = self.images.get(imgname)
+        if info is None:
+            info = self._fetch_image(imgname)
+        return info
+
+    def _fetch_image(self, imgname):
         try:
-            self.client.inspect_image(imgname)
+            result = self.client.inspect_image(imgname)
         except docker.errors.APIError:
             print "Pulling image %s" % imgname
-            print self.client.pull(imgname)
+            with span('pull', image=imgname):
+                print self.client.pull(imgname)
+            result = self.client.inspect_image(imgname)
+        return self.images.put(imgname, result)
+
+    def prefetch(self, images):
+        """Start pulling the given images in the background, such that
+        they are hopefully available once a container needs them.
+        """
+        def fetch(imgname):
+            try:
+                self._fetch_image(imgname)
+            except Exception as e:
+                # It will be tried again when the image is needed.
+                print "Prefetching image %s failed: %s" % (imgname, e)
+            finally:
+                self._pulls.pop(imgname, None)
+
+        for imgname in set(images):
+            if imgname in self._pulls or self.images.get(imgname):
+                continue
+            self._pulls[imgname] = gevent.spawn(fetch, imgname)
+
+    def add_listener(self, func):
+        self.listeners.append(func)
+
+    def handle_event(self, event):
+        """Process an event from the docker event stream."""
+        self.images.handle_event(event)
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                print "Handling docker event failed: %s" % e
+
+    def watch_events(self):
+        """Follow the docker event stream in a greenlet, passing all
+        events to :meth:`handle_event`.
+        """
+        def watch():
+            # The regular client has a timeout we cannot use here.
+            client = docker.Client(
+                base_url=self.docker_url, version='1.6', timeout=None)
+            while True:
+                try:
+                    for event in client.events():
+                        if isinstance(event, basestring):
+                            event = json.loads(event)
+                        self.handle_event(event)
+                except Exception as e:
+                    print "Docker event stream failed: %s" % e
+                # We might have missed events while not connected.
+                self.images.clear()
+                gevent.sleep(5)
+        return gevent.spawn(watch)
 
     def create_container(self, runcfg):
         # If the given name already exists, we need to delete the container
@@ -147,6 +381,7 @@ class DockerOnlyBackend(object):
             # or the binds won't work during start.
             ports=runcfg['ports'].keys(),
             volumes=runcfg['volumes'].values(),
+            mem_limit=parse_memory(runcfg.get('memory')) or 0,
         )
         container_id = result['Id']
         return container_id
@@ -0,0 +1,157 @@
+"""Cache directories for builds, shared by all deployments.
+
+A builder (like slugbuilder) keeps downloaded dependencies in a cache
+directory that is mounted into its container. Rather than one directory
+per service, the directory is chosen by a key that describes what ends up
+in the cache, such as the buildpack and a hash of the dependency lock
+files; so the first build of an app in a new deployment can use the
+cache of the same app elsewhere.
+
+Only one build uses a directory at a time. Once the directories together
+take more than ``BUILD_CACHE_SIZE`` (default: 5g) of disk space, the ones
+used least recently are removed. When a directory was last used is its
+modification time, so this survives restarts of the controller.
+
+Measuring and removing directories walks the disk; that is done in
+gevent's threadpool, so the controller keeps serving meanwhile.
+
+Cache directories of earlier versions (one per service, in
+``_cache/slugbuilder``) are given as ``legacy``, and removed once the
+cache is first measured.
+"""
+
+import os
+import shutil
+from contextlib import contextmanager
+from os import path
+import gevent
+import gevent.lock
+from deploylib.daemon.backend import parse_memory
+
+
+def disk_usage(directory):
+    """Bytes used by the files below ``directory``."""
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.lstat(path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _in_thread(func, *args):
+    return gevent.get_hub().threadpool.apply(func, args)
+
+
+class BuildCache(object):
+
+    def __init__(self, root, budget=5 * 1024**3, legacy=()):
+        self.root = root
+        self.budget = budget
+        self.legacy = list(legacy)
+        # key -> lock, held while a build uses the directory, or while
+        # it is removed. Kept for good, so that there is only ever one
+        # lock per key.
+        self.locks = {}
+        # key -> bytes, measured after the directory was last used
+        self.sizes = None
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+    @classmethod
+    def from_environ(cls, root, legacy=(), environ=os.environ):
+        return cls(root, legacy=legacy, budget=parse_memory(
+            environ.get('BUILD_CACHE_SIZE', '5g')))
+
+    def directory(self, key):
+        return path.join(self.root, key)
+
+    @contextmanager
+    def use(self, key):
+        """Provide the directory for ``key``, waiting if another build
+        is using it; afterwards, make room if over budget.
+        """
+        lock = self.locks.setdefault(key, gevent.lock.Semaphore())
+        with lock:
+            directory = self.directory(key)
+            if path.exists(directory) and os.listdir(directory):
+                self.stats['hits'] += 1
+            else:
+                self.stats['misses'] += 1
+                if not path.exists(directory):
+                    os.makedirs(directory)
+            try:
+                yield directory
+            finally:
+                os.utime(directory, None)
+                self._measure()[key] = _in_thread(disk_usage, directory)
+        self.evict(keep=key)
+
+    def _measure(self):
+        if self.sizes is None:
+            while self.legacy:
+                directory = self.legacy.pop()
+                if path.exists(directory):
+                    print "Removing old build cache %s" % directory
+                    _in_thread(shutil.rmtree, directory, True)
+
+            # Others see the sizes only once all are known.
+            sizes = {}
+            if path.exists(self.root):
+                for key in os.listdir(self.root):
+                    sizes[key] = _in_thread(disk_usage, self.directory(key))
+            if self.sizes is None:
+                self.sizes = sizes
+        return self.sizes
+
+    def size(self):
+        return sum(self._measure().values())
+
+    def evict(self, keep=None):
+        """Remove the directories used least recently until the cache
+        fits its budget; those in use are skipped, as is ``keep``.
+        """
+        sizes = self._measure()
+
+        def last_used(key):
+            try:
+                return os.stat(self.directory(key)).st_mtime
+            except OSError:
+                return 0
+
+        for key in sorted(sizes, key=last_used):
+            if sum(sizes.values()) <= self.budget:
+                break
+            if key == keep:
+                continue
+            # A build that wants the directory waits until it is gone.
+            lock = self.locks.setdefault(key, gevent.lock.Semaphore())
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                # Another eviction may have removed it while we waited
+                # for the threadpool.
+                if not key in sizes:
+                    continue
+                print "Removing build cache %s (%d bytes)" % (
+                    key, sizes[key])
+                _in_thread(shutil.rmtree, self.directory(key), True)
+                sizes.pop(key, None)
+                self.stats['evictions'] += 1
+            finally:
+                lock.release()
+
+    def as_dict(self):
+        result = dict(self.stats)
+        result.update({
+            'size': self.size(),
+            'budget': self.budget,
+            'entries': len(self._measure()),
+        })
+        return result
@@ -1,3 +1,5 @@
+from contextlib import contextmanager
+import time
 import gevent.queue
 from werkzeug.local import Local
 
@@ -13,11 +15,65 @@ def set_context(ctx):
         local.ctx = ctx
 
 
+@contextmanager
+def span(name, min_duration=0, **info):
+    """Time a phase of the work done for the current context, see
+    :meth:`Context.span`. Does nothing if there is no context, as in
+    background greenlets.
+    """
+    try:
+        context = ctx._get_current_object()
+    except RuntimeError:
+        context = None
+    if context is None:
+        yield
+    else:
+        with context.span(name, min_duration, **info):
+            yield
+
+
 class Context(object):
 
+    # If set, the id of the deployment the spans should be stored with
+    # once the work is done.
+    trace_deployment = None
+
     def __init__(self, cintf):
         self.cintf = cintf
         self.queue = gevent.queue.Queue()
+        self.started = time.time()
+        self.spans = []
+        self._depth = 0
+
+    @contextmanager
+    def span(self, name, min_duration=0, **info):
+        """Time the code within, and report it as a ``span`` event once
+        done, with the start relative to when the context was created.
+
+        Spans within spans have a higher ``depth``. Those that took less
+        than ``min_duration`` seconds are not reported.
+        """
+        started = time.time()
+        depth = self._depth
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth = depth
+            duration = time.time() - started
+            if duration >= min_duration:
+                span = dict(info)
+                span.update({
+                    'span': name,
+                    'start': round(started - self.started, 6),
+                    'duration': round(duration, 6),
+                    'depth': depth,
+                })
+                self.record_span(span)
+
+    def record_span(self, span):
+        self.spans.append(span)
+        self.custom(**span)
 
     def custom(self, **obj):
         self.queue.put(obj)
@@ -38,3 +94,42 @@ class Context(object):
 
     def done(self):
         self.queue.put(StopIteration)
+
+
+class BackgroundContext(Context):
+    """Context for work the controller does on its own, such as reacting
+    to docker events. Nobody is listening, so messages are printed.
+    """
+
+    def custom(self, **obj):
+        for key in ('job', 'log', 'error'):
+            if key in obj:
+                print "%s: %s" % (key, obj[key])
+
+    def done(self):
+        pass
+
+
+class ForwardingContext(Context):
+    """Context for a helper greenlet that works on behalf of another
+    context, for example when services are being set up concurrently.
+
+    It has its own controller interface (and thus database connection),
+    but all events end up in the stream of the parent.
+    """
+
+    def __init__(self, cintf, parent):
+        Context.__init__(self, cintf)
+        self.parent = parent
+        self.started = parent.started
+        self._depth = parent._depth
+
+    def custom(self, **obj):
+        self.parent.custom(**obj)
+
+    def record_span(self, span):
+        self.parent.record_span(span)
+
+    def done(self):
+        # Only the parent may end the stream.
+        pass
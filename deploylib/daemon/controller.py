@@ -1,22 +1,35 @@
 import copy
+import functools
 import os
 from os import path
 import shlex
+import socket
+import time
 from subprocess import check_output as run, CalledProcessError
-import random
 import binascii
 import BTrees.OOBTree
 import click
 import gevent
+import gevent.pool
 import netifaces
+import requests
 import ZODB
 import ZODB.FileStorage
+from ZODB.POSException import ConflictError
 import transaction
 from deploylib.daemon.api import create_app
 from deploylib.plugins import load_plugins, Plugin
-from deploylib.plugins.upstart import UpstartBackend
-from deploylib.daemon.db import Deployment, DeployDBNew
-from .context import ctx, set_context, Context
+from deploylib.daemon.db import Deployment, DeployDBNew, SlugIndex
+from deploylib.daemon.backend import create_backend
+from deploylib.daemon.discovery import ConsulDiscovery
+from deploylib.daemon.pack import PackScheduler
+from deploylib.daemon.health import InstanceMonitor
+from deploylib.daemon.buildcache import BuildCache
+from deploylib.daemon.multihost import MultiHostBackend, NoCapacityError
+from deploylib.daemon.ports import (
+    PortAllocator, NoFreePortError, listening_ports, wait_until_free)
+from deploylib.daemon import metrics
+from .context import ctx, set_context, span, Context, ForwardingContext
 
 
 # For old ZODB databases, support module alias
@@ -120,6 +133,86 @@ def canonical_definition(name, definition):
     return name, DeepCopyDict(canonical)
 
 
+def rollout_options(definition):
+    """Return the options how a service is to be replaced by a new
+    version, given via the ``rollout`` key::
+
+        web:
+            rollout:
+                strategy: start-first
+                check: http
+
+    or, with all the options::
+
+        web:
+            rollout:
+                strategy: start-first
+                check: http        # or "tcp", or "none"; required for
+                                   # start-first
+                path: /health      # for the http check
+                timeout: 30        # seconds to wait for readiness
+                drain: 5           # seconds between unregistering the
+                                   # old instance and stopping it
+                batch: 2           # instances replaced at a time
+                surge: 2           # with start-first, new instances
+                                   # started before old ones are
+                                   # stopped; defaults to batch
+
+    The default strategy is ``stop-first``: Stop the old instance, then
+    start the new one.
+
+    There is no default ``check``: the ``tcp`` check passes as soon as
+    docker's userland proxy listens on the port, whether or not the
+    container is ready, so it is only of use where the ports are mapped
+    by iptables alone.
+    """
+    options = definition['kwargs'].get('rollout') or {}
+    if isinstance(options, basestring):
+        options = {'strategy': options}
+    result = {
+        'strategy': 'stop-first',
+        'check': None,
+        'path': '/',
+        'timeout': 30,
+        'drain': 0,
+        'batch': 1,
+        'surge': None,
+    }
+    result.update(options)
+    if not result['strategy'] in ('stop-first', 'start-first'):
+        raise DeployError('Unknown rollout strategy: %s' % result['strategy'])
+    if result['strategy'] == 'start-first' and not result['check']:
+        raise DeployError(
+            'start-first needs a readiness check: set rollout.check to '
+            '"http", "tcp" or "none"')
+    result['batch'] = max(int(result['batch']), 1)
+    result['surge'] = max(int(result['surge'] or result['batch']), 1)
+    return result
+
+
+def check_ready(host, port, check='tcp', path='/'):
+    """Return True if something accepts connections on the given port.
+
+    Note that if the port is mapped through docker's userland proxy, the
+    proxy accepts connections even when the container does not; use the
+    ``http`` check in that case.
+    """
+    if check == 'http':
+        try:
+            response = requests.get(
+                'http://%s:%s%s' % (host, port, path), timeout=2)
+        except requests.RequestException:
+            return False
+        return response.status_code < 500
+
+    try:
+        sock = socket.create_connection((host, port), timeout=2)
+    except socket.error:
+        return False
+    sock.close()
+    return True
+
+
 class ControllerInterface(object):
     """This implements the main controller functionality around a
     database connection. Because we are a multi-threaded/multi-greenleted
@@ -128,8 +221,12 @@ class ControllerInterface(object):
     operating on the server will get their own ``ControllerInterface``.
     """
 
-    def __init__(self, controller):
+    # How many services may be set up at the same time
+    concurrency = 1
+
+    def __init__(self, controller, read_only=False):
         self.controller = controller
+        self.read_only = read_only
         self.backend = controller.backend
 
         self.run_plugins = controller.run_plugins
@@ -140,6 +237,11 @@ class ControllerInterface(object):
 
         self._db_obj, self.db = controller.get_connection()
 
+        # The instances started, and the containers placed on a docker
+        # host, through this interface; see :meth:`rollback`.
+        self.started = []
+        self.placed = []
+
     def close(self):
         self._db_obj.close()
 
@@ -147,11 +249,55 @@ class ControllerInterface(object):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_type:
-            transaction.abort()
-        else:
-            transaction.commit()
-        self.close()
+        try:
+            if exc_type or self.read_only:
+                transaction.abort()
+            else:
+                try:
+                    transaction.commit()
+                except:
+                    transaction.abort()
+                    raise
+                self.flush()
+        finally:
+            self.close()
+
+    def flush(self):
+        """Let the backend apply the changes it collected through this
+        interface; called once they have been committed.
+        """
+        flush = getattr(self.backend, 'flush', None)
+        if flush:
+            with span('flush'):
+                flush(self)
+
+    def commit(self):
+        """Commit the current transaction; the instances started so far
+        are there to stay.
+        """
+        with span('commit'):
+            metrics.commit()
+        self.started, self.placed = [], []
+
+    def rollback(self):
+        """Stop the instances started through this interface; to be
+        called once its transaction has been aborted, which means the
+        database does not know about them anymore. The ports they were
+        given have been freed by the abort, the memory reserved for the
+        containers placed on a docker host is given up here.
+        """
+        placed, self.placed = self.placed, []
+        started, self.started = self.started, []
+        for service, instance, container in started:
+            self.controller.monitor.untrack(instance)
+            self.run_plugins('post_stop', service, instance)
+            try:
+                self._terminate(service, [container])
+            except Exception, e:
+                ctx.error('Failed to stop %s: %s' % (container[0][1], e))
+        self._unplace(placed)
+        # Whatever the plugins wrote was about the aborted changes.
+        transaction.abort()
 
     def create_deployment(self, deploy_id, fail=True):
         """Create a new instance.
@@ -172,6 +318,9 @@ class ControllerInterface(object):
         deployment = self.db.deployments[deploy_id]
         globals_changed = deployment.globals != globals
         deployment.globals = globals
+        # Every new version will refer to this, so store it right away;
+        # services set up concurrently then do not all try to.
+        deployment.intern(globals)
         if globals_changed:
             self.run_plugins('on_globals_changed', deployment)
         return globals_changed
@@ -186,7 +335,8 @@ class ControllerInterface(object):
         ctx.job('%s - installing' % name)
 
         deployment = self.db.deployments[deploy_id]
-        name, definition = canonical_definition(name, definition)
+        with span('canonicalize', service=name):
+            name, definition = canonical_definition(name, definition)
 
         # If the service is not changed, we can skip it
         exists = name in deployment.services
@@ -203,23 +353,177 @@ class ControllerInterface(object):
         self.setup_version(service, version, **kwargs)
         return service
 
+    def prefetch_images(self, services):
+        """Given raw service definitions, have the backend start pulling
+        the images they need, while we are busy with other things.
+        """
+        prefetch = getattr(self.backend, 'prefetch', None)
+        if not prefetch:
+            return
+
+        images = []
+        for name, definition in services.items():
+            _, canonical = canonical_definition(name, definition)
+            if not self.run_plugins('provide_images', canonical, images):
+                images.append(canonical['image'])
+        prefetch(images)
+
+    def set_services(self, deploy_id, services, force=False, concurrency=None):
+        """Set multiple services of a deployment at once.
+
+        By default, this simply calls :meth:`set_service` for each one.
+
+        If ``concurrency`` (or, if not given, the ``concurrency`` attribute
+        of this interface) is larger than one, services are set up in a
+        pool of that many greenlets; see :meth:`run_parallel`.
+
+        Services for which a plugin says they need to be set up serially
+        (because they are ``require``-ing something, for instance; holds
+        are only released for services visible in the same transaction)
+        are set up afterwards, one by one, using this interface. The same
+        happens to a service whose transaction fails with a conflict.
+
+        Note that like everything else, this is not atomic: if a service
+        fails, the services that were set up successfully stay that way.
+        """
+        concurrency = concurrency or self.concurrency
+        if concurrency <= 1 or len(services) <= 1:
+            for name, definition in services.items():
+                self.set_service(deploy_id, name, definition, force=force)
+            return
+
+        deployment = self.db.deployments[deploy_id]
+        concurrent, serial = {}, []
+        for name, definition in services.items():
+            _, canonical = canonical_definition(name, definition)
+            if self.run_plugins('needs_serial_setup', deployment, canonical):
+                serial.append(name)
+            else:
+                concurrent[name] = functools.partial(
+                    ControllerInterface.set_service, deploy_id=deploy_id,
+                    name=name, definition=definition, force=force)
+
+        errors, conflicts = self.run_parallel(concurrent, concurrency)
+
+        for name in conflicts + serial:
+            self.set_service(deploy_id, name, services[name], force=force)
+
+        if errors:
+            raise DeployError(
+                'Setting up failed for: %s' % ', '.join(sorted(errors)))
+
+    def run_parallel(self, jobs, concurrency):
+        """Run ``jobs``, a dict of callables, in a pool of greenlets.
+
+        Since ZODB connections cannot be shared, each job is called with a
+        new :class:`ControllerInterface` of its own, and has its own
+        transaction, which is committed once the job is done. All events
+        are passed to the current context.
+
+        The current transaction is committed before the jobs start, so
+        they see what we have written so far; once they are done, we start
+        a new one to see what they have written.
+
+        Returns the keys of the jobs that failed (the errors have been
+        reported), and those whose transaction failed due to a conflict;
+        the caller should retry those, for example by running them
+        serially. The instances such a job started are stopped again.
+
+        Note that this means the work of the caller is not atomic: what
+        it did before, and each job that succeeded, is committed even if
+        the caller fails later.
+        """
+        self.commit()
+
+        pool = gevent.pool.Pool(concurrency)
+        parent = ctx._get_current_object()
+        greenlets = [
+            (key, metrics.count('parallel_job', pool.spawn(
+                self._run_in_greenlet, parent, job)))
+            for key, job in jobs.items()]
+        pool.join()
+
+        self.commit()
+
+        errors, conflicts = [], []
+        for key, greenlet in greenlets:
+            if not greenlet.successful():
+                ctx.error('%s: %s' % (key, greenlet.exception))
+                errors.append(key)
+            elif greenlet.value is False:
+                ctx.log('%s: conflicting write, retrying' % key)
+                conflicts.append(key)
+        return errors, conflicts
+
+    def _run_in_greenlet(self, parent, job):
+        """Run ``job`` with a separate connection.
+
+        Return False if the transaction could not be committed due to a
+        conflict, so the caller may retry. Either way, the instances the
+        job has started are stopped again if its transaction is aborted.
+        """
+        cintf = self.controller.interface()
+        set_context(ForwardingContext(cintf, parent))
+        try:
+            try:
+                job(cintf)
+                cintf.commit()
+            except ConflictError:
+                transaction.abort()
+                cintf.rollback()
+                return False
+            except:
+                transaction.abort()
+                cintf.rollback()
+                raise
+            cintf.flush()
+        finally:
+            cintf.close()
+            set_context(None)
+        return True
+
     def setup_version(self, service, version, **kwargs):
         """Internal method to go through the service setup process, to
         be used by plugins. Needs to be passed the db objects, and the
         canonical service definition.
         """
 
-        # See if a plugin will handle this.
-        handled_by_plugin = self.run_plugins('setup', service, version)
+        with metrics.SETUP_SECONDS.time(
+                deployment=service.deployment.id, service=service.name):
+            # See if a plugin will handle this.
+            handled_by_plugin = self.run_plugins('setup', service, version)
+
+            # If no plugin handles this, deploy as a regular docker image.
+            if not handled_by_plugin:
+                self.create_container(service, version, **kwargs)
+            else:
+                if service.held:
+                    ctx.log('service was held: %s' % service.hold_message)
+
+            self.run_plugins('post_setup', service, version)
 
-        # If no plugin handles this, deploy as a regular docker image.
-        if not handled_by_plugin:
-            self.create_container(service, version, **kwargs)
+        retention = self.controller.version_retention
+        if retention and not service.held:
+            service.prune(retention)
+
+    def prune(self, deploy_id=None, keep=None):
+        """Remove old service versions, in one or all deployments, keeping
+        the ``keep`` latest ones of each service (by default, as many as
+        the configured retention).
+        """
+        keep = keep or self.controller.version_retention
+        if not keep:
+            raise DeployError(
+                'give the number of versions to keep, there is no '
+                'VERSION_RETENTION configured')
+        if deploy_id:
+            deployments = [self.db.deployments[deploy_id]]
         else:
-            if service.held:
-                ctx.log('service was held: %s' % service.hold_message)
+            deployments = self.db.deployments.values()
 
-        self.run_plugins('post_setup', service, version)
+        for deployment in deployments:
+            removed = deployment.prune(keep)
+            ctx.log('%s: removed %s versions' % (deployment.id, removed))
 
     def provide_data(self, deploy_id, service_name, files, info):
         """Some services rely on external data that cannot be included in
@@ -230,6 +534,13 @@ class ControllerInterface(object):
         service = self.db.deployments[deploy_id].services[service_name]
         self.run_plugins('on_data_provided', service, files, info)
 
+    def negotiate_data(self, deploy_id, service_name, name, info):
+        """Before data is provided, let the plugins tell the client what
+        they already have of it, so it can send less.
+        """
+        service = self.db.deployments[deploy_id].services[service_name]
+        return self.run_plugins('negotiate_data', service, name, info)
+
     def set_resource(self, deploy_id, name, data):
         """Declare the given resource to be available.
         """
@@ -237,9 +548,12 @@ class ControllerInterface(object):
         is_new = deployment.set_resource(name, data)
         self.run_plugins('on_resource_changed', deployment, name, data)
 
-    def generate_runcfg(self, service, version):
+    def generate_runcfg(self, service, version, host_ip=None, name=None):
         """Given a service version, generate a final controller-independent
         runcfg structure as used by the backends.
+
+        Host ports are allocated for the container called ``name``; give
+        them back via :meth:`release_ports` once it is gone.
         """
         deployment = service.deployment
 
@@ -248,12 +562,22 @@ class ControllerInterface(object):
         self.run_plugins(
             'rewrite_service', service, version, definition)
 
-        def get_free_port():
-            return random.randint(10000, 65000)
-
         local_repl = {}
         extra_env = {}
-        host_lan_ip = self.get_host_ip()
+        host_lan_ip = host_ip or self.get_host_ip()
+
+        # We can only see the sockets of our own host.
+        bound = ()
+        if host_lan_ip == self.get_host_ip():
+            bound = listening_ports()
+
+        def get_free_port():
+            try:
+                return self.db.ports.allocate(
+                    host_lan_ip, name or service.full_name,
+                    quarantine=self.controller.port_quarantine, bound=bound)
+            except NoFreePortError as e:
+                raise DeployError('%s' % e)
         local_repl['HOST'] = host_lan_ip
         local_repl['DEPLOY_ID'] = deployment.id
         self.run_plugins(
@@ -274,7 +598,8 @@ class ControllerInterface(object):
             'privileged': definition['privileged'],
             'volumes': {},
             'ports': {},
-            'env': {}
+            'env': {},
+            'memory': definition['kwargs'].get('memory'),
         }
 
         # Construct the 'volumes' argument.
@@ -341,43 +666,356 @@ class ControllerInterface(object):
 
         return runcfg, definition, port_assignments
 
-    def create_container(self, service, version):
-        """Create the docker container that the service(-version) defines.
+    def instance_target(self, service, definition):
+        """The number of instances ``service`` should run: as set via
+        :meth:`scale`, or else as given by the ``instances`` key of the
+        definition.
         """
+        if service.scale is not None:
+            return service.scale
+        return int(definition['kwargs'].get('instances', 1))
 
-        runcfg, definition, port_assignments = \
-            self.generate_runcfg(service, version)
+    def release_ports(self, hosts):
+        """Give back the host ports of a container, as ``(ip, port)``
+        pairs; they are reused once their quarantine is over.
+        """
+        for host in hosts:
+            if host and host[1]:
+                self.db.ports.release(host[0], host[1])
 
-        # Construct a name; for now, for informative purposes only; later
-        # this might be what we use for matching.
-        runcfg['name'] = "{deploy}-{service}-{version}-{instance}".format(
-            deploy=service.deployment.id, service=service.name,
-            version=len(service.versions)+1,
-            instance=service.latest.instance_count if service.latest else 1)
+    def create_container(self, service, version):
+        """Create the docker containers that the service(-version)
+        defines, replacing the running instances of the service.
+        """
+        definition = version.definition
+        count = self.instance_target(service, definition)
+        rollout = rollout_options(definition)
+        if definition['wan_map']:
+            # The WAN ports are fixed, a second container could not
+            # bind them.
+            if count > 1:
+                raise DeployError(
+                    'service has WAN ports, cannot run more than one instance')
+            if rollout['strategy'] == 'start-first':
+                ctx.log('service has WAN ports, cannot use start-first')
+                rollout['strategy'] = 'stop-first'
+
+        if rollout['strategy'] == 'start-first':
+            self._replace_start_first(service, version, count, rollout)
+        else:
+            self._replace_stop_first(service, version, count, rollout)
 
-        # We are almost ready, let plugins do some final modifications
-        # before we are starting the container.
-        self.run_plugins(
-            'before_start', service, definition, runcfg, port_assignments)
+    def _replace_stop_first(self, service, version, count, rollout):
+        """Replace the running instances of ``service`` by ``count``
+        instances of ``version``; ``batch`` of them at a time, by first
+        shutting down old ones, then starting the new ones.
+        """
+        old = list(service.instances)
+        started = 0
+        while started < count or old:
+            if old:
+                new = min(rollout['batch'], count - started)
+            else:
+                new = count - started
+            if started + new < count:
+                stop, old = old[:rollout['batch']], old[rollout['batch']:]
+            else:
+                stop, old = old, []
+
+            # Creating the containers allows the backend to fail before
+            # we shut anything down.
+            prepared = self._prepare_instances(service, version, new)
+            self._stop_instances(service, stop)
+            if stop and version.definition['wan_map']:
+                self._wait_for_wan_ports(version.definition)
+            instances, errors = self._start_instances(service, prepared)
+            if instances or not errors:
+                self._register_instances(service, version, instances)
+            if errors:
+                raise errors[0]
+            started += new
+
+    def _replace_start_first(self, service, version, count, rollout):
+        """Replace the running instances of ``service`` without a gap:
+        Start ``surge`` new containers on their own freshly assigned
+        ports, wait until they are ready, register them, and only then
+        unregister and stop as many of the old instances.
+        """
+        old = list(service.instances)
+        started = 0
+        while started < count or old:
+            if old:
+                new = min(rollout['surge'], count - started)
+            else:
+                new = count - started
+
+            prepared = self._prepare_instances(service, version, new)
+            instances, errors = self._start_instances(
+                service, prepared, rollout)
+            if errors:
+                ctx.log('New containers did not become ready, removing '
+                        'them; existing instances are kept')
+                self._terminate(
+                    service, [(i, r.get('host')) for r, i, _ in instances])
+                for _, _, port_assignments in instances:
+                    self.release_ports(
+                        p['host'] for p in port_assignments.values())
+                raise errors[0]
+            self._register_instances(service, version, instances)
+            started += new
+
+            if started < count:
+                stop, old = old[:new], old[new:]
+            else:
+                stop, old = old, []
+            self._stop_instances(service, stop, rollout['drain'])
+
+    def _prepare_instances(self, service, version, count):
+        """Generate the runcfgs for ``count`` new instances of ``version``,
+        and have the backend create the containers, concurrently.
+
+        Returns a list of ``(runcfg, instance_id, port_assignments)``.
+        """
+        memory = version.definition['kwargs'].get('memory')
+        pending, placed = [], []
+        try:
+            for i in range(count):
+                # Construct a name; for now, for informative purposes only;
+                # later this might be what we use for matching.
+                version.instance_count += 1
+                name = "{deploy}-{service}-{version}-{instance}".format(
+                    deploy=service.deployment.id, service=service.name,
+                    version=version.number or service.next_version_number,
+                    instance=version.instance_count)
+
+                # With multiple hosts, the ports need to be bound on the
+                # one chosen for the container.
+                host = None
+                if isinstance(self.backend, MultiHostBackend):
+                    host = self._place(service, version, memory, name)
+                    placed.append((name, host.name))
+                    self.placed.append((name, host.name))
+                    ctx.log('Placing %s on host %s' % (name, host.name))
+
+                runcfg, definition, port_assignments = self.generate_runcfg(
+                    service, version, host_ip=host.ip if host else None,
+                    name=name)
+                runcfg['name'] = name
+                if host:
+                    runcfg['host'] = host.name
+
+                # We are almost ready, let plugins do some final
+                # modifications before we are starting the container.
+                self.run_plugins(
+                    'before_start', service, definition, runcfg,
+                    port_assignments)
+                pending.append((runcfg, port_assignments))
+        except:
+            self._unplace(placed)
+            raise
+
+        def prepare((runcfg, port_assignments)):
+            with span('create', service=service.name):
+                return self.backend.prepare(runcfg, service)
+
+        greenlets = self._concurrently(prepare, pending)
+        for greenlet in greenlets:
+            if not greenlet.successful():
+                for runcfg, port_assignments in pending:
+                    self.release_ports(
+                        p['host'] for p in port_assignments.values())
+                self._unplace(placed)
+                raise greenlet.exception
+        return [(runcfg, greenlet.value, port_assignments)
+                for (runcfg, port_assignments), greenlet
+                in zip(pending, greenlets)]
+
+    def _place(self, service, version, memory, name):
+        """Choose the docker host for a new instance. The volumes of a
+        service are local to the host, so once it has any, it stays there.
+        """
+        pinned = None
+        if version.definition.get('volumes'):
+            pinned = service.volume_host or next(
+                (i.host for i in service.instances if i.host), None)
+        try:
+            host = self.backend.place(memory, name=name, host=pinned)
+        except NoCapacityError as e:
+            raise DeployError('%s' % e)
+        if version.definition.get('volumes'):
+            service.volume_host = host.name
+        return host
+
+    def _unplace(self, placed):
+        """Give up the reservations for ``(name, host)`` pairs of
+        containers that were placed, but did not start.
+        """
+        for name, host in placed:
+            self.backend.unplace(name, host)
 
-        # Create the new container
-        instance_id = self.backend.prepare(runcfg, service)
+    def _start_instances(self, service, prepared, rollout=None):
+        """Start the prepared containers concurrently; if ``rollout`` is
+        given, also wait until they are ready.
 
-        # For now, all services may only run once. If there is already
-        # a container for this service, make sure it is shut down.
-        for inst in service.instances:
-            ctx.log("Killing existing container %s" % inst.container_id[1])
-            self.backend.terminate(inst.container_id)
+        Returns the ones started, in the same format as ``prepared``, and
+        the errors that occurred.
+        """
+        def start((runcfg, instance_id, port_assignments)):
+            with span('start', service=service.name):
+                return self.backend.start(runcfg, service, instance_id)
+
+        instances, errors = [], []
+        greenlets = self._concurrently(start, prepared)
+        for (runcfg, _, port_assignments), greenlet in zip(prepared, greenlets):
+            if greenlet.successful():
+                instances.append((runcfg, greenlet.value, port_assignments))
+            else:
+                errors.append(greenlet.exception)
+                self.release_ports(
+                    p['host'] for p in port_assignments.values())
+                if runcfg.get('host'):
+                    self._unplace([(runcfg['name'], runcfg['host'])])
+
+        if rollout and instances and not errors:
+            def wait((runcfg, instance_id, port_assignments)):
+                with span('wait', service=service.name):
+                    self.wait_until_ready(port_assignments, rollout)
+            errors = [g.exception for g in self._concurrently(wait, instances)
+                      if not g.successful()]
+        return instances, errors
+
+    def _register_instances(self, service, version, instances):
+        """Record the started instances, and tell the plugins."""
+        if service.latest is not version:
+            service.append_version(version)
+        for runcfg, instance_id, port_assignments in instances:
+            instance = service.append_instance(
+                runcfg['name'], instance_id, port_assignments,
+                host=runcfg.get('host'))
+            self.started.append(
+                (service, instance, (instance_id, runcfg.get('host'))))
+            self.controller.monitor.track(service, instance)
+            self.run_plugins(
+                'post_start', service, instance, port_assignments)
+            ctx.log("New instance id is %s" % (instance_id,))
+
+    def _stop_instances(self, service, instances, drain=0):
+        """Unregister the given instances first, then give clients a
+        chance to finish their requests before we stop them.
+        """
+        for inst in instances:
             service.instances.remove(inst)
-
+            self.controller.monitor.untrack(inst)
             self.run_plugins('post_stop', service, inst)
+        if instances and drain:
+            ctx.log('Draining old instances for %ss' % drain)
+            gevent.sleep(drain)
+        self._terminate(
+            service, [(inst.container_id, inst.host) for inst in instances])
+        for inst in instances:
+            self.release_ports((inst.ports or {}).values())
+
+    def _terminate(self, service, containers):
+        """Stop the given ``(container id, host)`` pairs concurrently."""
+        def terminate((container_id, host)):
+            ctx.log("Stopping container %s" % container_id[1])
+            with span('stop', service=service.name):
+                self.backend.terminate(container_id, host=host)
+
+        for greenlet in self._concurrently(terminate, containers):
+            if not greenlet.successful():
+                raise greenlet.exception
+
+    def _wait_for_wan_ports(self, definition):
+        """The WAN ports of the old container are bound again right away;
+        make sure it has let go of them.
+        """
+        ports = [int(port) for _, port in definition['wan_map'] if port]
+        if not wait_until_free(ports):
+            ctx.log('WAN ports are still bound: %s' % ports)
 
-        # Run the container
-        instance_id = self.backend.start(runcfg, service, instance_id)
-        service.append_version(version)
-        instance = service.append_instance(runcfg['name'], instance_id)
-        self.run_plugins('post_start', service, instance, port_assignments)
-        ctx.log("New instance id is %s" % instance_id)
+    def _concurrently(self, func, items):
+        """Call ``func`` for each of ``items``, each in its own greenlet,
+        and return the greenlets once all are done.
+
+        Only use this for work that does not touch the database; events
+        are passed to the current context.
+        """
+        parent = ctx._get_current_object()
+
+        def run(item):
+            set_context(ForwardingContext(self, parent))
+            try:
+                return func(item)
+            finally:
+                set_context(None)
+
+        greenlets = [metrics.count('concurrent', gevent.spawn(run, item))
+                     for item in items]
+        gevent.joinall(greenlets)
+        return greenlets
+
+    def scale(self, deploy_id, name, count):
+        """Run ``count`` instances of the latest version of the service.
+
+        The number is remembered, and used instead of the ``instances``
+        key of the definition when the service is set up again.
+        """
+        if count < 0:
+            raise DeployError('Cannot run %s instances' % count)
+        service = self.db.deployments[deploy_id].services[name]
+        service.scale = count
+
+        version = service.latest
+        if service.held or version is None:
+            ctx.log('service is held, will run %s instances once set up' %
+                    count)
+            return
+        if count > 1 and version.definition['wan_map']:
+            raise DeployError(
+                'service has WAN ports, cannot run more than one instance')
+
+        running = list(service.instances)
+        if count > len(running):
+            prepared = self._prepare_instances(
+                service, version, count - len(running))
+            instances, errors = self._start_instances(service, prepared)
+            self._register_instances(service, version, instances)
+            if errors:
+                raise errors[0]
+        elif count < len(running):
+            # Instances of older versions go first
+            running.sort(key=lambda i: i.version is version)
+            self._stop_instances(
+                service, running[:len(running) - count],
+                rollout_options(version.definition)['drain'])
+        ctx.log('%s is running %s instances' % (
+            service.full_name, len(service.instances)))
+
+    def wait_until_ready(self, port_assignments, rollout):
+        """Wait until all host-mapped ports of a freshly started instance
+        accept connections (or answer HTTP requests, depending on the
+        ``check`` option), or raise a :class:`DeployError`.
+        """
+        if rollout['check'] == 'none':
+            return
+
+        pending = [m['host'] for m in port_assignments.values()
+                   if m['host'] and m['host'][1]]
+        ctx.log('Waiting for %s port(s) to become ready' % len(pending))
+        deadline = time.time() + rollout['timeout']
+        while pending:
+            pending = [
+                (host, port) for host, port in pending
+                if not check_ready(host, port, rollout['check'],
+                                   rollout['path'])]
+            if not pending:
+                break
+            if time.time() > deadline:
+                raise DeployError('Not ready after %ss: %s' % (
+                    rollout['timeout'],
+                    ', '.join('%s:%s' % p for p in pending)))
+            gevent.sleep(0.5)
 
     #####
 
@@ -402,23 +1040,68 @@ class Controller(object):
 
         self._zodb_storage = ZODB.FileStorage.FileStorage(db_dir)
         self._zodb_obj = ZODB.DB(self._zodb_storage)
+        self.packer = PackScheduler.from_environ(self._zodb_obj, db_dir)
 
         if plugins is None:
             self.plugins = load_plugins(Plugin)
         else:
             self.plugins = [p() for p in plugins]
 
-        self.backend = UpstartBackend(docker_url)
+        # hook name -> list of (plugin name, method), see run_plugins()
+        self._hooks = {}
+        self._hooks_for = None
+        # (hook name, plugin name) -> [calls, seconds spent, including
+        # the hooks run from within]
+        self.hook_stats = {}
+        # Hooks that return quicker are left out of the traces; most
+        # plugins have nothing to do for most calls.
+        self.hook_span_min = float(os.environ.get('HOOK_SPAN_MIN', 0.005))
+
+        # Plugins may have data of their own to migrate.
+        self.init_db()
+
+        if os.environ.get('DOCKER_HOSTS'):
+            self.backend = MultiHostBackend.from_environ()
+        else:
+            self.backend = create_backend(
+                os.environ.get('SUPERVISOR', 'upstart'), docker_url)
+        self._discovery = None
+
+        # How many versions of each service to keep; 0, the default,
+        # keeps all.
+        self.version_retention = int(os.environ.get('VERSION_RETENTION', 0))
+        # Seconds before the ports of a stopped container are reused
+        self.port_quarantine = int(os.environ.get('PORT_QUARANTINE', 60))
+        # Seconds between removing the ports out of quarantine
+        self.port_prune_interval = int(
+            os.environ.get('PORT_PRUNE_INTERVAL', 600))
+
+        # Whether the instances are up, as far as docker tells us
+        self.monitor = InstanceMonitor.from_environ(self)
+
+        # Cache directories for builds
+        self.build_cache = BuildCache.from_environ(
+            path.join(self.volume_base, '_cache', 'builds'),
+            legacy=[path.join(self.volume_base, '_cache', 'slugbuilder')])
 
     def close(self):
         self._zodb_obj.close()
         self._zodb_storage.close()
 
+    def init_db(self):
+        """Create or migrate the database; done once, on startup.
+        """
+        connection = self._zodb_obj.open()
+        try:
+            if not getattr(connection.root, 'deploy', None):
+                connection.root.deploy = DeployDBNew()
+            self.migrate(connection.root)
+            transaction.commit()
+        finally:
+            connection.close()
+
     def get_connection(self):
         self._zodb_connection = self._zodb_obj.open()
-        if not getattr(self._zodb_connection.root, 'deploy', None):
-            self._zodb_connection.root.deploy = DeployDBNew()
-        self.migrate(self._zodb_connection.root)
         return self._zodb_connection, self._zodb_connection.root.deploy
 
     CURRENT_DB_VERSION = 2
@@ -438,21 +1121,67 @@ class Controller(object):
             transaction.commit()
             print "Upgraded Schema"
 
-    def interface(self):
+        if root.deploy.ports is None:
+            # Before ports were allocated; record the ones in use.
+            root.deploy.ports = PortAllocator()
+            for deployment in root.deploy.deployments.values():
+                for service in deployment.services.values():
+                    for instance in service.instances:
+                        for host in (instance.ports or {}).values():
+                            if host and host[1]:
+                                root.deploy.ports.reserve(
+                                    host[0], host[1], instance.id)
+            transaction.commit()
+
+        if root.deploy.slug_index is None:
+            root.deploy.slug_index = SlugIndex()
+            transaction.commit()
+
+        self.run_plugins('migrate_db', root.deploy)
+        transaction.commit()
+
+    def interface(self, read_only=False):
         """
         ZODB absolutely does not like you creating multiple connections
         in the same thread:
 
         StorageTransactionError: Duplicate tpc_begin calls for same transaction
+
+        A ``read_only`` interface is never committed when used as a
+        context manager.
+        """
+        return ControllerInterface(self, read_only=read_only)
+
+    def get_hook(self, method_name):
+        """Return the plugin methods implementing a hook, in the order
+        they are to be called: by descending ``priority``, and in the
+        order of ``plugins`` for the same priority.
         """
-        return ControllerInterface(self)
+        # Rebuild if plugins have been added or removed.
+        if self._hooks_for != len(self.plugins):
+            self._hooks = {}
+            self._hooks_for = len(self.plugins)
+
+        if not method_name in self._hooks:
+            plugins = sorted(
+                self.plugins, key=lambda p: -getattr(p, 'priority', 100))
+            self._hooks[method_name] = [
+                (type(p).__name__, getattr(p, method_name))
+                for p in plugins if getattr(p, method_name, None)]
+        return self._hooks[method_name]
 
     def run_plugins(self, method_name, *args, **kwargs):
-        for plugin in self.plugins:
-            method = getattr(plugin, method_name, None)
-            if not method:
-                continue
-            result = method(*args, **kwargs)
+        for plugin_name, method in self.get_hook(method_name):
+            started = time.time()
+            try:
+                with span('%s.%s' % (plugin_name, method_name), kind='hook',
+                          min_duration=self.hook_span_min):
+                    result = method(*args, **kwargs)
+            finally:
+                stats = self.hook_stats.setdefault(
+                    (method_name, plugin_name), [0, 0.0])
+                stats[0] += 1
+                stats[1] += time.time() - started
             if result:
                 return result
         else:
@@ -477,51 +1206,65 @@ class Controller(object):
         except ValueError:
             raise RuntimeError('Cannot determine host ip, set HOST_IP environment variable')
 
+    @property
+    def discovery(self):
+        if self._discovery is None:
+            self._discovery = ConsulDiscovery(self.get_host_ip())
+        return self._discovery
+
     def discover(self, servicename, durable=False):
-        # # sdutil does not support specifying a discoverd host yet, which is
-        # # fine with us for now since all is running on the same host.
-        # try:
-        #     return run('DISCOVERD={}:1111 sdutil services -1 {}'.format(
-        #         self.get_host_ip(), servicename), shell=True).strip()
-        # except CalledProcessError as e:
-        #     raise ServiceDiscoveryError(e)
-
-        import consul
-        consul = consul.Consul(self.get_host_ip())
-        service = consul.catalog.service(servicename)[1][0]
+        with span('discover', service=servicename):
+            nodes = self.discovery.lookup(servicename)
+        if not nodes:
+            raise ServiceDiscoveryError(
+                'Service not found: %s' % servicename)
+
+        service = nodes[0]
         if durable:
             host = '%s.service.consul' % servicename
         else:
             host = service['ServiceAddress'] or service['Address']
         return '%s:%s' % (host, service['ServicePort'])
 
-    def register(self, servicename, port):
-        """This is used by the controller to register itself.
+    def prune_ports(self):
+        """Forget the released ports whose quarantine is over, in a
+        transaction of its own.
         """
-        # def regger():
-        #     try:
-        #         cip = os.environ.get('CONTROLLER_IP')
-        #         if cip:
-        #             opts = '-h %s' % cip
-        #         else:
-        #             opts = ''
-        #         run('DISCOVERD={0}:1111 sdutil register {opts}  {2}:{1}'.format(
-        #             self.get_host_ip(), address, servicename, opts=opts), shell=True)
-        #     except CalledProcessError as e:
-        #         raise ServiceDiscoveryError(e)
-        # return gevent.spawn(regger)
-
-        #cip = os.environ.get('CONTROLLER_IP')
+        with self.interface() as cintf:
+            return cintf.db.ports.prune(self.port_quarantine)
 
-        import consul
-        consul = consul.Consul(self.get_host_ip())
-        consul.agent.service.register(servicename, port=port)
+    def _prune_ports_periodically(self):
+        while True:
+            gevent.sleep(self.port_prune_interval)
+            try:
+                self.prune_ports()
+            except Exception as e:
+                print "Pruning released ports failed: %s" % e
 
+    def register(self, servicename, port):
+        """This is used by the controller to register itself.
+        """
+        self.discovery.client.agent.service.register(servicename, port=port)
+        self.discovery.invalidate(servicename)
 
     def run(self, host, port):
         # Register ourselves with service discovery
         greenlet = self.register('docker-deploy', int(port))
 
+        # Keep our caches in line with what happens in docker, and
+        # restart instances that die.
+        self.monitor.start()
+        if hasattr(self.backend, 'watch_events'):
+            self.backend.watch_events()
+
+        # Keep the database file from growing forever
+        self.packer.start()
+        if self.port_prune_interval:
+            gevent.spawn(self._prune_ports_periodically)
+
+        # Let plugins start their background work
+        self.run_plugins('on_start', self)
+
         try:
             # Start API
             print('Serving API from :%s' % port)
@@ -1,7 +1,10 @@
 from copy import deepcopy
+import hashlib
+import json
 import BTrees.OOBTree
 from persistent import Persistent
 from persistent.list import PersistentList
+from deploylib.daemon.ports import PortAllocator
 
 
 
@@ -16,20 +19,107 @@ class DeployDB(object):
 class DeployDBNew(Persistent):
     """Our root."""
 
+    # The PortAllocator; created by a migration for older databases.
+    ports = None
+    # The SlugIndex of the app plugin; likewise.
+    slug_index = None
+
     def __init__(self):
         self.deployments = BTrees.OOBTree.BTree()
         self.auth_key = None
+        self.ports = PortAllocator()
+        self.slug_index = SlugIndex()
+
+
+class SlugIndex(Persistent):
+    """Maps (tree hash, build fingerprint) to the id of a slug on shelf,
+    for the app plugin.
+    """
+
+    def __init__(self):
+        self.slugs = BTrees.OOBTree.BTree()
+
+    def get(self, tree, fingerprint):
+        return self.slugs.get((tree, fingerprint))
+
+    def add(self, tree, fingerprint, slug):
+        self.slugs[(tree, fingerprint)] = slug
+
+    def discard(self, tree, fingerprint):
+        self.slugs.pop((tree, fingerprint), None)
+
+
+
+def _canonical(value):
+    # Dicts become sorted lists of [key, value] pairs, so keys need not be
+    # strings (service definitions have tuples as keys in ``wan_map``),
+    # and 1 and '1' stay apart. Containers are tagged with their type, so
+    # a tuple and a list, or a dict and a list of pairs, differ.
+    if isinstance(value, dict):
+        return ['d', sorted([_canonical(k), _canonical(v)]
+                            for k, v in value.items())]
+    if isinstance(value, tuple):
+        return ['t', [_canonical(v) for v in value]]
+    if isinstance(value, list):
+        return ['l', [_canonical(v) for v in value]]
+    return value
 
 
+def content_key(value):
+    """Return a digest of a JSON-like value that does not depend on the
+    order of dict keys.
+    """
+    return hashlib.sha1(json.dumps(
+        _canonical(value), default=repr)).hexdigest()
+
+
+class SharedData(Persistent):
+    """An immutable value that is stored once per deployment, and then
+    referenced by every service version that uses it; see
+    :meth:`Deployment.intern`.
+
+    Being a separate persistent object, it is only loaded when accessed.
+    """
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+
+class Trace(Persistent):
+    """The timing spans recorded during one operation on a deployment."""
+
+    def __init__(self, started, spans):
+        self.started = started
+        self.spans = list(spans)
+
+    def as_dict(self):
+        return {'started': self.started, 'spans': self.spans}
+
 
 class Deployment(Persistent):
     """A group of containers/services that make up one project."""
 
+    # Content-addressed values shared between service versions;
+    # created on first use for deployments from before this existed.
+    shared = None
+
+    # The timing spans of the most recent operations by start time, see
+    # add_trace(); created on first use.
+    traces = None
+    keep_traces = 10
+
+    # Held services by the names of the requirements they wait for, see
+    # the RequiresPlugin; created by a migration for older deployments.
+    requires = None
+
     def __init__(self, id):
         self.id = id
         self.services = BTrees.OOBTree.BTree()
         self.data = BTrees.OOBTree.BTree()
         self.resources = BTrees.OOBTree.BTree()
+        self.shared = BTrees.OOBTree.BTree()
+        self.requires = BTrees.OOBTree.BTree()
 
         # The globals for this deployment. The thing is, when the
         # globals change we ostensibly should release new versions
@@ -71,10 +161,77 @@ class Deployment(Persistent):
         """
         return self.resources.get(name, None)
 
+    def add_trace(self, started, spans):
+        """Store the spans recorded while working on this deployment;
+        only the most recent ones are kept.
+
+        Each trace is an object of its own, so adding one does not
+        rewrite the others.
+        """
+        if not isinstance(self.traces, BTrees.OOBTree.BTree):
+            # Older versions kept a list.
+            self.traces = BTrees.OOBTree.BTree()
+        while started in self.traces:
+            started += 0.000001
+        self.traces[started] = Trace(started, spans)
+        for key in list(self.traces.keys())[:-self.keep_traces]:
+            del self.traces[key]
+
+    def recent_traces(self):
+        """The stored traces as dicts, oldest first."""
+        if not isinstance(self.traces, BTrees.OOBTree.BTree):
+            return []
+        return [trace.as_dict() for trace in self.traces.values()]
+
+    def intern(self, value):
+        """Return a :class:`SharedData` object for the value, reusing
+        an existing one if an identical value has been stored before.
+
+        Values must not be modified once interned.
+        """
+        if self.shared is None:
+            self.shared = BTrees.OOBTree.BTree()
+        key = content_key(value)
+        if not key in self.shared:
+            self.shared[key] = SharedData(key, value)
+        return self.shared[key]
+
+    def prune(self, keep):
+        """Prune the versions of all services, see
+        :meth:`DeployedService.prune`. Shared values no longer used by
+        any version are removed as well.
+
+        Returns the number of versions removed.
+        """
+        removed = 0
+        used = set()
+        for service in self.services.values():
+            removed += service.prune(keep)
+            versions = list(service.versions)
+            if service.held:
+                versions.append(service.held_version)
+            for instance in service.instances:
+                versions.append(instance.version)
+            for version in versions:
+                used.update(version.shared_keys())
+
+        if self.shared is not None:
+            for key in list(self.shared.keys()):
+                if not key in used:
+                    del self.shared[key]
+        return removed
+
 
 class DeployedService(Persistent):
     """One service that is defined as part of a deployment."""
 
+    # The number of instances to run, if set explicitly via the API.
+    scale = None
+
+    # The docker host the volumes of the service are on, if the backend
+    # manages more than one.
+    volume_host = None
+
     def __init__(self, deployment, name):
         self.name = name
         self.deployment = deployment
@@ -83,6 +240,7 @@ class DeployedService(Persistent):
 
         self.held = False
         self.hold_message = None
+        self.version_count = 0
 
     @property
     def full_name(self):
@@ -140,41 +298,123 @@ class DeployedService(Persistent):
             definition = self.latest.definition
         data = deepcopy(self.latest.data) if self.latest else {}
 
-        return ServiceVersion(definition, self.deployment.globals, data=data)
+        return ServiceVersion(
+            self.deployment.intern(definition),
+            self.deployment.intern(self.deployment.globals), data=data)
+
+    @property
+    def next_version_number(self):
+        """The number the next version appended will get. Unlike the
+        length of ``versions``, this does not go down when old versions
+        are pruned.
+        """
+        # Services from before versions were numbered
+        count = getattr(self, 'version_count', None) or len(self.versions)
+        return count + 1
 
     def append_version(self, version):
         if self.held:
             self._remove_hold()
 
         version.service = self
+        version.number = self.version_count = self.next_version_number
         self.versions.append(version)
         return version
 
-    def append_instance(self, id, backend_id):
-        instance = ServiceInstance(id, backend_id, self.latest)
+    def prune(self, keep):
+        """Remove all but the ``keep`` latest versions. Versions that
+        instances are still running with are kept as well.
+
+        Returns the number of versions removed.
+        """
+        keep = max(keep, 1)
+        if len(self.versions) <= keep:
+            return 0
+        self.version_count = self.next_version_number - 1
+
+        in_use = set(id(i.version) for i in self.instances)
+        old, recent = self.versions[:-keep], self.versions[-keep:]
+        retained = [v for v in old if id(v) in in_use]
+        if len(retained) == len(old):
+            return 0
+
+        self.versions = PersistentList(retained + recent)
+        return len(old) - len(retained)
+
+    def append_instance(self, id, backend_id, port_assignments=None,
+                        host=None):
+        ports = {name: tuple(p['host']) if p['host'] else None
+                 for name, p in (port_assignments or {}).items()}
+        instance = ServiceInstance(id, backend_id, self.latest, ports, host)
         self.instances.append(instance)
-        self.latest.instance_count += 1
         return instance
 
 
 class ServiceVersion(Persistent):
     """A new version is created whenever the service changes.
+
+    The definition and the globals are usually identical between many
+    versions; they may be given as :class:`SharedData`, in which case
+    only a reference is stored.
     """
 
+    # The number of this version within the service; versions from
+    # before those were numbered do not know.
+    number = None
+
+    _definition = None
+    _globals = None
+
     def __init__(self, definition, globals, data=None):
         self.definition = definition
         self.globals = globals
         self.data = BTrees.OOBTree.BTree(data or {})
+        # Number of instances created of this version, to name them
         self.instance_count = 0
 
+    def _get_value(self, attr):
+        value = getattr(self, '_' + attr)
+        if value is None:
+            # Stored inline by older versions of the code.
+            return self.__dict__.get(attr)
+        if isinstance(value, SharedData):
+            return value.value
+        return value
+
+    def _set_value(self, attr, value):
+        self.__dict__.pop(attr, None)
+        setattr(self, '_' + attr, value)
+
+    definition = property(
+        lambda self: self._get_value('definition'),
+        lambda self, value: self._set_value('definition', value))
+    globals = property(
+        lambda self: self._get_value('globals'),
+        lambda self, value: self._set_value('globals', value))
+
+    def shared_keys(self):
+        """Return the keys of the :class:`SharedData` used."""
+        return [v.key for v in (self._definition, self._globals)
+                if isinstance(v, SharedData)]
+
 
 class ServiceInstance(Persistent):
     """An running instance of a container."""
 
-    def __init__(self, id, backend_id, version):
+    # The host (ip, port) each named port is mapped to. Instances created
+    # before this was recorded do not know.
+    ports = None
+
+    # The name of the docker host the instance runs on, if the backend
+    # manages more than one.
+    host = None
+
+    def __init__(self, id, backend_id, version, ports=None, host=None):
         self._id = id
         self.container_id = backend_id
         self.version = version
+        self.ports = ports
+        self.host = host
 
     @property
     def id(self):
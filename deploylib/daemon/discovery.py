@@ -0,0 +1,93 @@
+"""Service discovery lookups, currently against consul.
+
+Lookups happen a lot: Plugins ask for the address of shelf, the router
+API and others many times during a single deploy, and some poll until a
+service shows up. Rather than creating a new client and asking the agent
+every time, :class:`ConsulDiscovery` uses a single client (python-consul
+keeps a ``requests`` session, so connections are reused), and caches
+results.
+
+A cached result is used for ``ttl`` seconds. In addition, for every name
+that is looked up, a greenlet keeps a blocking query open against the
+catalog, so the cached result is replaced as soon as consul knows of a
+change; as long as that watch is active, the cache does not expire. The
+watch ends once the name has not been asked for in ``watch_for`` seconds.
+
+Empty results are never cached, so polling for a service that is not yet
+registered works as expected.
+"""
+
+import time
+import gevent
+
+
+class ConsulDiscovery(object):
+
+    ttl = 5
+    watch_for = 60
+    wait = '30s'
+
+    def __init__(self, host):
+        self.host = host
+        self._client = None
+        # name -> (index, nodes, time of query)
+        self._cache = {}
+        self._watchers = {}
+        self._last_used = {}
+
+    @property
+    def client(self):
+        if self._client is None:
+            import consul
+            self._client = consul.Consul(self.host)
+        return self._client
+
+    def lookup(self, name):
+        """Return the list of catalog entries for the service ``name``.
+        """
+        self._last_used[name] = time.time()
+
+        entry = self._cache.get(name)
+        if entry:
+            index, nodes, fetched = entry
+            if name in self._watchers or time.time() - fetched < self.ttl:
+                return nodes
+
+        index, nodes = self.client.catalog.service(name)
+        if nodes:
+            self._cache[name] = (index, nodes, time.time())
+            if not name in self._watchers:
+                self._watchers[name] = gevent.spawn(self._watch, name, index)
+        else:
+            self._cache.pop(name, None)
+        return nodes
+
+    def invalidate(self, name):
+        """Forget what we know about ``name``; for example, because we
+        just changed its registration ourselves.
+        """
+        self._cache.pop(name, None)
+        watcher = self._watchers.pop(name, None)
+        if watcher:
+            watcher.kill(block=False)
+
+    def _watch(self, name, index):
+        try:
+            while time.time() - self._last_used.get(name, 0) < self.watch_for:
+                new_index, nodes = self.client.catalog.service(
+                    name, index=index, wait=self.wait)
+                if not nodes:
+                    self._cache.pop(name, None)
+                    break
+                self._cache[name] = (new_index, nodes, time.time())
+                if new_index == index:
+                    # Don't hammer the agent if it does not block
+                    gevent.sleep(1)
+                index = new_index
+        except Exception as e:
+            # Without the watch, we cannot trust the cached result.
+            print "Watching %s in consul failed: %s" % (name, e)
+            self._cache.pop(name, None)
+        finally:
+            if self._watchers.get(name) is gevent.getcurrent():
+                del self._watchers[name]
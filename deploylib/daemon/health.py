@@ -0,0 +1,243 @@
+"""Keeps track of whether the instances in the database are running.
+
+:class:`InstanceMonitor` listens to the docker event stream the backend
+follows. When the container of an instance dies, plugins are told via
+the ``on_instance_down`` hook right away (so they can, for example,
+remove it from service discovery), and the container is restarted;
+if it keeps dying, with an increasing delay. Once it is up again,
+``on_instance_up`` is called.
+
+Containers that a supervisor (upstart, systemd) keeps running are left
+to it to restart; see ``Backend.supervised``.
+
+The state is kept in memory only. The instances are added and removed
+as the controller starts and stops them; in case we miss something
+(a transaction that was aborted, events while the stream was
+disconnected), the index is synced with the database and the actual
+state of the containers every ``MONITOR_SYNC_INTERVAL`` seconds
+(default: 5 minutes).
+"""
+
+import os
+import time
+import gevent
+from ZODB.POSException import ConflictError
+from deploylib.daemon.context import set_context, BackgroundContext
+from deploylib.daemon import metrics
+
+
+UP, DOWN, UNKNOWN = 'up', 'down', 'unknown'
+
+
+def docker_id(container_id):
+    """The docker id of an instance's ``container_id``, which is a
+    tuple of (docker id, name) for the docker backends.
+    """
+    if isinstance(container_id, (tuple, list)):
+        return container_id[0]
+    return container_id
+
+
+class InstanceState(object):
+
+    def __init__(self, deploy_id, service, instance_id, container_id,
+                 host=None, status=UNKNOWN):
+        self.deploy_id = deploy_id
+        self.service = service
+        self.instance_id = instance_id
+        self.container_id = container_id
+        self.host = host
+        self.status = status
+        self.since = time.time()
+        self.restarts = 0
+
+    def as_dict(self):
+        return {
+            'instance': self.instance_id,
+            'host': self.host,
+            'status': self.status,
+            'since': self.since,
+            'restarts': self.restarts,
+        }
+
+
+class InstanceMonitor(object):
+
+    # Seconds an instance needs to stay up for its restarts to no
+    # longer count towards the delay of the next one.
+    stable = 30
+    # The delay before the second restart in a row; doubled for every
+    # further one, up to ``max_backoff``. The first happens right away.
+    backoff = 1
+    max_backoff = 60
+
+    def __init__(self, controller, sync_interval=300):
+        self.controller = controller
+        self.sync_interval = sync_interval
+        # docker id -> InstanceState
+        self.index = {}
+
+    @classmethod
+    def from_environ(cls, controller, environ=os.environ):
+        return cls(controller, sync_interval=int(
+            environ.get('MONITOR_SYNC_INTERVAL', 300)))
+
+    @property
+    def backend(self):
+        return self.controller.backend
+
+    def track(self, service, instance, status=UP):
+        """Add an instance the controller has just started."""
+        id = docker_id(instance.container_id)
+        if not id in self.index:
+            self.index[id] = InstanceState(
+                service.deployment.id, service.name, instance.id,
+                instance.container_id, instance.host, status)
+        return self.index[id]
+
+    def untrack(self, instance):
+        """Remove an instance before the controller stops it, so it is
+        not restarted.
+        """
+        self.index.pop(docker_id(instance.container_id), None)
+
+    def is_down(self, instance):
+        state = self.index.get(docker_id(instance.container_id))
+        return state is not None and state.status == DOWN
+
+    def status(self, deploy_id=None):
+        """Return ``{deploy_id: {service: [state, ...]}}``."""
+        result = {}
+        for state in self.index.values():
+            if deploy_id and state.deploy_id != deploy_id:
+                continue
+            result.setdefault(state.deploy_id, {}).setdefault(
+                state.service, []).append(state.as_dict())
+        for services in result.values():
+            for states in services.values():
+                states.sort(key=lambda s: s['instance'])
+        return result
+
+    def counts(self):
+        """Number of instances per status, for the metrics."""
+        counts = {(UP,): 0, (DOWN,): 0, (UNKNOWN,): 0}
+        for state in self.index.values():
+            counts[(state.status,)] += 1
+        return counts
+
+    def sync(self, db):
+        """Bring the index in line with the instances in ``db``, asking
+        the backend for the state of each container.
+        """
+        seen = set()
+        for deployment in db.deployments.values():
+            for service in deployment.services.values():
+                for instance in service.instances:
+                    state = self.track(service, instance, status=UNKNOWN)
+                    seen.add(docker_id(instance.container_id))
+                    self._set_status(state, self._query(state))
+        for id in set(self.index) - seen:
+            del self.index[id]
+
+    def _query(self, state):
+        status = getattr(self.backend, 'status', None)
+        if not status:
+            return UNKNOWN
+        try:
+            return UP if status(state.container_id, host=state.host) \
+                else DOWN
+        except Exception as e:
+            print "Cannot get the state of %s: %s" % (state.instance_id, e)
+            return UNKNOWN
+
+    def handle_event(self, event, host=None):
+        """Process an event from the docker event stream."""
+        state = self.index.get(event.get('id'))
+        if state is None:
+            return
+        if event.get('status') in ('start', 'restart', 'unpause'):
+            self._set_status(state, UP)
+        elif event.get('status') in ('die', 'destroy'):
+            self._set_status(state, DOWN)
+
+    def _set_status(self, state, status):
+        previous, state.status = state.status, status
+        if status == previous or status == UNKNOWN:
+            return
+        now = time.time()
+        if status == DOWN:
+            if previous == UP and now - state.since > self.stable:
+                state.restarts = 0
+            print "Instance %s is down" % state.instance_id
+            metrics.count('instance_hook', gevent.spawn(
+                self._run_hook, 'on_instance_down', state))
+            if not getattr(self.backend, 'supervised', False):
+                self._schedule_restart(state)
+        elif previous == DOWN:
+            print "Instance %s is up again" % state.instance_id
+            metrics.count('instance_hook', gevent.spawn(
+                self._run_hook, 'on_instance_up', state))
+        state.since = now
+
+    def _schedule_restart(self, state):
+        if not state.restarts:
+            delay = 0
+        else:
+            delay = min(self.backoff * 2 ** (state.restarts - 1),
+                        self.max_backoff)
+        metrics.count('restart', gevent.spawn_later(
+            delay, self._restart, state))
+
+    def _restart(self, state):
+        # The instance might have been stopped, or come back on its own.
+        if self.index.get(docker_id(state.container_id)) is not state or \
+                state.status != DOWN:
+            return
+        state.restarts += 1
+        print "Restarting instance %s" % state.instance_id
+        try:
+            self.backend.restart(state.container_id, host=state.host)
+        except Exception as e:
+            print "Restarting %s failed: %s" % (state.instance_id, e)
+            self._schedule_restart(state)
+
+    def _run_hook(self, name, state, attempts=5):
+        """Call the plugins with the database objects of the instance;
+        again if the transaction conflicts with another one.
+        """
+        for attempt in range(attempts):
+            cintf = self.controller.interface()
+            set_context(BackgroundContext(cintf))
+            try:
+                with cintf:
+                    deployment = cintf.db.deployments.get(state.deploy_id)
+                    service = deployment.services.get(state.service) \
+                        if deployment else None
+                    for instance in (service.instances if service else ()):
+                        if instance.id == state.instance_id:
+                            cintf.run_plugins(name, service, instance)
+                return
+            except ConflictError:
+                gevent.sleep(self.backoff * attempt)
+            except Exception as e:
+                print "%s failed for %s: %s" % (name, state.instance_id, e)
+                return
+            finally:
+                set_context(None)
+        print "%s for %s kept conflicting, giving up" % (
+            name, state.instance_id)
+
+    def run(self):
+        while True:
+            try:
+                with self.controller.interface(read_only=True) as cintf:
+                    self.sync(cintf.db)
+            except Exception as e:
+                print "Syncing the instance states failed: %s" % e
+            gevent.sleep(self.sync_interval)
+
+    def start(self):
+        add_listener = getattr(self.backend, 'add_listener', None)
+        if add_listener:
+            add_listener(self.handle_event)
+        return gevent.spawn(self.run)
@@ -0,0 +1,273 @@
+"""Metrics about the controller, in the Prometheus text format.
+
+There is a single registry; metrics are defined at module level here, and
+updated from wherever the thing measured happens. Values that are cheap
+to read on demand (like the size of the database) are gauges with a
+callback, evaluated when ``/metrics`` is scraped.
+
+The endpoint requires the auth key like the rest of the API, since the
+labels name deployments and services. Set ``METRICS_PUBLIC=1`` to let a
+scraper in without it.
+"""
+
+import bisect
+import os
+import time
+import weakref
+from contextlib import contextmanager
+from flask import Blueprint, Response, g
+import gevent
+import transaction
+from ZODB.POSException import ConflictError
+
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60,
+                   120, 300)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (n, str(v).replace('\\', r'\\').replace('"', r'\"'))
+        for n, v in zip(names, values))
+
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('%s needs labels %s' % (self.name, self.labels))
+        return tuple(labels[n] for n in self.labels)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, format_labels(self.labels, key), value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for name, labels, value in self.samples():
+            lines.append('%s%s %s' % (name, labels, repr(float(value))))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that is read from ``func`` when scraped; ``func`` returns
+    a number, or a dict of label value tuples to numbers.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, help, func, labels=()):
+        Metric.__init__(self, name, help, labels)
+        self.func = func
+
+    def samples(self):
+        try:
+            values = self.func()
+        except Exception:
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            yield self.name, format_labels(self.labels, key), value
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if not key in self.values:
+            self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+        counts, _, _ = entry = self.values[key]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(counts):
+            counts[index] += 1
+        entry[1] += 1
+        entry[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for key, (counts, count, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield ('%s_bucket' % self.name,
+                       format_labels(names, key + (bound,)), cumulative)
+            yield ('%s_bucket' % self.name,
+                   format_labels(names, key + ('+Inf',)), count)
+            yield ('%s_count' % self.name,
+                   format_labels(self.labels, key), count)
+            yield ('%s_sum' % self.name,
+                   format_labels(self.labels, key), total)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(m.render() for m in self.metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'deployd_request_seconds',
+    'Time to answer an API request; for streaming requests, until the '
+    'stream starts.', labels=('endpoint',)))
+SETUP_SECONDS = REGISTRY.register(Histogram(
+    'deployd_service_setup_seconds',
+    'Time to set up a version of a service.',
+    labels=('deployment', 'service')))
+DOCKER_SECONDS = REGISTRY.register(Histogram(
+    'deployd_docker_call_seconds', 'Latency of docker API calls.',
+    labels=('method',)))
+COMMIT_SECONDS = REGISTRY.register(Histogram(
+    'deployd_zodb_commit_seconds', 'Time to commit a transaction.'))
+CONFLICTS = REGISTRY.register(Counter(
+    'deployd_zodb_conflicts_total', 'Commits that failed due to a conflict.'))
+
+
+# Contexts of the streaming responses currently open
+_streams = weakref.WeakSet()
+
+
+def track_stream(context):
+    _streams.add(context)
+
+
+REGISTRY.register(Gauge(
+    'deployd_stream_queue_depth',
+    'Events waiting to be sent to clients, over all open streams.',
+    lambda: sum(c.queue.qsize() for c in list(_streams))))
+REGISTRY.register(Gauge(
+    'deployd_streams', 'Number of open streaming responses.',
+    lambda: len(_streams)))
+
+
+# Greenlets still running, by what they were spawned for
+_greenlets = {}
+
+
+def count(task, greenlet):
+    """Count ``greenlet`` as running ``task`` until it is done."""
+    def done(greenlet):
+        _greenlets[task] -= 1
+    _greenlets[task] = _greenlets.get(task, 0) + 1
+    greenlet.rawlink(done)
+    return greenlet
+
+
+REGISTRY.register(Gauge(
+    'deployd_greenlets',
+    'Greenlets spawned for requests and background work that are still '
+    'running, by what for.',
+    lambda: {(task,): n for task, n in _greenlets.items()},
+    labels=('task',)))
+
+
+def commit():
+    """Commit the current transaction, measuring how long that takes,
+    and whether it conflicts.
+    """
+    started = time.time()
+    try:
+        transaction.commit()
+    except ConflictError:
+        CONFLICTS.inc()
+        raise
+    finally:
+        COMMIT_SECONDS.observe(time.time() - started)
+
+
+class InstrumentedClient(object):
+    """Wraps a docker client; measures the latency of all calls."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            with DOCKER_SECONDS.time(method=name):
+                return attr(*args, **kwargs)
+        return call
+
+
+metrics_api = Blueprint('metrics', __name__)
+
+
+def controller_gauges(controller):
+    """The gauges that need to know the controller."""
+    packer = controller.packer
+    build_cache = controller.build_cache
+    return [
+        Gauge('deployd_instances', 'Number of instances by state.',
+              controller.monitor.counts, labels=('status',)),
+        Gauge('deployd_zodb_size_bytes', 'Size of the database file.',
+              packer.size),
+        Gauge('deployd_zodb_packs_total', 'Number of times the database '
+              'was packed.', lambda: packer.stats['packs']),
+        Gauge('deployd_zodb_last_pack_seconds', 'Duration of the last pack.',
+              lambda: packer.stats['last_pack_duration'] or 0),
+        Gauge('deployd_build_cache_bytes', 'Disk space used by the build '
+              'cache.', build_cache.size),
+        Gauge('deployd_build_cache_total', 'Builds by whether their cache '
+              'directory had content.', lambda: {
+                  ('hit',): build_cache.stats['hits'],
+                  ('miss',): build_cache.stats['misses']},
+              labels=('result',)),
+        Gauge('deployd_build_cache_evictions_total', 'Number of build cache '
+              'directories removed to stay within the budget.',
+              lambda: build_cache.stats['evictions']),
+    ]
+
+
+@metrics_api.route('/metrics')
+def metrics():
+    output = REGISTRY.render()
+    output += '\n'.join(
+        m.render() for m in controller_gauges(g.controller)) + '\n'
+    return Response(output, content_type='text/plain; version=0.0.4')
+metrics.is_public = bool(os.environ.get('METRICS_PUBLIC'))
+metrics.read_only = True
@@ -0,0 +1,122 @@
+"""Packing of the controller database.
+
+Every request commits a transaction, and ZODB's ``FileStorage`` only ever
+appends to ``Data.fs``; old object revisions remain until the storage is
+packed. :class:`PackScheduler` runs in the background and packs the
+database when either
+
+- the file has grown by ``growth`` bytes since the last pack, or
+- the last pack was more than ``max_age`` seconds ago (and the file has
+  grown at all).
+
+Revisions younger than ``history`` seconds are kept, so the recent
+history can still be inspected or undone.
+
+All settings can be given via environment variables:
+
+    PACK_HISTORY       seconds of history to keep (default: 7 days)
+    PACK_GROWTH        bytes of growth that trigger a pack (default: 64MB)
+    PACK_MAX_AGE       seconds after which to pack anyway (default: 1 day)
+    PACK_INTERVAL      seconds between checks (default: 5 minutes);
+                       0 disables the scheduler.
+
+Packing runs in gevent's threadpool, so the API is still served
+meanwhile; ZODB's locks are monkey-patched, which works across native
+threads as of gevent 20.12. FileStorage packs in a copy of the file, so
+nothing is lost if we are interrupted.
+"""
+
+import os
+import time
+import gevent
+
+
+class PackScheduler(object):
+
+    def __init__(self, db, path, history=7*86400, growth=64*1024*1024,
+                 max_age=86400, interval=300):
+        self.db = db
+        self.path = path
+        self.history = history
+        self.growth = growth
+        self.max_age = max_age
+        self.interval = interval
+
+        # When we last packed, and the size of the file afterwards. Until
+        # we pack the first time, measure from startup.
+        self.last_pack = time.time()
+        self.last_size = self.size()
+
+        self.stats = {
+            'packs': 0,
+            'failures': 0,
+            'size': self.last_size,
+            'last_pack_time': None,
+            'last_pack_duration': None,
+            'last_pack_freed': None,
+        }
+
+    @classmethod
+    def from_environ(cls, db, path, environ=os.environ):
+        options = {}
+        for key in ('history', 'growth', 'max_age', 'interval'):
+            value = environ.get('PACK_%s' % key.upper())
+            if value:
+                options[key] = int(value)
+        return cls(db, path, **options)
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def should_pack(self, now=None):
+        now = now or time.time()
+        size = self.size()
+        self.stats['size'] = size
+
+        grown = size - self.last_size
+        if grown >= self.growth:
+            return True
+        if grown > 0 and now - self.last_pack >= self.max_age:
+            return True
+        return False
+
+    def pack(self):
+        """Pack the database now; return the number of bytes freed.
+        """
+        size_before = self.size()
+        started = time.time()
+        gevent.get_hub().threadpool.apply(
+            self.db.pack, kwds={'t': started - self.history})
+        finished = time.time()
+
+        self.last_pack = finished
+        self.last_size = self.size()
+        freed = size_before - self.last_size
+        self.stats.update({
+            'packs': self.stats['packs'] + 1,
+            'size': self.last_size,
+            'last_pack_time': finished,
+            'last_pack_duration': finished - started,
+            'last_pack_freed': freed,
+        })
+        return freed
+
+    def run(self):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                if self.should_pack():
+                    freed = self.pack()
+                    print "Packed database in %.2fs, freed %d bytes" % (
+                        self.stats['last_pack_duration'], freed)
+            except Exception as e:
+                self.stats['failures'] += 1
+                print "Packing the database failed: %s" % e
+
+    def start(self):
+        if not self.interval:
+            return None
+        return gevent.spawn(self.run)
@@ -0,0 +1,136 @@
+"""Assignment of host ports to containers.
+
+Ports are tracked per host IP in the database, so no two instances are
+given the same port. Once an instance is stopped, its ports are kept in
+quarantine for a while (``PORT_QUARANTINE`` seconds, default 60) before
+they are handed out again; docker's proxy or connections in TIME_WAIT
+might still hold them.
+
+The search for a free port starts at an offset derived from the name of
+the container; so services set up concurrently do not all compete for
+the same ports, and the result does not depend on chance. For the host
+the controller runs on, ports that something else listens on are
+skipped as well.
+"""
+
+import os
+import time
+import zlib
+import gevent
+import BTrees.OOBTree
+from persistent import Persistent
+
+
+class NoFreePortError(Exception):
+    pass
+
+
+def listening_ports(proc='/proc/net'):
+    """Return the TCP ports something on this host listens on, as far as
+    we can tell; on systems without ``/proc``, an empty set.
+    """
+    ports = set()
+    for name in ('tcp', 'tcp6'):
+        try:
+            with open(os.path.join(proc, name)) as f:
+                lines = f.readlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            fields = line.split()
+            # The state 0A is LISTEN
+            if len(fields) > 3 and fields[3] == '0A':
+                ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+    return ports
+
+
+def wait_until_free(ports, timeout=5, proc='/proc/net'):
+    """Wait until none of the given ports are listened on anymore.
+    Return False if that does not happen within ``timeout`` seconds.
+    """
+    deadline = time.time() + timeout
+    while set(ports) & listening_ports(proc):
+        if time.time() > deadline:
+            return False
+        gevent.sleep(0.1)
+    return True
+
+
+class PortAllocator(Persistent):
+    """Keeps the ports assigned on each host, as ``(ip, port)`` keys.
+
+    The BTrees resolve concurrent changes to different keys, so
+    transactions that assign different ports mostly do not conflict;
+    they still do if a bucket of the tree splits, or if both change the
+    same key. That is why released ports are forgotten by :meth:`prune`,
+    run periodically, rather than by each release.
+    """
+
+    first = 10000
+    last = 65000
+
+    def __init__(self):
+        # (ip, port) -> the name of the container it is assigned to
+        self.assigned = BTrees.OOBTree.BTree()
+        # (ip, port) -> time it was released
+        self.released = BTrees.OOBTree.BTree()
+
+    def allocate(self, ip, owner, quarantine=60, bound=(), now=None):
+        """Assign a port on ``ip`` to the container named ``owner``.
+
+        Ports in ``bound`` are not used, nor are those released less
+        than ``quarantine`` seconds ago.
+        """
+        now = now or time.time()
+        if isinstance(owner, unicode):
+            owner = owner.encode('utf-8')
+        size = self.last - self.first + 1
+        offset = zlib.crc32(owner) % size
+        for i in xrange(size):
+            port = self.first + (offset + i) % size
+            key = (ip, port)
+            if key in self.assigned or port in bound:
+                continue
+            released = self.released.get(key)
+            if released is not None:
+                if now - released < quarantine:
+                    continue
+                del self.released[key]
+            self.assigned[key] = owner
+            return port
+        raise NoFreePortError('No free port left on %s' % ip)
+
+    def reserve(self, ip, port, owner):
+        """Record a port as assigned that was not allocated by us."""
+        self.assigned[(ip, int(port))] = owner
+
+    def release(self, ip, port, now=None):
+        """Put a port into quarantine. Return False if it was not
+        assigned.
+        """
+        now = now or time.time()
+        key = (ip, int(port))
+        if self.assigned.pop(key, None) is None:
+            return False
+        self.released[key] = now
+        return True
+
+    def prune(self, quarantine=60, now=None):
+        """Forget the released ports whose ``quarantine`` is over, which
+        otherwise would pile up if not allocated again. Return how many.
+        """
+        now = now or time.time()
+        expired = [key for key, released in self.released.items()
+                   if now - released >= quarantine]
+        for key in expired:
+            del self.released[key]
+        return len(expired)
+
+    def stats(self):
+        result = {}
+        for tree, name in ((self.assigned, 'assigned'),
+                           (self.released, 'quarantined')):
+            for ip, _ in tree.keys():
+                host = result.setdefault(ip, {'assigned': 0, 'quarantined': 0})
+                host[name] += 1
+        return result
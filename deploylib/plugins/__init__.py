@@ -3,6 +3,15 @@ class Plugin(object):
 
     Currently, the following methods are supported:
 
+    migrate_db()
+        The database is migrated on startup; plugins upgrade the data
+        they keep themselves.
+
+    on_start()
+        The controller daemon is starting up and is passed as an argument.
+        Plugins may spawn greenlets for background work here; these need
+        to open their own connection via ``controller.interface()``.
+
     on_globals_changed()
         Global data of a deployment has changed.
 
@@ -20,10 +29,21 @@ class Plugin(object):
 
     post_setup()
 
+    needs_serial_setup()
+        When services are set up concurrently, return ``True`` to indicate
+        that the given service has to be set up on its own, after all the
+        others. Needed if the setup depends on state that other services
+        may change at the same time.
+
     setup_resource()
         Before a plugin wants to setup a resource it should call this,
         and delay setup if a truth value is returned.
 
+    provide_images()
+        Add the docker images a (canonical) service definition needs to
+        the given list, so they can be pulled in advance. Return ``True``
+        if the ``image`` key of the definition should not be used.
+
     rewrite_service()
         Plugins have a chance to rewrite the service definition. Used
         for example to enable apps via the slugrunner image.
@@ -45,6 +65,23 @@ class Plugin(object):
 
     before_once()
         Like before_start(), but called when one-off jobs are created.
+
+    post_start(), post_stop()
+        An instance has been started, or is about to be stopped.
+
+    negotiate_data()
+        A client is about to provide data for a service; return a dict
+        that tells it what the plugin has already, so it can send less.
+
+    on_data_provided()
+        A client has provided data for a service, like the code of an app.
+
+    on_instance_down(), on_instance_up()
+        The container of an instance has died (it will be restarted),
+        or is running again. Called from a background greenlet.
+
+    Plugins with a higher ``priority`` are called first; a hook stops
+    being run once a plugin returns a true value.
     """
 
     priority = 100
@@ -57,40 +94,112 @@ class LocalPlugin(object):
         self.app = app
 
 
-def load_plugins(klass, *args, **kwargs):
-    """Search all plugin modules for subclasses of ``klass``,
-    instantiate using ``args`` and ``kwargs``, return as list.
-
-    TODO: consider stevedore.
+# The builtin plugins, in the format of setuptools entry points. Other
+# packages can provide plugins via the ``deploylib.plugins`` entry point
+# group. Modules are only imported once plugins of a base class are
+# asked for.
+BUILTIN_PLUGINS = [
+    'deploylib.plugins._vars:VarsPlugin',
+    'deploylib.plugins.app:AppPlugin',
+    'deploylib.plugins.app:LocalAppPlugin',
+    'deploylib.plugins.consul_registrator:RegistratorAmbassadorConsul',
+    'deploylib.plugins.etcd_discoverd:DiscoverdEtcdPlugin',
+    'deploylib.plugins.exec_resource:ExecPlugin',
+    'deploylib.plugins.flynn_postgres:FlynnPostgresPlugin',
+    'deploylib.plugins.flynn_postgres:LocalFlynnPostgresPlugin',
+    'deploylib.plugins.flynn_postgres:flynn_postgres_api',
+    'deploylib.plugins.generate:GeneratePlugin',
+    'deploylib.plugins.gitreceive:GitReceivePlugin',
+    'deploylib.plugins.gitreceive:LocalGitReceivePlugin',
+    'deploylib.plugins.gitreceive:gitreceive_api',
+    'deploylib.plugins.sdutil:SdutilPlugin',
+    'deploylib.plugins.shelf:ShelfPlugin',
+    'deploylib.plugins.shelf:LocalGitReceivePlugin',
+    'deploylib.plugins.shelf:shelf_api',
+    'deploylib.plugins.strowger:StrowgerPlugin',
+    'deploylib.plugins.strowger:LocalStrowgerPlugin',
+    'deploylib.plugins.systemd:SystemdPlugin',
+    'deploylib.plugins.upstart:UpstartPlugin',
+    'deploylib.plugins.vulcand:SmartPlugin',
+    'deploylib.plugins.vulcand:VulcanPlugin',
+    'deploylib.plugins.vulcand:LocalVulcanPlugin',
+    # Should run after the others, see the docstring.
+    'deploylib.plugins.setup_require:RequiresPlugin',
+]
+
+ENTRY_POINT_GROUP = 'deploylib.plugins'
+
+
+# Base class -> list of plugin classes or objects
+_registry = {}
+_loaded = None
+
+
+def _load_all():
+    """Import all plugins in the manifest, as well as those registered
+    as entry points. Done once.
     """
-    import os
-    from os import path
+    global _loaded
+    if _loaded is not None:
+        return _loaded
+
     import warnings
-    import inspect
     from importlib import import_module
 
-    result = []
-    current_dir = path.dirname(__file__)
-    for name in os.listdir(current_dir):
-        if not name.endswith('.py'):
+    loaded = []
+    modules = {}
+    for spec in BUILTIN_PLUGINS:
+        module_name, attr_name = spec.split(':', 1)
+        if not module_name in modules:
+            try:
+                modules[module_name] = import_module(module_name)
+            except Exception as e:
+                warnings.warn('Error while loading plugin module '
+                              '\'%s\': %s' % (module_name, e))
+                modules[module_name] = None
+        if modules[module_name] is None:
             continue
-        name = path.splitext(name)[0]
-        module_name = 'deploylib.plugins.%s' % name
-        try:
-            module = import_module(module_name)
-        except Exception as e:
-            warnings.warn('Error while loading builtin plugin module '
-                          '\'%s\': %s' % (module_name, e))
-        else:
-            for attr_name in dir(module):
-                attr = getattr(module, attr_name)
-                if inspect.isclass(attr) and issubclass(attr, klass) and not \
-                        attr is klass:
-                    if not 'abstract' in dir(klass) or not getattr(klass, 'abstract', True):
-                        result.append(attr(*args, **kwargs))
-
-                if isinstance(attr, klass):
+        loaded.append(getattr(modules[module_name], attr_name))
+
+    try:
+        import pkg_resources
+    except ImportError:
+        pass
+    else:
+        for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP):
+            try:
+                loaded.append(entry_point.load(require=False))
+            except Exception as e:
+                warnings.warn('Error while loading plugin \'%s\': %s' % (
+                    entry_point, e))
+
+    _loaded = loaded
+    return loaded
+
+
+def find_plugins(klass):
+    """Return the plugin classes derived from ``klass``, and the plugin
+    objects that are instances of it. Classes that set ``abstract`` in
+    their own body are only there to be derived from, and are skipped.
+    """
+    if not klass in _registry:
+        import inspect
+        result = []
+        for attr in _load_all():
+            if inspect.isclass(attr):
+                if issubclass(attr, klass) and not attr is klass and \
+                        not vars(attr).get('abstract'):
                     result.append(attr)
+            elif isinstance(attr, klass):
+                result.append(attr)
+        _registry[klass] = result
+    return _registry[klass]
 
-    return result
 
+def load_plugins(klass, *args, **kwargs):
+    """Find all plugins for ``klass``, instantiate the classes using
+    ``args`` and ``kwargs``, return as list.
+    """
+    import inspect
+    return [p(*args, **kwargs) if inspect.isclass(p) else p
+            for p in find_plugins(klass)]
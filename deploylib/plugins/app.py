@@ -2,22 +2,162 @@
 
 Will automatically install flynn/shelf as part of tye system deployment to
 store compiled slugs.
+
+Slugs are indexed by the git tree of the code and a fingerprint of what
+else goes into the build: the slugbuilder image and ``BUILDPACK_URL``.
+If the same code was built before, in any service or deployment, the
+slug on shelf is used rather than building it again. A service whose
+build depends on more of its environment names those variables as
+``build_env``; they are part of the fingerprint then.
+
+Before uploading, the client asks the controller (``/negotiate``) whether
+it has a slug of the tree already, in which case nothing is sent. If not,
+rather than an archive of the code, the client sends a git pack with only
+the objects the controller's own repository lacks (it tells the client
+which commits it has); the controller then archives the tree itself.
+
+The slugbuilder cache is shared by the builds that use the same buildpack
+and have the same dependency lock files (``Gemfile.lock`` and the like),
+see :mod:`deploylib.daemon.buildcache`.
 """
 
 import os
 from os.path import abspath, exists, join as path
 import subprocess
+from contextlib import contextmanager
 import ConfigParser
-import tempfile
+import hashlib
+import json
+import gevent
+import requests
 
 import click
 from deploylib.client.cli import print_jobs
-from deploylib.daemon.context import ctx
+from deploylib.daemon.context import ctx, span
 from deploylib.daemon.controller import DeployError
+# Slug indexes stored before it moved refer to it here.
+from deploylib.daemon.db import SlugIndex
 from deploylib.plugins.shelf import ShelfPlugin, SHELF_SD_NAME
 from . import Plugin, LocalPlugin
 
 
+# Size of the pieces in which app code is passed on.
+CHUNK_SIZE = 64 * 1024
+
+
+def stream_output(args, cwd=None, input=None):
+    """Run a command, and yield its output in chunks as it is written;
+    can be given to requests as a body to upload.
+    """
+    process = subprocess.Popen(
+        args, cwd=cwd, stdout=subprocess.PIPE,
+        stdin=subprocess.PIPE if input is not None else None)
+    if input is not None:
+        process.stdin.write(input)
+        process.stdin.close()
+    try:
+        for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), ''):
+            yield chunk
+    finally:
+        process.stdout.close()
+        if process.wait():
+            raise subprocess.CalledProcessError(process.returncode, args)
+
+
+# The environment variables every build depends on.
+BUILD_ENV = ('BUILDPACK_URL',)
+
+
+def build_fingerprint(image, env, names=()):
+    """Hash what, besides the code, determines the slug that is built:
+    the builder ``image``, and the variables of ``env`` in
+    :data:`BUILD_ENV` and ``names``.
+    """
+    names = set(BUILD_ENV) | set(names or ())
+    env = {k: env.get(k) for k in names}
+    return hashlib.sha1(json.dumps([image, sorted(env.items())])).hexdigest()
+
+
+# Files that pin the dependencies of an app, for the common buildpacks.
+LOCK_FILES = ('Gemfile.lock', 'package-lock.json', 'yarn.lock',
+              'npm-shrinkwrap.json', 'requirements.txt', 'Pipfile.lock',
+              'poetry.lock', 'composer.lock', 'go.sum', 'Godeps.json',
+              'Cargo.lock', 'mix.lock')
+
+
+def dependency_hash(ls_tree):
+    """Hash the lock files listed in the output of ``git ls-tree``, or
+    return None if there are none.
+    """
+    blobs = []
+    for line in ls_tree.splitlines():
+        info, name = line.split('\t', 1)
+        if name in LOCK_FILES:
+            blobs.append((name, info.split()[2]))
+    if not blobs:
+        return None
+    return hashlib.sha1(json.dumps(sorted(blobs))).hexdigest()
+
+
+class SourceRepo(object):
+    """A bare git repository on the controller with the code that clients
+    have sent as packs; one for all services, so that any of them can be
+    the base of the next upload.
+
+    Only the trees of the commits are stored, not their history: their
+    parents are missing.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not exists(path(directory, 'HEAD')):
+            self.git('init', '--bare', '-q')
+
+    def git(self, *args):
+        return subprocess.check_output(('git',) + args, cwd=self.directory)
+
+    def bases(self, count=20):
+        """Commits a client may send the difference to, latest first."""
+        result = []
+        for commit in self.git(
+                'for-each-ref', '--sort=-committerdate', '--count=%d' % count,
+                '--format=%(objectname)', 'refs/deploy/').split():
+            if not commit in result:
+                result.append(commit)
+        return result
+
+    def receive(self, stream, commit, ref):
+        """Store the pack read from ``stream``, and point ``ref`` at the
+        commit it brings.
+        """
+        process = subprocess.Popen(
+            ['git', 'index-pack', '--stdin'],
+            cwd=self.directory, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), ''):
+                process.stdin.write(chunk)
+        finally:
+            _, error = process.communicate()
+        if process.returncode:
+            raise DeployError('the uploaded code is not valid: %s' % error.strip())
+        self.git('update-ref', ref, commit)
+
+    @contextmanager
+    def archive(self, tree):
+        """Provide a stream with a tarball of ``tree``."""
+        process = subprocess.Popen(
+            ['git', 'archive', tree], cwd=self.directory,
+            stdout=subprocess.PIPE)
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode:
+            raise DeployError('git archive failed with code %s' % returncode)
+
+
 class LocalAppPlugin(LocalPlugin):
     """Base interface for a plugin that runs as part of the CLI
     on the client.
@@ -26,14 +166,17 @@ class LocalAppPlugin(LocalPlugin):
     def provide_cli(self, group):
         group.add_command(app_cli)
 
-    def provide_data(self, service, what):
+    def provide_data(self, service, what, negotiate=None):
         """Server says it is missing data for the given service.
 
-        This should return a dict of files that will be uploaded.
-        """
-        run = subprocess.check_output
-        from deploylib.client.utils import directory
+        This should return a dict of files that will be uploaded, as
+        ``{name: (file, data)}``; the file may be a filename, a file
+        object, or an iterable of chunks.
 
+        ``negotiate(name, data)``, if given, asks the server what it
+        already has of a file; it returns None for servers that cannot
+        tell.
+        """
         if what != 'git':
             return False
 
@@ -41,22 +184,49 @@ class LocalAppPlugin(LocalPlugin):
         # For git archive to work right we need the sub path relative
         # to the repository root.
         project_path = self.find_project_repo(service, service['git'])
-        with directory(project_path):
-            git_root = run('git rev-parse --show-toplevel', shell=True)
-            gitsubdir = project_path[len(git_root):]
-
-        # Determine git version
-        with directory(project_path):
-            app_version = run('git rev-parse HEAD', shell=True)[:10]
-
-        # Create and push the git archive
-        with directory(project_path):
-            temp = tempfile.mktemp()
-            run('git archive HEAD:{} > {}'.format(gitsubdir, temp), shell=True)
+        # Not changing the working directory: several services may be
+        # uploaded at the same time, from threads.
+        run = lambda args: subprocess.check_output(args, cwd=project_path)
+        git_root = run(['git', 'rev-parse', '--show-toplevel'])
+        gitsubdir = project_path[len(git_root):]
+
+        # Determine git version, and the tree of the code
+        commit = run(['git', 'rev-parse', 'HEAD']).strip()
+        tree = run(['git', 'rev-parse', 'HEAD:{}'.format(gitsubdir)]).strip()
+        deps = dependency_hash(run(['git', 'ls-tree', tree]))
+        info = {'version': commit[:10], 'tree': tree, 'deps': deps}
+
+        offer = negotiate('app', info) if negotiate else None
+        if offer and offer.get('have'):
+            # The server has built this code before
+            return {'app': ('', dict(info, format='none'))}
+
+        if offer and 'pack' in offer.get('formats', ()):
+            # Only send the objects the server does not have yet. It has
+            # the trees of the commits it was sent, not their history, so
+            # neither does the pack: it holds the commit and those objects
+            # of its tree that are not in the trees of the bases.
+            bases = [b for b in offer.get('bases', ())
+                     if self.has_commit(project_path, b)]
+            objects = run(['git', 'rev-list', '--objects', '--no-walk',
+                           commit, '--not'] + bases)
+            pack = stream_output(
+                ['git', 'pack-objects', '--stdout', '-q'],
+                cwd=project_path, input=objects)
+            return {'app': (pack, dict(info, format='pack', commit=commit))}
+
+        # The archive is streamed to the server while git creates it.
+        archive = stream_output(
+            ['git', 'archive', 'HEAD:{}'.format(gitsubdir)], cwd=project_path)
+        return {
+            'app': (archive, info)
+        }
 
-            return {
-                'app': (temp, {'version': app_version})
-            }
+    def has_commit(self, project_path, commit):
+        with open(os.devnull, 'w') as devnull:
+            return not subprocess.call(
+                ['git', 'cat-file', '-e', '%s^{commit}' % commit],
+                cwd=project_path, stdout=devnull, stderr=devnull)
 
     def find_project_repo(self, service, rel):
         """Try to find ``rel``. Either it's relative to the service file,
@@ -120,11 +290,32 @@ class AppPlugin(Plugin):
             service.hold('app code not available', version)
             return True
 
+    def negotiate_data(self, service, name, data):
+        """Client is about to upload the app code; tell it whether we
+        have built this tree already, and the commits it can send the
+        difference to.
+        """
+        if name != 'app':
+            return
+
+        version = service.held_version if service.held else service.latest
+        slug = version and ctx.cintf.db.slug_index.get(
+            data.get('tree'), self._fingerprint(version))
+        return {
+            'have': bool(slug and self._slug_exists(slug)),
+            'bases': self._repo().bases(),
+            'formats': ['tar', 'pack', 'none'],
+        }
+
     def on_data_provided(self, service, files, data):
-        """Client has uploaded the app code.
+        """Client has uploaded the app code; as a tarball, as a git pack
+        with what our repository lacks, or not at all if we have built
+        the same code before.
         """
         if not 'app' in files:
             return
+        code = files['app']
+        format = data['app'].get('format', 'tar')
 
         # Use the held version, or copy the latest one
         if service.held:
@@ -133,17 +324,61 @@ class AppPlugin(Plugin):
             version = service.derive()
         version.data['app_version_id'] = data['app']['version']
 
-        ctx.job('building slug for %s, version %s' % (
-            service.name, data['app']['version']))
-
-        # Build into a slug
-        uploaded_file = tempfile.mktemp()
-        files['app'].save(uploaded_file)
-        self.build(service, version, uploaded_file)
+        if format == 'pack':
+            self._repo().receive(code, data['app']['commit'], 'refs/deploy/%s/%s' % (
+                service.deployment.id, service.name))
+
+        # Clients that do not send the tree give us the commit instead.
+        tree = data['app'].get('tree') or 'commit:%s' % data['app']['version']
+        fingerprint = self._fingerprint(version)
+        index = ctx.cintf.db.slug_index
+
+        slug = index.get(tree, fingerprint)
+        if slug and not self._slug_exists(slug):
+            index.discard(tree, fingerprint)
+            slug = None
+
+        if slug:
+            ctx.job('using existing slug %s for %s, version %s' % (
+                slug, service.name, data['app']['version']))
+            if format == 'tar':
+                # The client is still sending the code
+                for _ in iter(lambda: code.read(CHUNK_SIZE), ''):
+                    pass
+        elif format == 'none':
+            raise DeployError(
+                'the slug for version %s is no longer available, please '
+                'deploy again' % data['app']['version'])
+        else:
+            ctx.job('building slug for %s, version %s' % (
+                service.name, data['app']['version']))
+            # Builds of the same code with another environment must not
+            # replace this one.
+            slug = self._slug_id(service, '%s-%s' % (
+                version.data['app_version_id'], fingerprint[:8]))
+
+            # Build into a slug, passing the code on as it is uploaded
+            with span('build', service=service.name):
+                if format == 'pack':
+                    with self._repo().archive(tree) as archive:
+                        self.build(service, version, archive, slug,
+                                   data['app'].get('deps'))
+                else:
+                    self.build(service, version, code, slug,
+                               data['app'].get('deps'))
+            index.add(tree, fingerprint, slug)
+
+        version.data['slug'] = slug
 
         # Run this new version
         ctx.cintf.setup_version(service, version)
 
+    def provide_images(self, definition, images):
+        if not 'git' in definition['kwargs']:
+            return False
+        images.append('flynn/slugrunner')
+        return True
+
     def rewrite_service(self, service, version, definition):
         """Convert service to be run as a slugrunner.
         """
@@ -163,8 +398,12 @@ class AppPlugin(Plugin):
         definition['kwargs'].setdefault('sdutil', {})
         definition['kwargs']['sdutil']['binary'] = 'sdutil'
 
-    def build(self, service, version, filename):
-        """Build an app using slugbuilder.
+    def build(self, service, version, stream, slug, deps=None):
+        """Build an app using slugbuilder, storing it on shelf as
+        ``slug``; ``stream`` is a file-like object with the tarball of
+        the app, which is copied into the builder's stdin via the docker
+        attach API as it is read. ``deps`` is the hash of the dependency
+        lock files of the app, if known.
 
         Note: buildstep would give us a real exclusive image, rather than a
         container that presumably needs to unpack the slug every time. Maybe
@@ -172,64 +411,125 @@ class AppPlugin(Plugin):
         """
 
         # Determine the url where we'll store the slug
-        slug_url = self._get_slug_url(service, version.data['app_version_id'])
-
-        # To speed up the build, use a cache
-        cache_dir = ctx.cintf.cache(
-            'slugbuilder', service.deployment.id, service.name)
+        slug_url = self._get_slug_url(slug)
 
         # Run the slugbuilder
         docker = ctx.cintf.backend.client
-        ctx.log('Pulling flynn/slugbuilder')
-        docker.pull('flynn/slugbuilder')
+        builder_image = self._builder_image()
+        ctx.log('Pulling %s' % builder_image)
+        docker.pull(builder_image)
         env = self._build_env(service, version)
-
-        # TODO: Sending data through stdin via the API isn't obvious
-        # at all, so we'll fall back on the command line here for now.
-        #container = docker.create_container(
-        #    image='flynn/slugbuilder',
-        #    stdin=filename,
-        #    command=slug_url,
-        #    environment=env,
-        #    volumes={cache_dir: '/tmp/cache:rw'})
-        builder_image = os.environ.get('SLUGBUILDER', 'flynn/slugbuilder')
-
-        cmd = ('cat {} | docker run -u root -v {cache}:/tmp/cache:rw {env} -i -a stdin '
-              '-a stdout {image} {outuri}'.format(
-                filename, outuri=slug_url, cache=cache_dir,
+        env['SLUG_URL'] = slug_url
+
+        # To speed up the build, use a cache; the same one as builds of
+        # the same dependencies elsewhere.
+        cache = ctx.cintf.controller.build_cache
+        with cache.use(self._cache_key(service, version, deps)) as cache_dir:
+            # stdin is closed once we detach, like with "docker run -i".
+            container = docker.create_container(
                 image=builder_image,
-                env=' '.join(['-e %s="%s"' % (k, v) for k, v in env.items()])))
-
-        build_process = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, bufsize=0)
+                command=[slug_url],
+                user='root',
+                environment=env,
+                stdin_open=True,
+                volumes=['/tmp/cache'])
+            feeder = returncode = None
+            try:
+                stdin = docker.attach_socket(
+                    container, params={'stdin': 1, 'stream': 1})
+                docker.start(container, binds={cache_dir: '/tmp/cache'})
+                feeder = gevent.spawn(self._feed, stream, stdin)
+
+                for line in self._read_lines(
+                        docker.attach(container, stream=True, logs=True)):
+                    if line.startswith('\x1b'):
+                        # There is some type of shell code at the beginning,
+                        # and it somehow prevents indentation.
+                        line = line[4:]
+                    ctx.log(line.strip())
+
+                # Errors reading the upload
+                feeder.get()
+                returncode = docker.wait(container)
+            finally:
+                if feeder is not None:
+                    feeder.kill()
+                if returncode is None:
+                    # We did not see the build to its end
+                    try:
+                        docker.kill(container)
+                    except Exception:
+                        pass
+                docker.remove_container(container)
+
+        if returncode:
+            raise DeployError('the build failed with code %s' % returncode)
+
+    def _feed(self, stream, sock):
+        try:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), ''):
+                sock.sendall(chunk)
+        finally:
+            sock.close()
+
+    def _read_lines(self, chunks):
+        buffer = ''
+        for chunk in chunks:
+            buffer += chunk
+            lines = buffer.split('\n')
+            buffer = lines.pop()
+            for line in lines:
+                yield line
+        if buffer:
+            yield buffer
+
+    def _builder_image(self):
+        return os.environ.get('SLUGBUILDER', 'flynn/slugbuilder')
+
+    def _fingerprint(self, version):
+        return build_fingerprint(
+            self._builder_image(), version.definition['env'],
+            version.definition['kwargs'].get('build_env'))
+
+    def _cache_key(self, service, version, deps):
+        buildpack = version.definition['env'].get('BUILDPACK_URL', '')
+        if deps:
+            parts = [self._builder_image(), buildpack, deps]
+        else:
+            # We cannot tell whether apps have the same dependencies.
+            parts = [self._builder_image(), buildpack,
+                     service.deployment.id, service.name]
+        return hashlib.sha1(json.dumps(parts)).hexdigest()[:16]
 
-        line = build_process.stdout.readline()
-        while line:
-            if line.startswith('\x1b'):
-                # There is some type of shell code at the beginning, and
-                # it somehow prevents indentation.
-                line = line[4:]
-            ctx.log(line.strip())
-            line = build_process.stdout.readline()
+    def _repo(self):
+        return SourceRepo(ctx.cintf.cache('git'))
 
-        build_process.wait()
-        if build_process.returncode:
-            raise DeployError('the build failed with code %s' % build_process.returncode)
+    def _slug_id(self, service, slug_name):
+        return "{}/{}:{}".format(
+            service.deployment.id, service.name, slug_name)
 
-    def _get_slug_url(self, service, slug_name):
+    def _get_slug_url(self, slug):
         # Put together an full url for a slug
         shelf_ip = ctx.cintf.discover(SHELF_SD_NAME, durable=True)
-        release_id = "{}/{}:{}".format(
-            service.deployment.id, service.name, slug_name)
-        slug_url = 'http://{}{}'.format(shelf_ip, '/slugs/{}'.format(release_id))
+        slug_url = 'http://{}{}'.format(shelf_ip, '/slugs/{}'.format(slug))
         return slug_url
 
+    def _slug_exists(self, slug):
+        """Make sure a slug we know of is still on shelf."""
+        try:
+            response = requests.head(self._get_slug_url(slug), timeout=10)
+        except requests.RequestException:
+            return False
+        return response.status_code == 200
+
     def _build_env(self, service, version):
         # Put together some extra environment variables we know the
         # slugrunner image expects.
         env = {
            'APP_ID': service.deployment.id,
-           'SLUG_URL': self._get_slug_url(service, version.data['app_version_id'])
+           # Versions from before the slug index was added lack the id.
+           'SLUG_URL': self._get_slug_url(version.data.get('slug') or self._slug_id(
+               service, version.data['app_version_id']))
         }
         env.update(version.definition['env'])
         return env
@@ -30,13 +30,73 @@ There are some options we have for solving this:
    consul initially on start/stop. Now the controller keeps the catalog
    clean, and registrator keeps it up to date with running/not running state.
    If we combine this with health checks, indeed we do not need registrator.
+
+We currently do a version of (4): The instances in the database are the
+source of truth. When instances are started or stopped, the registrations
+of their service are brought in line with them right away, and a periodic
+sync of all services cleans up what we missed.
 """
 
-import consul
+import os
+import gevent
 from deploylib.daemon.context import ctx
 from deploylib.plugins import Plugin
 
 
+SERVICE_ID_PREFIX = 'hafez:'
+
+
+class CatalogSync(object):
+    """Applies a desired set of registrations to the consul agent.
+
+    The desired set is a dict of ``{service_id: (name, address, port)}``.
+    Rather than registering every port as we go, we fetch the agent's
+    services once, and only send the changes.
+
+    Registrations are made with the agent, not the catalog: Consul's
+    transaction API only covers catalog writes, and agent registrations
+    are what anti-entropy and health checks are built on. So a sync is
+    one read plus one request per actual change.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def current(self):
+        return {id: (s['Service'], s.get('Address', ''), s['Port'])
+                for id, s in self.client.agent.services().items()
+                if id.startswith(SERVICE_ID_PREFIX)}
+
+    def apply(self, desired, remove=None, current=None):
+        """Register everything in ``desired`` that is missing or different.
+
+        Of the existing registrations, those for which ``remove(id, entry)``
+        returns True, and that are not desired, are deregistered.
+
+        Returns the names of all services that were changed.
+        """
+        if current is None:
+            current = self.current()
+
+        changed = set()
+        for id, (name, address, port) in desired.items():
+            if current.get(id) == (name, address, port):
+                continue
+            print "Adding service to consul catalog: %s, id=%s" % (name, id)
+            self.client.agent.service.register(
+                name, service_id=id, address=address, port=port)
+            changed.add(name)
+
+        for id, entry in current.items():
+            if id in desired or not remove or not remove(id, entry):
+                continue
+            print "Removing service from consul catalog: %s" % id
+            self.client.agent.service.deregister(service_id=id)
+            changed.add(entry[0])
+
+        return changed
+
+
 class RegistratorAmbassadorConsul(Plugin):
     """
     Using the progrium/registrator image for service discovery,
@@ -59,32 +119,124 @@ class RegistratorAmbassadorConsul(Plugin):
     def _get_service_id_for_port(self, service_id, portname):
         if isinstance(service_id, tuple):
             service_id = service_id[1]  # backwards compat hack, remove soon
-        service_id_base = 'hafez:%s' % service_id
+        service_id_base = '%s%s' % (SERVICE_ID_PREFIX, service_id)
         if portname:
             return '%s:%s' % (service_id_base, portname)
         else:
             return service_id_base
 
-    def post_start(self, service, instance, port_assignments):
-        """Add instances for all services (all ports) to consul catalog.
-        """
-        c = consul.Consul(ctx.cintf.get_host_ip())
+    # Set once the controller starts; instances that are down are not
+    # registered.
+    monitor = None
+
+    # Seconds between syncs of all services; 0 to disable.
+    sync_interval = int(os.environ.get('CONSUL_SYNC_INTERVAL', 60))
+
+    def __init__(self):
+        # Registrations found to be stale during the last full sync
+        self._stale = set()
+
+    def _instance_ids(self, service, instance):
+        """All service ids for the ports of ``instance``."""
         for portname in self._ports_from_service(instance):
-            name = self._get_name_for_port(service, portname)
-            id = self._get_service_id_for_port(instance.id, portname)
-            print "Adding service to consul catalog: %s, id=%s" % (name, id)
-            c.agent.service.register(
-                name, service_id=id, port=port_assignments[portname]['host'])
+            yield self._get_service_id_for_port(instance.id, portname)
+
+    def _desired_for_service(self, service):
+        """Return the registrations we want for ``service``, and the
+        ids that we do not know enough about to touch.
+        """
+        desired, keep = {}, set()
+        for instance in service.instances:
+            if instance.ports is None:
+                keep.update(self._instance_ids(service, instance))
+                continue
+            if self.monitor and self.monitor.is_down(instance):
+                continue
+            for portname, host in instance.ports.items():
+                if not host:
+                    continue
+                id = self._get_service_id_for_port(instance.id, portname)
+                desired[id] = (
+                    self._get_name_for_port(service, portname),
+                    host[0], int(host[1]))
+        return desired, keep
+
+    def post_start(self, service, instance, port_assignments):
+        self._service_changed(service, instance)
 
     def post_stop(self, service, instance):
-        """Remove all services for this instance fro consul
+        self._service_changed(service, instance)
+
+    def on_instance_down(self, service, instance):
+        self._service_changed(service, instance)
+
+    def on_instance_up(self, service, instance):
+        self._service_changed(service, instance)
+
+    def _service_changed(self, service, instance):
+        """Bring the registrations of ``service`` in line with its
+        instances right away.
+
+        This happens before old instances are drained and stopped, so
+        clients move over to the new ones in the meantime. Should the
+        transaction be aborted, the controller stops the instances it
+        started again, which brings us back here.
         """
-        c = consul.Consul(ctx.cintf.get_host_ip())
-        for portname in self._ports_from_service(instance):
-            name = self._get_name_for_port(service, portname)
-            id = self._get_service_id_for_port(instance.id, portname)
-            print "Removing service from consul catalog: %s" % id
-            c.agent.service.deregister(service_id=id)
+        # The ids of all instances we know of, to catch those stopped.
+        ids = set(self._instance_ids(service, instance))
+        for inst in service.instances:
+            ids.update(self._instance_ids(service, inst))
+        desired, keep = self._desired_for_service(service)
+        ids -= keep
+
+        discovery = ctx.cintf.controller.discovery
+        sync = CatalogSync(discovery.client)
+        try:
+            changed = sync.apply(desired, remove=lambda id, _: id in ids)
+        except Exception as e:
+            # The periodic sync will retry
+            print "Updating consul catalog failed: %s" % e
+            return
+        for name in changed:
+            discovery.invalidate(name)
+
+    def sync_all(self, db, discovery):
+        """Sync the registrations of all services in the database.
+
+        Since deploys may run at the same time, a registration we do not
+        know about is only removed if it is still there on the next run.
+        """
+        desired, keep = {}, set()
+        for deployment in db.deployments.values():
+            for service in deployment.services.values():
+                service_desired, service_keep = \
+                    self._desired_for_service(service)
+                desired.update(service_desired)
+                keep.update(service_keep)
+
+        sync = CatalogSync(discovery.client)
+        current = sync.current()
+        stale = set(current) - set(desired) - keep
+        remove = stale & self._stale
+        changed = sync.apply(
+            desired, current=current, remove=lambda id, _: id in remove)
+        self._stale = stale - remove
+        for name in changed:
+            discovery.invalidate(name)
+
+    def on_start(self, controller):
+        self.monitor = controller.monitor
+        if self.sync_interval:
+            gevent.spawn(self._sync_periodically, controller)
+
+    def _sync_periodically(self, controller):
+        while True:
+            try:
+                with controller.interface(read_only=True) as cintf:
+                    self.sync_all(cintf.db, controller.discovery)
+            except Exception as e:
+                print "Syncing consul catalog failed: %s" % e
+            gevent.sleep(self.sync_interval)
 
     def before_start(self, service, definition, runcfg, port_assignments):
         deploy_id = service.deployment.id
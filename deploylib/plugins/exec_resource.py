@@ -29,6 +29,14 @@ class ExecPlugin(Plugin):
     def post_setup(self, service, version):
         self.execute_runs(service.deployment)
 
+    def needs_serial_setup(self, deployment, definition):
+        """While there are runs outstanding, any service might be the
+        one to trigger them; we don't want them to run twice.
+        """
+        for name in deployment.globals.get('Exec', {}):
+            if not deployment.get_resource(name):
+                return True
+
     def execute_runs(self, deployment):
         """Execute any outstanding Run resources that are ready.
         """
@@ -41,7 +41,8 @@ from flask import Blueprint, g, request
 from Crypto.PublicKey import RSA
 from persistent import Persistent
 import yaml
-from deploylib.daemon.api import json_method, streaming, TextStreamingResponse
+from deploylib.daemon.api import json_method, streaming, read_only, \
+    TextStreamingResponse, request_body
 from deploylib.daemon.context import ctx
 from deploylib.plugins import Plugin, LocalPlugin
 from deploylib.plugins.app import LocalAppPlugin
@@ -149,17 +150,24 @@ def parse_public_key(keydata):
 @gitreceive_api.route('/push-data', methods=['POST'])
 @streaming(TextStreamingResponse)
 def api_pushdata(request, app):
-    """Called by git received with a new tarball from git.
+    """Called by git received with a new tarball from git; either as the
+    body of the request, which is built while it arrives, or as the
+    "tarball" field of a form.
     """
     deployment, service = request.args['name'].split('/', 1)
-    request.files['tarball']
+    if 'tarball' in request.files:
+        tarball = request.files['tarball']
+    else:
+        tarball = request_body(request)
     ctx.cintf.provide_data(
         deployment, service,
-        {'app': request.files['tarball']},
-        {'app': {'version': request.args['version']}})
+        {'app': tarball},
+        {'app': {'version': request.args['version'],
+                 'tree': request.args.get('tree')}})
 
 
 @gitreceive_api.route('/check-key', methods=['GET'])
+@read_only
 def api_checkkey():
     """Verify the given public key is authorized.
     """
@@ -171,6 +179,7 @@ def api_checkkey():
 
 
 @gitreceive_api.route('/check-repo', methods=['GET'])
+@read_only
 def api_checkrepo():
     """Verify the given repo exists.
     """
@@ -44,18 +44,53 @@ Plugin configuration
 
 The environment variable ``SDUTIL_URL`` can be used to change where the
 binary that is inserted comes from. If not specified, an internet location
-is used.
+is used. It may also be a local path.
+
+The binary is downloaded once and kept in the controller's cache directory.
+The images built are remembered, so an image is only rebuilt if the base
+image or the sdutil binary changes.
 """
 
 import os
+import hashlib
+import shutil
+import tarfile
+import time
 from io import BytesIO
+from BTrees.OOBTree import OOBTree
+import docker.errors
+from persistent import Persistent
+import requests
 from deploylib.daemon.context import ctx
 from deploylib.daemon.controller import DeployError
 from deploylib.plugins import Plugin
 
 
+DEFAULT_SDUTIL_URL = 'https://sdutil.s3.amazonaws.com/sdutil.linux'
+
+
+class SdutilImages(Persistent):
+    """Maps (base image id, sdutil checksum) to the id of the image that
+    was built from the base image with sdutil inside; with several docker
+    hosts, the name of the host is part of the key.
+    """
+
+    @classmethod
+    def load(cls, db):
+        if not hasattr(db, 'sdutil_images'):
+            db.sdutil_images = SdutilImages()
+        return db.sdutil_images
+
+    def __init__(self):
+        self.images = OOBTree()
+
+
 class SdutilPlugin(Plugin):
 
+    def __init__(self):
+        # Checksums of the downloaded binaries, by path
+        self._checksums = {}
+
     def before_once(self, service, definition, runcfg):
         self._process(service, definition, runcfg, skip_register=True)
 
@@ -76,7 +111,10 @@ class SdutilPlugin(Plugin):
         # To prefix the command line with sdutil we need to know what
         # it is, and it might be encoded in the image only, not in the
         # service definition.
-        entrypoint, cmd = self.read_image_cmdline(runcfg['image'])
+        # With several docker hosts, the image needs to be on the one
+        # the container runs on.
+        backend = ctx.cintf.backend.host_backend(runcfg)
+        entrypoint, cmd = self.read_image_cmdline(backend, runcfg['image'])
 
         # The values declared in the image are more important though.
         if runcfg['entrypoint']:
@@ -94,7 +132,8 @@ class SdutilPlugin(Plugin):
 
         # Build a new image with the sdutil binary, or use existing path
         if not 'binary' in cfg:
-            runcfg['image'], binary = self.add_to_image(runcfg['image'])
+            runcfg['image'], binary = self.add_to_image(
+                backend, runcfg['image'], runcfg.get('host'))
         else:
             binary = cfg.get('binary', '/sdutil')
 
@@ -132,32 +171,92 @@ class SdutilPlugin(Plugin):
             runcfg['cmd'] = new_cmd[1:]
             runcfg['entrypoint'] = new_cmd[:1]
 
-    def read_image_cmdline(self, imgname):
+    def read_image_cmdline(self, backend, imgname):
         """Get Entrypoint and Cmd from image."""
-        docker = ctx.cintf.backend.client
-        ctx.cintf.backend.pull_image(imgname)
-        ctx.log('Inspecting image %s' % imgname)
-        image_info = docker.inspect_image(imgname)
-        entrypoint = image_info['config']['Entrypoint']
-        cmd = image_info['config']['Cmd']
+        image_info = backend.image_info(imgname)
+        entrypoint = image_info['entrypoint']
+        cmd = image_info['cmd']
         assert isinstance(cmd, list) or cmd is None
         assert isinstance(entrypoint, list) or entrypoint is None
         return entrypoint, cmd
 
-    def add_to_image(self, imgname):
-        """Builds a new docker image that contains sdutil.
+    def add_to_image(self, backend, imgname, host=None):
+        """Return a docker image based on ``imgname`` that contains sdutil,
+        building it with ``backend`` (on docker host ``host``) if
+        necessary.
         """
-        sdutil_url = os.environ.get(
-            'SDUTIL_URL', 'https://sdutil.s3.amazonaws.com/sdutil.linux')
-        docker = ctx.cintf.backend.client
-        ctx.job('Building version of %s with sdutil inside' % imgname)
-        newimg, output = docker.build(fileobj=BytesIO("""
-FROM {old_img}
-ADD {sdutil_url} /sdutil
-RUN chmod +x /sdutil
-""".format(old_img=imgname, sdutil_url=sdutil_url)))
+        binary, checksum = self.get_binary()
+        base_id = backend.image_info(imgname)['id'] or imgname
+        key = (base_id, checksum)
+        if host:
+            # Each host has its own build of the image
+            key += (host,)
+
+        known = SdutilImages.load(ctx.cintf.db).images
+        if key in known:
+            # Only ask whether it exists; image_info() would try to pull
+            # the id from the registry.
+            try:
+                backend.client.inspect_image(known[key])
+            except docker.errors.APIError:
+                # The image was removed from docker
+                del known[key]
+            else:
+                return known[key], '/sdutil'
 
+        ctx.job('Building version of %s with sdutil inside' % imgname)
+        newimg, output = backend.client.build(
+            fileobj=self._build_context(imgname, binary), custom_context=True)
         if not newimg:
             raise DeployError('Build failed: %s' % output)
 
+        known[key] = newimg
         return newimg, '/sdutil'
+
+    def _build_context(self, imgname, binary):
+        """Tar up a Dockerfile along with the sdutil binary."""
+        dockerfile = """
+FROM {old_img}
+ADD sdutil /sdutil
+RUN chmod +x /sdutil
+""".format(old_img=imgname)
+
+        context = BytesIO()
+        tar = tarfile.open(fileobj=context, mode='w')
+        info = tarfile.TarInfo('Dockerfile')
+        info.size = len(dockerfile)
+        info.mtime = time.time()
+        tar.addfile(info, BytesIO(dockerfile))
+        tar.add(binary, arcname='sdutil')
+        tar.close()
+        context.seek(0)
+        return context
+
+    def get_binary(self):
+        """Return the path to a local copy of the sdutil binary, and
+        its checksum.
+        """
+        sdutil_url = os.environ.get('SDUTIL_URL', DEFAULT_SDUTIL_URL)
+        filename = os.path.join(
+            ctx.cintf.cache('sdutil'), hashlib.sha1(sdutil_url).hexdigest())
+
+        if not os.path.exists(filename):
+            ctx.log('Downloading sdutil from %s' % sdutil_url)
+            self._checksums.pop(filename, None)
+            if os.path.exists(sdutil_url):
+                shutil.copyfile(sdutil_url, filename + '.tmp')
+            else:
+                try:
+                    response = requests.get(sdutil_url, stream=True)
+                    response.raise_for_status()
+                except requests.RequestException as e:
+                    raise DeployError('Cannot download sdutil: %s' % e)
+                with open(filename + '.tmp', 'wb') as f:
+                    for chunk in response.iter_content(64 * 1024):
+                        f.write(chunk)
+            os.rename(filename + '.tmp', filename)
+
+        if not filename in self._checksums:
+            with open(filename, 'rb') as f:
+                self._checksums[filename] = hashlib.sha256(f.read()).hexdigest()
+        return filename, self._checksums[filename]
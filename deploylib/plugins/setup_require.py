@@ -1,4 +1,6 @@
+import BTrees.OOBTree
 from deploylib.daemon.context import ctx
+from deploylib.daemon.controller import DeployError
 from deploylib.plugins import Plugin
 
 
@@ -10,6 +12,10 @@ def iterablify(obj):
     return (obj,)
 
 
+def get_requirements(definition):
+    return iterablify(definition['kwargs'].get('require')) or ()
+
+
 class RequiresPlugin(Plugin):
     """Supports a ``requires`` service key that will hold a service until
     the required service have been setup first.
@@ -21,6 +27,15 @@ class RequiresPlugin(Plugin):
     Once services have been added to a deployment for the first time, they
     will subsequently start in arbitrary order.
 
+    Held services are indexed by the requirements they are waiting for, so
+    when a service or resource becomes available, only the services that
+    wait for it need to be looked at. Those that are ready then are
+    released in waves: first all services that depended directly on the
+    requirement, then those that depended on the first wave, and so on.
+    The services within a wave do not depend on each other, so if the
+    controller interface is configured to set up services concurrently,
+    they are released in parallel.
+
     NOTE: This plugin should be one of the last ones, so that other plugins
     can use their own ``post_setup()``methods to post-process the containers
     before this plugin releases holds on their dependent services.
@@ -29,8 +44,7 @@ class RequiresPlugin(Plugin):
     priority = 20
 
     def setup(self, service, version):
-        definition = version.definition
-        requirements = iterablify(definition['kwargs'].get('require'))
+        requirements = get_requirements(version.definition)
         if not requirements:
             return
 
@@ -40,11 +54,24 @@ class RequiresPlugin(Plugin):
             service.hold(
                 'waiting for requirement(s): %s' % ', '.join(missing_deps),
                 version)
+            self.index_held(service.deployment, service.name, missing_deps)
+
+            cycle = self.find_cycle(service.deployment, service.name)
+            if cycle:
+                ctx.log('Dependency cycle, service will never be '
+                        'released: %s' % ' -> '.join(cycle))
             return True
 
         # Yes they are, go ahead
         return
 
+    def needs_serial_setup(self, deployment, definition):
+        """A hold is only released for services that are visible in the
+        transaction that provides the requirement, so services with
+        requirements cannot be set up concurrently.
+        """
+        return bool(definition['kwargs'].get('require'))
+
     def setup_resource(self, deployment, name, data):
         """Support holding back other resources via a require key as well.
         """
@@ -78,24 +105,172 @@ class RequiresPlugin(Plugin):
     def on_resource_changed(self, deployment, name, data):
         self.trigger_dependency(deployment, name)
 
-    def trigger_dependency(self, deployment, depname):
-        """Search for any service that has been held due to lack of the
-        given requirement.
+    def migrate_db(self, db):
+        """Build the index of held services for deployments from before
+        it existed.
         """
-        for existing_service in deployment.services.values():
-            if not existing_service.held:
+        for deployment in db.deployments.values():
+            if deployment.requires is not None:
                 continue
+            deployment.requires = BTrees.OOBTree.BTree()
+            # Where an earlier version kept it
+            if 'Requires' in deployment.data:
+                del deployment.data['Requires']
+            for service in deployment.services.values():
+                if service.held:
+                    missing_deps = self.check_deps(
+                        deployment,
+                        get_requirements(service.held_version.definition))
+                    self.index_held(deployment, service.name, missing_deps)
+
+    def index_held(self, deployment, name, requirements):
+        """Record that the held service ``name`` waits for the given
+        requirements, in ``deployment.requires``.
+        """
+        index = deployment.requires
+        for dep in requirements:
+            if not dep in index:
+                index[dep] = BTrees.OOBTree.TreeSet()
+            index[dep].add(name)
+
+    def find_cycle(self, deployment, name):
+        """Return the path of a dependency cycle starting at the held
+        service ``name``, if there is one.
+
+        The graph consists of the held services and the ``Exec`` resources
+        that have not run yet, each pointing to their requirements.
+        Anything else is available and thus cannot be part of a cycle.
+        """
+        def requirements_of(node):
+            if node in deployment.services:
+                service = deployment.services[node]
+                if service.held:
+                    return get_requirements(service.held_version.definition)
+                return ()
+            options = deployment.globals.get('Exec', {}).get(node)
+            if options and not deployment.get_resource(node):
+                return iterablify(options.get('require')) or ()
+            return ()
+
+        path, visited = [name], set()
+        stack = [iter(requirements_of(name))]
+        while stack:
+            dep = next(stack[-1], None)
+            if dep is None:
+                stack.pop()
+                path.pop()
+                continue
+            if dep == name:
+                return path + [dep]
+            if dep in visited:
+                continue
+            visited.add(dep)
+            path.append(dep)
+            stack.append(iter(requirements_of(dep)))
+
+    def ready_dependents(self, deployment, depname):
+        """Return the names of the held services waiting for ``depname``
+        which have all of their requirements now, and remove them from
+        the index.
+
+        Services still missing something are indexed under those
+        requirements instead.
+        """
+        index = deployment.requires
+        if not depname in index:
+            return []
+        waiting = list(index[depname])
+        del index[depname]
 
-            # See if the service has a require key (it may be held for
-            # other reasons).
-            version = existing_service.held_version
-            reqs = iterablify(version.definition['kwargs'].get('require'))
-            if not reqs:
+        ready = []
+        for name in waiting:
+            service = deployment.services.get(name)
+            # It may have been released, or held for a different reason
+            if not service or not service.held:
                 continue
+            reqs = get_requirements(service.held_version.definition)
+            if not depname in reqs:
+                continue
+
+            missing_deps = self.check_deps(deployment, reqs)
+            if missing_deps:
+                self.index_held(deployment, name, missing_deps)
+            else:
+                ready.append(name)
+        return ready
+
+    def trigger_dependency(self, deployment, depname):
+        """Release any service that has been held due to lack of the
+        given requirement.
+
+        The services released in turn make others available; rather than
+        recursing, those are collected by the outermost call, and released
+        as the next wave.
+        """
+        context = ctx._get_current_object()
+        if getattr(context, 'require_releasing', False):
+            # Released by an outer call, which also looks after the
+            # dependents of what we release.
+            return
+
+        waves = getattr(context, 'require_waves', None)
+        if waves is not None:
+            waves.append(depname)
+            return
+
+        context.require_waves = waves = [depname]
+        try:
+            while waves:
+                wave = []
+                for name in waves:
+                    wave.extend(self.ready_dependents(deployment, name))
+                del waves[:]
+                released = self.release(deployment, sorted(set(wave)))
+                waves.extend(released)
+        finally:
+            context.require_waves = None
+
+    def release(self, deployment, names):
+        """Set up the held services ``names``, which do not depend on each
+        other. Return those that are no longer held now.
+        """
+        cintf = ctx.cintf
+        serial, concurrent = [], {}
+        for name in names:
+            ctx.log('Dependencies for held service %s now available' % name)
+            if cintf.concurrency <= 1 or len(names) <= 1 or \
+                    self._needs_serial_release(deployment, name):
+                serial.append(name)
+            else:
+                concurrent[name] = self._release_job(deployment.id, name)
+
+        if concurrent:
+            errors, conflicts = cintf.run_parallel(concurrent, cintf.concurrency)
+            serial.extend(conflicts)
+            if errors:
+                raise DeployError(
+                    'Releasing failed for: %s' % ', '.join(sorted(errors)))
+
+        for name in serial:
+            service = deployment.services[name]
+            cintf.setup_version(service, service.held_version)
+
+        return [name for name in names
+                if not deployment.services[name].held]
+
+    def _needs_serial_release(self, deployment, name):
+        """Ask the other plugins whether the service may be set up
+        concurrently, now that its requirements are satisfied.
+        """
+        definition = deployment.services[name].held_version.definition
+        definition = dict(definition, kwargs=dict(definition['kwargs']))
+        definition['kwargs'].pop('require', None)
+        return ctx.cintf.run_plugins('needs_serial_setup', deployment, definition)
 
-            if depname in reqs:
-                # Attempt to setup this service now (which will recursively
-                # trigger this plugin again if there are complex deps).
-                print('Dependency for held service %s now available' %
-                      existing_service.name)
-                ctx.cintf.setup_version(existing_service, version)
+    def _release_job(self, deploy_id, name):
+        def job(cintf):
+            # Dependents are released by the caller once the wave is done.
+            ctx.require_releasing = True
+            service = cintf.db.deployments[deploy_id].services[name]
+            cintf.setup_version(service, service.held_version)
+        return job
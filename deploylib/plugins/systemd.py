@@ -0,0 +1,213 @@
+"""Run services using systemd; select with ``SUPERVISOR=systemd``.
+
+Each deployment gets a target, and each instance a service unit that is
+part of it, so you'll be able to say::
+
+    systemctl stop my-deployment.target
+
+The targets are wanted by ``docker-deploy.target``; have your base
+system start that once it is ready.
+
+Unit files are written to ``SYSTEMD_DIR`` (``/etc/systemd/system``).
+systemd only sees them after a ``daemon-reload``, which takes a while
+with many units; rather than for every instance, it is done once when
+the work for a request has been committed (see
+:meth:`SystemdBackend.flush`), and the new units are then started
+together.
+
+With ``SYSTEMD_TRANSIENT=1``, no files are written; instances are run
+as transient units via ``systemd-run`` instead, which does not need a
+reload. Those do not survive a reboot of the host, though, so the
+deployment target will not bring them back.
+
+The ``systemctl`` and ``systemd-run`` binaries can be replaced by
+setting ``SYSTEMCTL`` and ``SYSTEMD_RUN``.
+"""
+
+import os
+import weakref
+from subprocess import check_output, CalledProcessError, STDOUT
+from deploylib.daemon.backend import DockerOnlyBackend
+from deploylib.daemon.context import ctx
+from deploylib.plugins import Plugin
+
+
+SERVICE_TEMPLATE = """[Unit]
+Description={name}
+PartOf={deployment}.target
+After=docker.service
+Requires=docker.service
+
+[Service]
+ExecStart=/usr/bin/docker start -a {name}
+ExecStop=/usr/bin/docker stop {name}
+Restart=always
+
+[Install]
+WantedBy={deployment}.target
+"""
+
+TARGET_TEMPLATE = """[Unit]
+Description={name}
+PartOf=docker-deploy.target
+
+[Install]
+WantedBy=docker-deploy.target
+"""
+
+
+def unit_dir():
+    return os.environ.get('SYSTEMD_DIR', '/etc/systemd/system')
+
+
+def write_unit(name, template, wanted_by=None, **kwargs):
+    """Write a unit file; if ``wanted_by`` is given, also enable it
+    for that target, the same way ``systemctl enable`` would.
+    """
+    filename = os.path.join(unit_dir(), name)
+    with open(filename, 'w') as f:
+        f.write(template.format(name=name.rsplit('.', 1)[0], **kwargs))
+
+    if wanted_by:
+        wants = os.path.join(unit_dir(), '%s.wants' % wanted_by)
+        if not os.path.exists(wants):
+            os.makedirs(wants)
+        link = os.path.join(wants, name)
+        if not os.path.lexists(link):
+            os.symlink(filename, link)
+
+
+def rm_unit(name, wanted_by=None):
+    paths = [os.path.join(unit_dir(), name)]
+    if wanted_by:
+        paths.append(os.path.join(unit_dir(), '%s.wants' % wanted_by, name))
+    for filename in paths:
+        if os.path.lexists(filename):
+            os.unlink(filename)
+
+
+class Systemctl(object):
+    """Runs ``systemctl`` (without a shell)."""
+
+    def __init__(self, environ=os.environ):
+        self.systemctl = environ.get('SYSTEMCTL', 'systemctl')
+        self.systemd_run = environ.get('SYSTEMD_RUN', 'systemd-run')
+
+    def __call__(self, *args):
+        return check_output((self.systemctl,) + args, stderr=STDOUT)
+
+    def is_active(self, unit):
+        try:
+            self('is-active', unit)
+        except CalledProcessError:
+            return False
+        return True
+
+    def run(self, unit, command, properties=()):
+        args = [self.systemd_run, '--unit=%s' % unit]
+        args.extend('--property=%s' % p for p in properties)
+        return check_output(args + list(command), stderr=STDOUT)
+
+
+class SystemdBackend(DockerOnlyBackend):
+    """Create systemd units along with docker containers.
+    """
+
+    # The units have Restart=always
+    supervised = True
+
+    def __init__(self, docker_url, systemctl=None, transient=None):
+        DockerOnlyBackend.__init__(self, docker_url)
+        self.systemctl = systemctl or Systemctl()
+        if transient is None:
+            transient = os.environ.get('SYSTEMD_TRANSIENT') == '1'
+        self.transient = transient
+
+        # Per controller interface, that is, per request: whether unit
+        # files have changed, and the units to start after the reload.
+        self._pending = weakref.WeakKeyDictionary()
+
+    def _changes(self):
+        return self._pending.setdefault(
+            ctx.cintf, {'reload': False, 'start': []})
+
+    def files_changed(self):
+        """A daemon-reload is needed once the request is done."""
+        self._changes()['reload'] = True
+
+    def start(self, runcfg, service, instance_id):
+        # First start the container manually via docker; this acts as
+        # validation; if it fails, don't bother creating the unit. The
+        # unit will attach to the running container.
+        result = DockerOnlyBackend.start(self, runcfg, service, instance_id)
+
+        name = runcfg['name']
+        deployment = service.deployment.id
+        if self.transient:
+            self.systemctl.run(
+                '%s.service' % name, ['/usr/bin/docker', 'start', '-a', name],
+                properties=['PartOf=%s.target' % deployment,
+                            'Restart=always',
+                            'ExecStop=/usr/bin/docker stop %s' % name])
+        else:
+            write_unit('%s.service' % name, SERVICE_TEMPLATE,
+                       wanted_by='%s.target' % deployment,
+                       deployment=deployment)
+            changes = self._changes()
+            changes['reload'] = True
+            changes['start'].append('%s.service' % name)
+
+        return result
+
+    def terminate(self, (instance_id, name), host=None):
+        unit = '%s.service' % name
+        pending = self._changes()['start']
+        if unit in pending:
+            pending.remove(unit)
+
+        # Stop the unit first, or systemd would restart the container.
+        elif self.systemctl.is_active(unit):
+            self.systemctl('stop', unit)
+
+        # Make sure ourselves that the container is stopped.
+        self.stop_container(instance_id)
+
+        if not self.transient:
+            # The unit's target is in the file we are about to remove.
+            target = None
+            filename = os.path.join(unit_dir(), unit)
+            if os.path.exists(filename):
+                with open(filename) as f:
+                    for line in f:
+                        if line.startswith('WantedBy='):
+                            target = line.strip().split('=', 1)[1]
+            rm_unit(unit, wanted_by=target)
+            self.files_changed()
+
+    def flush(self, cintf):
+        """Reload the unit files if they changed, and start the new
+        units; once for all the instances ``cintf`` started.
+        """
+        changes = self._pending.pop(cintf, None)
+        if not changes:
+            return
+        if changes['reload']:
+            self.systemctl('daemon-reload')
+        if changes['start']:
+            self.systemctl('start', *changes['start'])
+
+
+class SystemdPlugin(Plugin):
+
+    def on_create_deployment(self, deployment):
+        """A target that the units of all the services in this deployment
+        are part of.
+        """
+        if not deployment.id:
+            # The system deployment.
+            return
+        if not isinstance(ctx.cintf.backend, SystemdBackend):
+            return
+        write_unit('%s.target' % deployment.id, TARGET_TEMPLATE,
+                   wanted_by='docker-deploy.target')
+        ctx.cintf.backend.files_changed()
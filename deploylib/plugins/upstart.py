@@ -13,9 +13,11 @@ And all the service instances within that deployment will come up.
 """
 
 import os
-import time
-from subprocess import check_output, CalledProcessError
+from subprocess import check_output, CalledProcessError, STDOUT
+import gevent
 from deploylib.daemon.backend import DockerOnlyBackend
+from deploylib.daemon.context import ctx
+from deploylib.daemon.controller import DeployError
 from deploylib.plugins import Plugin
 
 
@@ -33,10 +35,129 @@ def rm_upstart_conf(name):
         os.unlink(filename)
 
 
+class InitctlControl(object):
+    """Controls upstart jobs by running ``initctl`` (without a shell).
+    """
+
+    def status(self, name):
+        """Return True if the job is running, False if not, and None if
+        upstart does not know it.
+        """
+        try:
+            output = check_output(['initctl', 'status', name], stderr=STDOUT)
+        except CalledProcessError:
+            return None
+        return 'start/running' in output
+
+    def start(self, name):
+        check_output(['initctl', 'start', name])
+
+    def stop(self, name):
+        check_output(['initctl', 'stop', name])
+
+
+class DBusControl(object):
+    """Controls upstart jobs via its D-Bus interface, over a connection
+    we keep open; by default upstart's private socket, which only root
+    can use.
+
+    Needs the ``dbus`` module. Its calls block, so they are made in the
+    threadpool of the hub; upstart is asked to reply once the job has
+    started or stopped, rather than being polled.
+    """
+
+    SERVICE = 'com.ubuntu.Upstart'
+    PATH = '/com/ubuntu/Upstart'
+    INTERFACE = 'com.ubuntu.Upstart0_6'
+
+    def __init__(self, address='unix:abstract=/com/ubuntu/upstart'):
+        import dbus
+        self.dbus = dbus
+        if address:
+            self.bus = dbus.connection.Connection(address)
+            self.bus_name = None
+        else:
+            self.bus = dbus.SystemBus()
+            self.bus_name = self.SERVICE
+        self.upstart = dbus.Interface(
+            self.bus.get_object(self.bus_name, self.PATH), self.INTERFACE)
+
+    def _in_thread(self, func, *args):
+        return gevent.get_hub().threadpool.apply(func, args)
+
+    def _job(self, name, reload=True):
+        try:
+            path = self.upstart.GetJobByName(name)
+        except self.dbus.DBusException:
+            if not reload:
+                return None
+            # The job file might be too new for upstart to have seen it.
+            self.upstart.ReloadConfiguration()
+            return self._job(name, reload=False)
+        return self.dbus.Interface(
+            self.bus.get_object(self.bus_name, path), self.INTERFACE + '.Job')
+
+    def _status(self, name):
+        job = self._job(name)
+        if job is None:
+            return None
+        for path in job.GetAllInstances():
+            state = self.bus.get_object(self.bus_name, path).Get(
+                self.INTERFACE + '.Instance', 'state',
+                dbus_interface='org.freedesktop.DBus.Properties')
+            if state == 'running':
+                return True
+        return False
+
+    def _change(self, name, method, timeout):
+        try:
+            getattr(self._job(name), method)(
+                self.dbus.Array([], 's'), True, timeout=timeout)
+        except self.dbus.DBusException as e:
+            raise DeployError('upstart did not %s %s: %s' % (
+                method.lower(), name, e))
+
+    def status(self, name):
+        return self._in_thread(self._status, name)
+
+    def start(self, name, timeout=30):
+        self._in_thread(self._change, name, 'Start', timeout)
+
+    def stop(self, name, timeout=30):
+        self._in_thread(self._change, name, 'Stop', timeout)
+
+
+def upstart_control(environ=os.environ):
+    """Return the way to control upstart, as selected by the
+    ``UPSTART_CONTROL`` environment variable: ``dbus``, ``initctl``, or
+    by default, D-Bus if available.
+    """
+    mode = environ.get('UPSTART_CONTROL', 'auto')
+    if mode == 'initctl':
+        return InitctlControl()
+    try:
+        return DBusControl(environ.get('UPSTART_DBUS_ADDRESS',
+                                       'unix:abstract=/com/ubuntu/upstart'))
+    except Exception as e:
+        if mode == 'dbus':
+            raise
+        print "Cannot talk to upstart via D-Bus, using initctl: %s" % e
+        return InitctlControl()
+
+
 class UpstartBackend(DockerOnlyBackend):
     """Create upstart files along with docker containers.
     """
 
+    # The jobs respawn the containers
+    supervised = True
+
+    def __init__(self, docker_url, control=None):
+        DockerOnlyBackend.__init__(self, docker_url)
+        # Chosen as the daemon starts, so it says once how it talks to
+        # upstart.
+        self.upstart = control or upstart_control()
+
     def start(self, runcfg, service, instance_id):
         # First start the container manually via docker; this acts as
         # validation; if it fails, don't bother writing the initscript.
@@ -47,43 +168,25 @@ class UpstartBackend(DockerOnlyBackend):
 
         # Ask upstart to start the service; it will attach to the
         # manually started container.
-        output = check_output('initctl status %s' % runcfg['name'], shell=True)
-        if not 'start/running' in output:
-            check_output('initctl start %s' % runcfg['name'], shell=True)
+        if not self.upstart.status(runcfg['name']):
+            self.upstart.start(runcfg['name'])
 
         return result
 
-    def terminate(self, (instance_id, name)):
+    def terminate(self, (instance_id, name), host=None):
         # First, stop the service; removing the initscript is not enough
-        # it seems to stop it from restarting.
-        try:
-            output = check_output('initctl status %s' % name, shell=True)
-        except CalledProcessError:
-            # It is possible that a previous deploy failed mid-stream.
-            pass
-        else:
-            # If the service is not running, "initctl stop" will return
-            # a failure, so skip the call in that case.
-            if not 'stop/waiting' in output:
-                check_output('initctl stop %s' % name, shell=True)
+        # it seems to stop it from restarting. A failed previous deploy
+        # might not have gotten as far as creating it.
+        if self.upstart.status(name):
+            self.upstart.stop(name)
 
-        # We cannot trust initctl to stop the container, verity ourselves
-        # that it did indeed happen.
-        try:
-            check_output('docker stop %s' % name, shell=True)
-        except Exception, e:
-            print(e)
+        # We cannot trust upstart to stop the container, make sure
+        # ourselves that it did indeed happen.
+        self.stop_container(instance_id)
 
         # Finally  remove the service file.
         rm_upstart_conf(name)
 
-        # Sometimes, especially with new docker versions, we see
-        # "port already bound" messages if we do a quick stop/start
-        # succession. This is supposed to help, though maybe we want
-        # to connect to the docker API (or check initctl) to ensure
-        # the service has really ended.
-        time.sleep(1)
-
     def write_upstart_for_service(self, deployment, runcfg):
         # Upstart file for an individual service. Linked to start
         # alongside abstract service for the whole deployment.
@@ -110,6 +213,8 @@ class UpstartPlugin(Plugin):
         if not deployment.id:
             # The system deployment.
             return
+        if not isinstance(ctx.cintf.backend, UpstartBackend):
+            return
         template = """
 description "{name}"
 author "docker-deploy"
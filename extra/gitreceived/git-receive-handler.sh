@@ -14,21 +14,22 @@ controller=$(get_controller_ip) || exit 1
 result=$(http_request GET http://$controller/gitreceive/check-repo $AUTH name=="$1") || exit 1
 [ "$result" == "ok" ] || exit 1
 
-# Upload the data
-# I don't know how to make httpie do a form upload with data from stdin,
-# so save it to a temporary file first.
+# The tree lets the controller reuse a slug built from the same code.
+tree=$(git rev-parse "$commit^{tree}" 2>/dev/null)
+
+# Upload the data, streaming it as git produces it.
 md5=$(echo $repo | md5sum | awk '{ print $1 }')
-tmpfile=/tmp/pushed-$md5-$(date -u +\%Y\%m\%dt\%H\%M\%S)
 logfile=/tmp/log-$md5-$(date -u +\%Y\%m\%dt\%H\%M\%S)
 function cleanup {
-  rm -f $tmpfile
   rm -f $logfile
 }
 trap cleanup EXIT
 
+# httpie reads all of stdin before sending it, so use curl here:
 # https://github.com/jakubroztocil/httpie/issues/230
-cat - > $tmpfile
-http --ignore-stdin --timeout 3600 --check-status --follow --stream -f POST http://$controller/gitreceive/push-data $AUTH name=="$repo" version=="$commit" tarball@$tmpfile 2>&1 | tee $logfile
+curl --silent --show-error --fail --no-buffer --max-time 3600 --location \
+    -X POST -T - -H "Transfer-Encoding: chunked" -H "$AUTH" \
+    "http://$controller/gitreceive/push-data?name=$repo&version=$commit&tree=$tree" 2>&1 | tee $logfile
 # Musn't accept on timeout
 if ((${PIPESTATUS[0]} > 0)); then
     exit 1
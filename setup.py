@@ -22,7 +22,7 @@ setup(
         'netifaces>=0.10',
         'requests==2.20.0',
         'pyyaml>=3.11',
-        'gevent>=0.6.1',
+        'gevent>=20.12',
         'clint>=0.3.7',
         'transaction>=1.4.3',
         'ZODB>=4.0.0',
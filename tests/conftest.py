@@ -16,15 +16,17 @@ def controller(request, tmpdir):
         plugins=getattr(request.module, "controller_plugins", []))
 
     # Test version of discovery client
-    controller.discover = lambda s: s
+    controller.discover = lambda s, durable=False: s
 
     # By default we mock the whole backend. However, the test module
     # can disable this.
     if getattr(request.module, "mock_backend", True):
         controller.backend = mock.Mock()
+        controller.backend.supervised = False
         controller.backend.prepare.return_value = 'abc'
         controller.backend.start.return_value = 'abc'
         controller.backend.once.return_value = 0
+        controller.backend.host_backend.return_value = controller.backend
         mock_backend_docker(controller)
 
     def close():
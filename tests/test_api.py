@@ -1,4 +1,5 @@
 import json
+import transaction
 from deploylib.daemon.api import create_app
 
 
@@ -17,3 +18,105 @@ class TestApi(object):
 
             assert 'error' in json.loads(rep.get_data().splitlines()[0])
 
+    def test_parallel_setup(self, controller, cintf):
+        cintf.create_deployment('foo')
+        transaction.commit()
+
+        app = create_app(controller)
+        with app.test_client() as c:
+            rep = c.post('/setup', content_type="application/json", data=json.dumps({
+                'deploy_id': 'foo',
+                'services': {'a': {}, 'b': {}, 'c': {}},
+                'globals': {},
+                'force': False,
+                'parallel': 2,
+            }))
+            events = [json.loads(l) for l in rep.get_data().splitlines()]
+
+        assert not [e for e in events if 'error' in e]
+        assert len([e for e in events if 'job' in e]) == 3
+        assert len(controller.backend.start.mock_calls) == 3
+
+        with controller.interface() as cintf:
+            services = cintf.db.deployments['foo'].services
+            assert sorted(services.keys()) == ['a', 'b', 'c']
+            assert all(len(s.versions) == 1 for s in services.values())
+
+    def test_read_only(self, controller, cintf):
+        """Read-only views do not commit a transaction."""
+        cintf.create_deployment('foo')
+        transaction.commit()
+        last = controller._zodb_storage.lastTransaction()
+
+        app = create_app(controller)
+        with app.test_client() as c:
+            rep = c.get('/list')
+            assert 'foo' in json.loads(rep.get_data())
+        assert controller._zodb_storage.lastTransaction() == last
+
+        with app.test_client() as c:
+            c.put('/create', content_type="application/json",
+                  data=json.dumps({'deploy_id': 'bar'}))
+        assert controller._zodb_storage.lastTransaction() != last
+
+    def test_trace(self, controller, cintf):
+        """The timing spans of a setup are streamed, and stored with the
+        deployment."""
+        cintf.create_deployment('foo')
+        transaction.commit()
+
+        app = create_app(controller)
+        with app.test_client() as c:
+            rep = c.post('/setup', content_type="application/json", data=json.dumps({
+                'deploy_id': 'foo',
+                'services': {'a': {}},
+                'globals': {},
+                'force': False,
+            }))
+            events = [json.loads(l) for l in rep.get_data().splitlines()]
+        streamed = [e['span'] for e in events if 'span' in e]
+        assert 'canonicalize' in streamed
+        assert 'create' in streamed
+        assert 'start' in streamed
+        assert 'commit' in streamed
+
+        with app.test_client() as c:
+            rep = c.get('/trace', query_string={'deploy_id': 'foo'})
+            traces = json.loads(rep.get_data())['traces']
+        assert len(traces) == 1
+        assert [s['span'] for s in traces[0]['spans']] == streamed
+
+    def test_flush(self, controller, cintf):
+        """The backend applies its changes once they are committed, and
+        not if the request failed.
+        """
+        cintf.create_deployment('foo')
+        transaction.commit()
+        storage = controller._zodb_storage
+        flushed = []
+        controller.backend.flush.side_effect = \
+            lambda cintf: flushed.append(storage.lastTransaction())
+
+        def setup(name):
+            with create_app(controller).test_client() as c:
+                rep = c.post('/setup', content_type="application/json",
+                             data=json.dumps({'deploy_id': 'foo',
+                                              'services': {name: {}},
+                                              'globals': {},
+                                              'force': False}))
+                # Waits for the request to be done
+                return rep.get_data()
+
+        before = storage.lastTransaction()
+        setup('a')
+        assert len(flushed) == 1 and flushed[0] != before
+
+        controller.backend.start.side_effect = Exception('no space left')
+        assert 'no space left' in setup('b')
+        assert len(flushed) == 1
+
+    def test_build_cache(self, controller):
+        app = create_app(controller)
+        with app.test_client() as c:
+            stats = json.loads(c.get('/build-cache').get_data())
+        assert stats['hits'] == stats['misses'] == stats['size'] == 0
@@ -0,0 +1,55 @@
+import docker.errors
+import mock
+from deploylib.daemon.backend import DockerOnlyBackend
+
+
+def make_backend():
+    backend = DockerOnlyBackend(None)
+    backend.client = mock.Mock()
+    backend.client.inspect_image.return_value = {
+        'id': 'abc', 'config': {
+            'Entrypoint': ['/entry'], 'Cmd': None,
+            'ExposedPorts': {'80/tcp': {}}}}
+    return backend
+
+
+class TestImageCache(object):
+
+    def test_cached(self):
+        backend = make_backend()
+        info = backend.image_info('foo')
+        assert info == {'id': 'abc', 'entrypoint': ['/entry'], 'cmd': None,
+                        'ports': ['80/tcp']}
+
+        # Docker is only asked once, the implicit tag is recognized.
+        assert backend.image_info('foo:latest') == info
+        assert len(backend.client.inspect_image.mock_calls) == 1
+
+    def test_pull_missing(self):
+        backend = make_backend()
+        backend.client.inspect_image.side_effect = [
+            docker.errors.APIError('missing', mock.Mock()), {'id': 'abc'}]
+        backend.image_info('foo')
+        assert backend.client.pull.mock_calls == [mock.call('foo')]
+
+    def test_invalidate_on_event(self):
+        backend = make_backend()
+        backend.image_info('foo')
+        backend.image_info('bar')
+
+        backend.handle_event({'status': 'pull', 'id': 'foo:latest'})
+        backend.image_info('foo')
+        assert len(backend.client.inspect_image.mock_calls) == 3
+
+        # Events may also refer to the image id
+        backend.handle_event({'status': 'untag', 'id': 'abc'})
+        backend.image_info('foo')
+        backend.image_info('bar')
+        assert len(backend.client.inspect_image.mock_calls) == 5
+
+    def test_prefetch(self):
+        backend = make_backend()
+        backend.prefetch(['foo', 'foo', 'bar'])
+        backend.image_info('foo')
+        backend.image_info('bar')
+        assert len(backend.client.inspect_image.mock_calls) == 2
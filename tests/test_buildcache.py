@@ -0,0 +1,121 @@
+import os
+import shutil
+import gevent
+from gevent.monkey import get_original
+import mock
+from deploylib.daemon.buildcache import BuildCache
+
+
+def fill(directory, size):
+    with open(os.path.join(directory, 'data'), 'wb') as f:
+        f.write('x' * size)
+
+
+class TestBuildCache(object):
+
+    def test_hits(self, tmpdir):
+        cache = BuildCache(tmpdir.strpath)
+        with cache.use('a') as directory:
+            fill(directory, 10)
+        with cache.use('a') as again:
+            assert again == directory
+        # Nothing was put into b
+        with cache.use('b'):
+            pass
+        with cache.use('b'):
+            pass
+        assert cache.stats == {'hits': 1, 'misses': 3, 'evictions': 0}
+        assert cache.as_dict()['size'] == 10
+
+    def test_evict_least_recently_used(self, tmpdir):
+        cache = BuildCache(tmpdir.strpath, budget=25)
+        for key in ('a', 'b'):
+            with cache.use(key) as directory:
+                fill(directory, 10)
+            os.utime(directory, (1000, 1000) if key == 'a' else (2000, 2000))
+        with cache.use('a'):
+            pass
+
+        with cache.use('c') as directory:
+            fill(directory, 10)
+        assert sorted(os.listdir(tmpdir.strpath)) == ['a', 'c']
+        assert cache.stats['evictions'] == 1
+        assert cache.size() == 20
+
+    def test_existing_directories(self, tmpdir):
+        """After a restart, the directories on disk count."""
+        tmpdir.mkdir('old').join('data').write('x' * 30)
+        cache = BuildCache(tmpdir.strpath, budget=25)
+        with cache.use('new') as directory:
+            fill(directory, 10)
+        assert os.listdir(tmpdir.strpath) == ['new']
+
+    def test_measure_in_thread(self, tmpdir):
+        """The disk is not walked on the hub."""
+        get_ident = get_original('thread', 'get_ident')
+        threads = []
+
+        def disk_usage(directory):
+            threads.append(get_ident())
+            return 0
+
+        cache = BuildCache(tmpdir.strpath)
+        with mock.patch('deploylib.daemon.buildcache.disk_usage',
+                        side_effect=disk_usage):
+            with cache.use('a'):
+                pass
+        assert threads and get_ident() not in threads
+
+    def test_in_use(self, tmpdir):
+        """A directory is used by one build at a time, and not evicted
+        while it is.
+        """
+        cache = BuildCache(tmpdir.strpath, budget=5)
+        order = []
+
+        def build(key, name):
+            with cache.use(key) as directory:
+                order.append('start %s' % name)
+                fill(directory, 10)
+                gevent.sleep(0.01)
+                order.append('end %s' % name)
+
+        gevent.joinall([gevent.spawn(build, 'a', 1),
+                        gevent.spawn(build, 'a', 2),
+                        gevent.spawn(build, 'b', 3)])
+        assert order.index('end 1') < order.index('start 2')
+        # The last build to finish evicted the other one
+        assert len(os.listdir(tmpdir.strpath)) == 1
+
+    def test_use_while_evicted(self, tmpdir):
+        """A build that wants a directory being removed waits for that,
+        and uses the same lock as everybody else."""
+        cache = BuildCache(tmpdir.strpath, budget=5)
+        with cache.use('a') as directory:
+            fill(directory, 10)
+        lock = cache.locks['a']
+
+        rmtree, sleep = shutil.rmtree, get_original('time', 'sleep')
+
+        def slow_rmtree(*args):
+            sleep(0.05)
+            rmtree(*args)
+
+        with mock.patch('deploylib.daemon.buildcache.shutil.rmtree',
+                        side_effect=slow_rmtree):
+            evicting = gevent.spawn(cache.evict)
+            gevent.sleep(0.01)
+            with cache.use('a') as directory:
+                # Removed before we got it, and created anew
+                assert os.listdir(directory) == []
+            evicting.join()
+        assert cache.locks['a'] is lock
+        assert cache.stats['evictions'] == 1
+
+    def test_legacy(self, tmpdir):
+        legacy = tmpdir.mkdir('slugbuilder')
+        legacy.mkdir('foo').join('data').write('x')
+        cache = BuildCache(tmpdir.join('builds').strpath,
+                           legacy=[legacy.strpath])
+        assert cache.size() == 0
+        assert not legacy.exists()
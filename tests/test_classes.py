@@ -1,3 +1,4 @@
+import gevent
 from deploylib.daemon.controller import canonical_definition
 
 
@@ -17,3 +18,50 @@ class TestServiceDef(object):
         _, d = canonical_definition('foo', {'image': 'bar'})
         assert not d['kwargs']
 
+
+
+class TestSpans(object):
+
+    def test_nesting(self):
+        from deploylib.daemon.context import Context
+        context = Context(None)
+        with context.span('outer', service='foo'):
+            with context.span('inner'):
+                pass
+
+        inner, outer = context.spans
+        assert (inner['span'], inner['depth']) == ('inner', 1)
+        assert (outer['span'], outer['depth']) == ('outer', 0)
+        assert outer['service'] == 'foo'
+        assert outer['duration'] >= inner['duration']
+        assert context.queue.get() == inner
+
+    def test_min_duration(self):
+        from deploylib.daemon.context import Context
+        context = Context(None)
+        with context.span('quick', min_duration=10):
+            pass
+        with context.span('slow', min_duration=0.001):
+            gevent.sleep(0.002)
+        assert [s['span'] for s in context.spans] == ['slow']
+
+    def test_printer(self):
+        """The CLI does not choke on span events."""
+        from deploylib.client.cli import print_jobs, print_waterfall
+        span = {'span': 'start', 'start': 0, 'duration': 1, 'depth': 0}
+        print_jobs([span])
+        print_waterfall([span, dict(span, start=0.5, depth=1)])
+
+
+class TestTraces(object):
+
+    def test_keep_recent(self):
+        from deploylib.daemon.db import Deployment
+        deployment = Deployment('foo')
+        deployment.keep_traces = 2
+        for started in (3, 1, 2, 2):
+            deployment.add_trace(started, [{'span': str(started)}])
+
+        traces = deployment.recent_traces()
+        assert [t['spans'][0]['span'] for t in traces] == ['2', '3']
+        assert traces[0]['started'] > 2
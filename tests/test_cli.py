@@ -0,0 +1,99 @@
+import threading
+import click
+import mock
+import pytest
+from deploylib.client.cli import upload_all, with_printer
+
+
+@pytest.fixture
+def output(request):
+    """The lines printed via clint."""
+    lines = []
+    patcher = mock.patch('deploylib.client.cli.puts',
+                         side_effect=lambda s: lines.append(str(s)))
+    patcher.start()
+    request.addfinalizer(patcher.stop)
+    return lines
+
+
+class FakeApp(object):
+
+    def __init__(self, fail=(), provide=None):
+        self.fail = fail
+        self.provide = provide or (
+            lambda service: (['code of %s' % service], {'version': 1}))
+        self.api = mock.Mock()
+        self.api.upload.side_effect = self.upload
+        # Both uploads are only done once they ran at the same time
+        self.barrier = threading.Semaphore(0)
+        self.running = []
+
+    def run_plugins(self, method_name, service, tag, negotiate):
+        assert method_name == 'provide_data'
+        return {'app': self.provide(service)}
+
+    def upload(self, deploy_id, service_name, name, body, data=None):
+        if service_name in self.fail:
+            raise ValueError('no space left')
+        self.running.append(service_name)
+        if len(self.running) == 2:
+            self.barrier.release()
+        self.barrier.acquire()
+        self.barrier.release()
+        return [{'job': 'building %s' % service_name},
+                {'log': 'done\nreally'}]
+
+
+class TestUploadAll(object):
+
+    services = {'web': 'web', 'worker': 'worker'}
+    requests = [{'data-request': 'web', 'tag': 'git'},
+                {'data-request': 'worker', 'tag': 'git'}]
+
+    def test_parallel(self, output):
+        app = FakeApp()
+        upload_all(app, 'foo', mock.Mock(services=self.services),
+                   self.requests, workers=2)
+
+        assert sorted(c[1][1] for c in app.api.upload.mock_calls) == \
+               ['web', 'worker']
+        lines = output
+        assert 'web    | -----> building web' in lines
+        assert 'worker | -----> building worker' in lines
+        assert lines.count('web    |        really') == 1
+
+    def test_failure(self, output):
+        """The other uploads go ahead; failures are reported at the end.
+        """
+        app = FakeApp(fail=['web'])
+        app.barrier.release()
+        with pytest.raises(click.ClickException) as e:
+            upload_all(app, 'foo', mock.Mock(services=self.services),
+                       self.requests, workers=2)
+        assert 'web (no space left)' in e.value.message
+        assert app.running == ['worker']
+
+    def test_single(self, output):
+        """One upload at a time: output as it used to be."""
+        app = FakeApp()
+        app.barrier.release()
+        upload_all(app, 'foo', mock.Mock(services=self.services),
+                   self.requests[:1], workers=1)
+        lines = output
+        assert lines[1:] == ['-----> building web', '       done',
+                             '       really']
+
+    def test_nothing_to_send(self, output):
+        """The server has the code already."""
+        app = FakeApp(provide=lambda service: ('', {'format': 'none'}))
+        app.barrier.release()
+        upload_all(app, 'foo', mock.Mock(services=self.services),
+                   self.requests[:1], workers=1)
+        [call] = app.api.upload.mock_calls
+        assert call[1][3] == ''
+
+
+def test_printer_passes_unknown_events(output):
+    events = list(with_printer([{'error': 'bad'}, {'foo': 1}], prefix='a | '))
+    assert events == [{'foo': 1}]
+    assert 'a |        Error: bad' in output
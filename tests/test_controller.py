@@ -0,0 +1,267 @@
+import socket
+import gevent
+import pytest
+from ZODB.POSException import ConflictError
+from deploylib.daemon.controller import DeployError, check_ready
+
+
+controller_plugins = []
+
+
+def backend_calls(cintf):
+    return [c[0] for c in cintf.backend.mock_calls
+            if c[0] in ('prepare', 'start', 'terminate')]
+
+
+class TestRollout(object):
+
+    def test_stop_first(self, cintf):
+        """By default, the old instance is stopped before the new one
+        is started."""
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        cintf.set_service('foo', 'bar', {}, force=True)
+
+        assert backend_calls(cintf) == [
+            'prepare', 'start', 'prepare', 'terminate', 'start']
+        assert len(cintf.db.deployments['foo'].services['bar'].instances) == 1
+
+    def test_start_first(self, cintf):
+        cintf.create_deployment('foo')
+        definition = {'rollout': {'strategy': 'start-first', 'check': 'none'}}
+        cintf.set_service('foo', 'bar', definition)
+        cintf.set_service('foo', 'bar', definition, force=True)
+
+        assert backend_calls(cintf) == [
+            'prepare', 'start', 'prepare', 'start', 'terminate']
+        service = cintf.db.deployments['foo'].services['bar']
+        assert len(service.instances) == 1
+        assert len(service.versions) == 2
+
+    def test_start_first_not_ready(self, cintf):
+        """If the new instance does not become ready, the old one is
+        kept running."""
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+
+        with pytest.raises(DeployError):
+            cintf.set_service('foo', 'bar', {
+                'rollout': {'strategy': 'start-first', 'check': 'tcp',
+                            'timeout': 0}})
+
+        service = cintf.db.deployments['foo'].services['bar']
+        assert len(service.instances) == 1
+        assert len(service.versions) == 1
+        assert backend_calls(cintf)[-1] == 'terminate'
+
+    def test_start_first_needs_check(self, cintf):
+        cintf.create_deployment('foo')
+        with pytest.raises(DeployError):
+            cintf.set_service('foo', 'bar', {'rollout': 'start-first'})
+        assert backend_calls(cintf) == []
+
+    def test_proxy_accepts_before_app(self):
+        """Like docker's userland proxy, something accepts connections
+        and closes them right away; only the http check sees that the app
+        is not ready."""
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        port = listener.getsockname()[1]
+
+        def proxy():
+            while True:
+                listener.accept()[0].close()
+        server = gevent.spawn(proxy)
+        try:
+            assert check_ready('127.0.0.1', port, 'tcp')
+            assert not check_ready('127.0.0.1', port, 'http')
+        finally:
+            server.kill()
+            listener.close()
+
+
+class TestVersions(object):
+
+    def test_shared_definition(self, cintf):
+        """Identical definitions and globals are only stored once."""
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        cintf.set_service('foo', 'bar', {}, force=True)
+
+        deployment = cintf.db.deployments['foo']
+        v1, v2 = deployment.services['bar'].versions
+        assert v1._definition is v2._definition
+        assert v1._globals is v2._globals
+        assert v1.definition == v2.definition
+        assert len(deployment.shared) == 2
+
+    def test_content_key(self):
+        from deploylib.daemon.db import content_key
+        assert content_key({'a': 1, 'b': 2}) == content_key({'b': 2, 'a': 1})
+        assert content_key({1: 'x'}) != content_key({'1': 'x'})
+        assert content_key({('tcp', 80): 1}) != content_key({"('tcp', 80)": 1})
+        assert content_key({('tcp', 80): 1}) != content_key({'a': 1}) != \
+            content_key([['a', 1]])
+        assert content_key(('tcp', 80)) != content_key(['tcp', 80])
+
+    def test_legacy_version(self, cintf):
+        """Versions which store their definition inline still work."""
+        from deploylib.daemon.db import ServiceVersion
+        version = ServiceVersion(None, None)
+        version.__dict__.update({'definition': {'a': 1}, 'globals': {}})
+        version._definition = version._globals = None
+        assert version.definition == {'a': 1}
+        assert version.shared_keys() == []
+
+    def test_retention(self, cintf):
+        cintf.controller.version_retention = 2
+        cintf.create_deployment('foo')
+        for i in range(4):
+            cintf.set_service('foo', 'bar', {'env': {'I': i}})
+
+        service = cintf.db.deployments['foo'].services['bar']
+        assert [v.number for v in service.versions] == [3, 4]
+        assert service.next_version_number == 5
+
+        # Container names keep counting
+        runcfg = cintf.backend.start.mock_calls[-1][1][0]
+        assert runcfg['name'].startswith('foo-bar-4-')
+
+    def test_prune(self, cintf):
+        # Nothing is removed unless asked for
+        assert cintf.controller.version_retention == 0
+        cintf.create_deployment('foo')
+        for i in range(4):
+            cintf.set_service('foo', 'bar', {'env': {'I': i}})
+
+        deployment = cintf.db.deployments['foo']
+        assert len(deployment.shared) == 5
+        with pytest.raises(DeployError):
+            cintf.prune('foo')
+
+        cintf.prune('foo', keep=1)
+        service = deployment.services['bar']
+        assert [v.number for v in service.versions] == [4]
+        assert sorted(deployment.shared.keys()) == sorted(
+            service.latest.shared_keys())
+
+    def test_prune_keeps_running(self, cintf):
+        """Versions with running instances are not removed."""
+        cintf.controller.version_retention = 0
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        service = cintf.db.deployments['foo'].services['bar']
+        service.derive()
+        service.append_version(service.derive({'env': {}}))
+
+        assert service.prune(1) == 0
+        assert len(service.versions) == 2
+
+
+class TestScaling(object):
+
+    def test_instances(self, cintf):
+        cintf.create_deployment('foo')
+        service = cintf.set_service('foo', 'bar', {'instances': 3})
+
+        assert len(service.instances) == 3
+        assert sorted(i.id for i in service.instances) == [
+            'foo-bar-1-1', 'foo-bar-1-2', 'foo-bar-1-3']
+        assert backend_calls(cintf) == ['prepare'] * 3 + ['start'] * 3
+
+    def test_batches(self, cintf):
+        """A new version replaces the instances a batch at a time."""
+        cintf.create_deployment('foo')
+        definition = {'instances': 3, 'rollout': {'batch': 2}}
+        cintf.set_service('foo', 'bar', definition)
+        cintf.backend.reset_mock()
+        service = cintf.set_service('foo', 'bar', definition, force=True)
+
+        assert backend_calls(cintf) == [
+            'prepare', 'prepare', 'terminate', 'terminate', 'start', 'start',
+            'prepare', 'terminate', 'start']
+        assert sorted(i.id for i in service.instances) == [
+            'foo-bar-2-1', 'foo-bar-2-2', 'foo-bar-2-3']
+
+    def test_surge(self, cintf):
+        cintf.create_deployment('foo')
+        definition = {'instances': 2, 'rollout': {
+            'strategy': 'start-first', 'check': 'none', 'surge': 1}}
+        cintf.set_service('foo', 'bar', definition)
+        cintf.backend.reset_mock()
+        service = cintf.set_service('foo', 'bar', definition, force=True)
+
+        assert backend_calls(cintf) == [
+            'prepare', 'start', 'terminate', 'prepare', 'start', 'terminate']
+        assert len(service.instances) == 2
+
+    def test_scale(self, cintf):
+        cintf.create_deployment('foo')
+        service = cintf.set_service('foo', 'bar', {})
+
+        cintf.scale('foo', 'bar', 3)
+        assert len(service.instances) == 3
+        assert len(service.versions) == 1
+
+        cintf.scale('foo', 'bar', 2)
+        assert len(service.instances) == 2
+
+        # The number is kept for new versions
+        cintf.set_service('foo', 'bar', {'env': {'A': 1}})
+        assert [i.version.number for i in service.instances] == [2, 2]
+
+    def test_scale_removes_old_versions_first(self, cintf):
+        cintf.create_deployment('foo')
+        service = cintf.set_service('foo', 'bar', {})
+        old = service.instances[0]
+        service.append_version(service.derive())
+        cintf.scale('foo', 'bar', 2)
+
+        cintf.scale('foo', 'bar', 1)
+        assert not old in service.instances
+
+    def test_wan_ports(self, cintf):
+        cintf.create_deployment('foo')
+        with pytest.raises(DeployError):
+            cintf.set_service('foo', 'bar', {
+                'instances': 2, 'wan_map': {'80': ''}})
+
+
+class TestParallel(object):
+
+    def test_conflict_stops_instances(self, cintf):
+        """If the transaction of a job is aborted, the instances it has
+        started are stopped again, so that a retry does not leave them
+        running unrecorded."""
+        cintf.create_deployment('foo')
+
+        def job(jcintf):
+            jcintf.set_service('foo', 'bar', {})
+            raise ConflictError()
+
+        errors, conflicts = cintf.run_parallel({'bar': job}, 2)
+        assert (errors, conflicts) == ([], ['bar'])
+        assert backend_calls(cintf) == ['prepare', 'start', 'terminate']
+        assert not cintf.db.deployments['foo'].services
+        assert not cintf.controller.monitor.index
+
+    def test_failure_stops_instances(self, cintf):
+        cintf.create_deployment('foo')
+
+        def job(jcintf):
+            jcintf.set_service('foo', 'bar', {})
+            raise ValueError('failed')
+
+        errors, conflicts = cintf.run_parallel({'bar': job}, 2)
+        assert (errors, conflicts) == (['bar'], [])
+        assert backend_calls(cintf) == ['prepare', 'start', 'terminate']
+
+    def test_rollback_after_commit(self, cintf):
+        """Instances committed before the jobs ran are kept."""
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        cintf.run_parallel({}, 2)
+
+        cintf.rollback()
+        assert 'terminate' not in backend_calls(cintf)
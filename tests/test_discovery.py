@@ -0,0 +1,74 @@
+import gevent
+import mock
+import pytest
+from deploylib.daemon.controller import ServiceDiscoveryError
+from deploylib.daemon.discovery import ConsulDiscovery
+
+
+A = [{'ServiceAddress': '', 'Address': '10.0.0.1', 'ServicePort': 80}]
+B = [{'ServiceAddress': '10.0.0.2', 'Address': '', 'ServicePort': 81}]
+
+
+@pytest.fixture
+def discovery():
+    discovery = ConsulDiscovery('localhost')
+    discovery._client = mock.Mock()
+    return discovery
+
+
+def fake_catalog(*results):
+    """Answer with the given results in turn, then block like consul
+    does when nothing changes."""
+    results = list(results)
+    def service(name, index=None, wait=None):
+        if results:
+            return results.pop(0)
+        gevent.sleep(60)
+    return service
+
+
+class TestConsulDiscovery(object):
+
+    def test_cached(self, discovery):
+        discovery._client.catalog.service.side_effect = fake_catalog((1, A))
+        assert discovery.lookup('foo') == A
+        gevent.sleep(0)
+
+        # Only the watcher is talking to consul now
+        assert discovery.lookup('foo') == A
+        assert len(discovery._client.catalog.service.mock_calls) == 2
+        discovery.invalidate('foo')
+
+    def test_watch_failure(self, discovery):
+        """If the watch fails, the cached result is dropped."""
+        discovery._client.catalog.service.side_effect = [
+            (1, A), Exception('failed'), (1, B)]
+        assert discovery.lookup('foo') == A
+        gevent.sleep(0)
+        assert discovery.lookup('foo') == B
+        discovery.invalidate('foo')
+
+    def test_empty_not_cached(self, discovery):
+        discovery._client.catalog.service.return_value = (1, [])
+        assert discovery.lookup('foo') == []
+        assert discovery.lookup('foo') == []
+        assert len(discovery._client.catalog.service.mock_calls) == 2
+
+    def test_watch_updates(self, discovery):
+        """The blocking query replaces the cached result."""
+        discovery._client.catalog.service.side_effect = fake_catalog(
+            (1, A), (2, B))
+        assert discovery.lookup('foo') == A
+        gevent.sleep(0)
+        assert discovery.lookup('foo') == B
+        discovery.invalidate('foo')
+
+    def test_controller_discover(self, controller, discovery):
+        discovery._client.catalog.service.side_effect = [(1, []), (1, B)]
+        controller._discovery = discovery
+        del controller.discover   # undo the test version
+
+        with pytest.raises(ServiceDiscoveryError):
+            controller.discover('foo')
+        assert controller.discover('foo') == '10.0.0.2:81'
+        discovery.invalidate('foo')
@@ -0,0 +1,146 @@
+import json
+import gevent
+import pytest
+import transaction
+from ZODB.POSException import ConflictError
+from deploylib.daemon.api import create_app
+from deploylib.plugins import Plugin
+
+
+events = []
+# Number of times on_instance_down fails with a conflict first
+conflicts = [0]
+
+
+class RecordingPlugin(Plugin):
+
+    def on_instance_down(self, service, instance):
+        if conflicts[0]:
+            conflicts[0] -= 1
+            raise ConflictError()
+        events.append(('down', instance.id))
+
+    def on_instance_up(self, service, instance):
+        events.append(('up', instance.id))
+
+
+controller_plugins = [RecordingPlugin]
+
+
+@pytest.fixture
+def monitor(controller):
+    del events[:]
+    conflicts[0] = 0
+    backend = controller.backend
+    backend.prepare.side_effect = lambda runcfg, service: 'id-%s' % runcfg['name']
+    backend.start.side_effect = \
+        lambda runcfg, service, instance_id: (instance_id, runcfg['name'])
+    return controller.monitor
+
+
+class TestInstanceMonitor(object):
+
+    def test_tracks_instances(self, cintf, monitor):
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        assert monitor.index.keys() == ['id-foo-bar-1-1']
+        assert monitor.status('foo') == {'foo': {'bar': [
+            dict(monitor.index['id-foo-bar-1-1'].as_dict(), status='up')]}}
+
+        cintf.set_service('foo', 'bar', {}, force=True)
+        assert monitor.index.keys() == ['id-foo-bar-2-1']
+
+    def test_restart(self, cintf, monitor):
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        transaction.commit()
+
+        monitor.handle_event({'status': 'die', 'id': 'id-foo-bar-1-1'})
+        state = monitor.index['id-foo-bar-1-1']
+        assert state.status == 'down'
+        gevent.sleep(0.01)
+        assert events == [('down', 'foo-bar-1-1')]
+        assert cintf.backend.restart.mock_calls[0][1][0] == (
+            'id-foo-bar-1-1', 'foo-bar-1-1')
+        assert state.restarts == 1
+
+        monitor.handle_event({'status': 'start', 'id': 'id-foo-bar-1-1'})
+        gevent.sleep(0.01)
+        assert state.status == 'up'
+        assert events[-1] == ('up', 'foo-bar-1-1')
+
+        # Dying again right away, it is restarted with a delay
+        monitor.handle_event({'status': 'die', 'id': 'id-foo-bar-1-1'})
+        gevent.sleep(0.01)
+        assert len(cintf.backend.restart.mock_calls) == 1
+
+    def test_failed_restart(self, cintf, monitor):
+        """If docker fails to restart the container, we try again."""
+        monitor.backoff = 0.001
+        cintf.backend.restart.side_effect = [Exception('docker'), None]
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        transaction.commit()
+
+        monitor.handle_event({'status': 'die', 'id': 'id-foo-bar-1-1'})
+        gevent.sleep(0.05)
+        assert len(cintf.backend.restart.mock_calls) == 2
+        assert monitor.index['id-foo-bar-1-1'].restarts == 2
+
+    def test_hook_conflict(self, cintf, monitor):
+        """A hook whose transaction conflicts is run again."""
+        conflicts[0] = 2
+        monitor.backoff = 0.001
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        transaction.commit()
+
+        monitor.handle_event({'status': 'die', 'id': 'id-foo-bar-1-1'})
+        gevent.sleep(0.05)
+        assert events == [('down', 'foo-bar-1-1')]
+        assert conflicts[0] == 0
+
+    def test_supervised(self, cintf, monitor):
+        """Containers kept running by a supervisor are left to it."""
+        cintf.backend.supervised = True
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        transaction.commit()
+
+        monitor.handle_event({'status': 'die', 'id': 'id-foo-bar-1-1'})
+        gevent.sleep(0.01)
+        assert monitor.index['id-foo-bar-1-1'].status == 'down'
+        assert events == [('down', 'foo-bar-1-1')]
+        assert not cintf.backend.restart.called
+
+    def test_stopped_is_not_restarted(self, cintf, monitor):
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        cintf.set_service('foo', 'bar', {}, force=True)
+
+        monitor.handle_event({'status': 'die', 'id': 'id-foo-bar-1-1'})
+        gevent.sleep(0.01)
+        assert not cintf.backend.restart.called
+        assert events == []
+
+    def test_sync(self, cintf, monitor):
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        monitor.index['gone'] = monitor.index.values()[0]
+        cintf.backend.status.return_value = False
+
+        monitor.sync(cintf.db)
+        assert monitor.index.keys() == ['id-foo-bar-1-1']
+        assert monitor.index['id-foo-bar-1-1'].status == 'down'
+        gevent.sleep(0.01)
+        assert cintf.backend.restart.called
+
+    def test_api(self, controller, cintf, monitor):
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        transaction.commit()
+
+        with create_app(controller).test_client() as c:
+            rep = c.get('/status?deploy_id=foo')
+        result = json.loads(rep.get_data())
+        assert result['foo']['bar'][0]['status'] == 'up'
@@ -0,0 +1,63 @@
+import gevent
+import mock
+import transaction
+from deploylib.daemon import metrics
+from deploylib.daemon.api import create_app
+from deploylib.daemon.metrics import Histogram, Counter
+
+
+controller_plugins = []
+
+
+class TestMetrics(object):
+
+    def test_histogram(self):
+        histogram = Histogram('foo', 'Foo.', labels=('a',), buckets=(1, 5))
+        histogram.observe(0.5, a='x')
+        histogram.observe(3, a='x')
+        histogram.observe(10, a='x')
+
+        lines = histogram.render().splitlines()
+        assert lines[1] == '# TYPE foo histogram'
+        assert lines[2:] == [
+            'foo_bucket{a="x",le="1"} 1.0',
+            'foo_bucket{a="x",le="5"} 2.0',
+            'foo_bucket{a="x",le="+Inf"} 3.0',
+            'foo_count{a="x"} 3.0',
+            'foo_sum{a="x"} 13.5',
+        ]
+
+    def test_counter(self):
+        counter = Counter('bar', 'Bar.')
+        counter.inc()
+        counter.inc(2)
+        assert counter.render().splitlines()[-1] == 'bar 3.0'
+
+    def test_endpoint(self, controller, cintf):
+        """The endpoint needs the auth key, unless made public."""
+        cintf.db.auth_key = 'secret'
+        cintf.create_deployment('foo')
+        transaction.commit()
+
+        app = create_app(controller)
+        with app.test_client() as c:
+            assert c.get('/list').status_code == 401
+            assert c.get('/metrics').status_code == 401
+            rep = c.get('/metrics', headers={'Authorization': 'secret'})
+        assert rep.status_code == 200
+
+        output = rep.get_data()
+        assert 'deployd_request_seconds_count{endpoint="api.list"}' in output
+        assert 'deployd_zodb_size_bytes ' in output
+        assert 'deployd_streams ' in output
+
+        with mock.patch.object(metrics.metrics, 'is_public', True):
+            with app.test_client() as c:
+                assert c.get('/metrics').status_code == 200
+
+    def test_greenlets(self):
+        greenlet = metrics.count('test', gevent.spawn(gevent.sleep, 0.01))
+        assert metrics._greenlets['test'] == 1
+        greenlet.join()
+        gevent.sleep(0)
+        assert metrics._greenlets['test'] == 0
@@ -0,0 +1,247 @@
+import json
+import re
+import pytest
+import responses as responses_lib
+from deploylib.daemon.controller import DeployError
+from deploylib.daemon.multihost import MultiHostBackend, NoCapacityError
+
+
+GB = 1024**3
+
+
+@pytest.fixture()
+def responses(request):
+    """Fake hosts answer every call that might come up, not all will."""
+    mock = responses_lib.RequestsMock(assert_all_requests_are_fired=False)
+    mock.start()
+    request.addfinalizer(mock.stop)
+    return mock
+
+
+class FakeDockerHost(object):
+    """Answers the docker API calls the backend makes, via responses.
+    """
+
+    def __init__(self, responses, name, memory=4*GB, containers=0):
+        self.url = 'http://%s:2375' % name
+        self.memory = memory
+        self.containers = {}
+        self.other_containers = containers
+        self.exited = 0
+        self.available = True
+        self.stopped = []
+
+        base = re.escape(self.url) + r'/v[\d.]+'
+        responses.add_callback(
+            responses.GET, re.compile(base + '/info$'), self.info)
+        responses.add_callback(
+            responses.GET, re.compile(base + '/images/.*/json$'),
+            lambda r: (200, {}, json.dumps({'id': 'img', 'config': {}})))
+        responses.add_callback(
+            responses.GET, re.compile(base + '/containers/.*/json$'),
+            lambda r: (404, {}, 'no such container'))
+        responses.add_callback(
+            responses.POST, re.compile(base + '/containers/create.*'),
+            self.create)
+        responses.add_callback(
+            responses.POST, re.compile(base + '/containers/.*/start$'),
+            lambda r: (204, {}, ''))
+        responses.add_callback(
+            responses.POST, re.compile(base + '/containers/.*/stop.*'),
+            self.stop)
+
+    def info(self, request):
+        if not self.available:
+            return 500, {}, 'unavailable'
+        running = self.other_containers + len(self.containers)
+        return 200, {}, json.dumps({
+            'MemTotal': self.memory, 'NCPU': 2,
+            'Containers': running + self.exited,
+            'ContainersRunning': running})
+
+    def create(self, request):
+        if not self.available:
+            return 500, {}, 'unavailable'
+        config = json.loads(request.body)
+        cid = 'c%d' % len(self.containers)
+        self.containers[cid] = config
+        return 201, {}, json.dumps({'Id': cid})
+
+    def stop(self, request):
+        self.stopped.append(request.url.split('/')[-2])
+        return 204, {}, ''
+
+
+def runcfg(name, memory=None):
+    return {'name': name, 'image': 'foo', 'cmd': [], 'entrypoint': [],
+            'env': {}, 'volumes': {}, 'ports': {}, 'privileged': False,
+            'memory': memory}
+
+
+def make_backend(responses, scheduler, *hosts):
+    fakes = [FakeDockerHost(responses, *h) for h in hosts]
+    backend = MultiHostBackend.from_string(
+        ','.join('%s=%s' % (h[0], f.url) for h, f in zip(hosts, fakes)),
+        scheduler=scheduler)
+    for fake, host in zip(fakes, backend.hosts):
+        fake.backend = host.backend
+    return backend, fakes
+
+
+class TestMultiHost(object):
+
+    def test_spread(self, responses):
+        backend, (one, two) = make_backend(
+            responses, 'spread', ('one', 4*GB, 1), ('two', 4*GB, 0))
+
+        placed = []
+        for i in range(3):
+            cfg = runcfg('c%d' % i)
+            backend.prepare(cfg, None)
+            backend.start(cfg, None, 'id')
+            placed.append(cfg['host'])
+        assert placed == ['two', 'one', 'two']
+        assert len(one.containers) == 1
+        assert len(two.containers) == 2
+
+    def test_binpack(self, responses):
+        backend, (one, two) = make_backend(
+            responses, 'binpack', ('one', 4*GB, 0), ('two', 2*GB, 0))
+
+        assert backend.place('1g').name == 'two'
+        # Does not fit on the fuller host
+        assert backend.place('3g').name == 'one'
+        with pytest.raises(NoCapacityError):
+            backend.place('5g')
+
+    def test_host_backend(self, responses):
+        """Images are prepared on the host the container is placed on."""
+        backend, (one, two) = make_backend(
+            responses, 'spread', ('one', 4*GB, 1), ('two', 4*GB, 0))
+
+        cfg = runcfg('web')
+        assert backend.host_backend(cfg) is two.backend
+        assert cfg['host'] == 'two'
+        cfg['host'] = 'one'
+        assert backend.host_backend(cfg) is one.backend
+
+    def test_terminate(self, responses):
+        backend, (one, two) = make_backend(
+            responses, 'spread', ('one', 4*GB, 0), ('two', 4*GB, 5))
+
+        cfg = runcfg('web')
+        backend.prepare(cfg, None)
+        instance_id = backend.start(cfg, None, 'c0')
+        assert cfg['host'] == 'one'
+        assert backend.hosts[0].containers == 1
+
+        backend.terminate(instance_id, host=cfg['host'])
+        assert one.stopped == ['c0']
+        assert backend.hosts[0].containers == 0
+
+    def test_exited_containers(self, responses):
+        """Only running containers count."""
+        backend, (one, two) = make_backend(
+            responses, 'spread', ('one', 4*GB, 1), ('two', 4*GB, 0))
+        two.exited = 10
+        assert backend.place().name == 'two'
+
+    def test_unplace(self, responses):
+        backend, (one, two) = make_backend(
+            responses, 'spread', ('one', 4*GB, 0), ('two', 4*GB, 0))
+        host = backend.place('1g', name='web')
+        assert host.placed == {'web': GB}
+
+        backend.unplace('web', host.name)
+        assert host.placed == {}
+        assert host.containers == 0
+
+    def test_unavailable_host(self, responses):
+        backend, (one,) = make_backend(responses, 'spread', ('one', 4*GB, 0))
+        backend.hosts.append(MultiHostBackend.from_string(
+            'down=http://down:2375').hosts[0])
+
+        assert backend.place().name == 'one'
+        assert not backend.hosts[1].available
+
+
+class TestController(object):
+
+    def test_instance_host(self, cintf, responses):
+        backend, (one, two) = make_backend(
+            responses, 'spread', ('one', 4*GB, 3), ('two', 4*GB, 0))
+        cintf.controller.backend = cintf.backend = backend
+
+        cintf.create_deployment('foo')
+        service = cintf.set_service('foo', 'web', {'ports': {'': 80}})
+
+        instance = service.instances[0]
+        assert instance.host == 'two'
+        assert instance.ports[''][0] == 'two'
+        assert len(two.containers) == 1
+
+        # The new version replaces the old one on its host
+        cintf.set_service('foo', 'web', {'ports': {'': 80}}, force=True)
+        assert two.stopped == ['c0']
+
+    def test_spread_instances(self, cintf, responses):
+        """Instances created together do not all end up on one host."""
+        backend, (one, two) = make_backend(
+            responses, 'spread', ('one', 4*GB, 0), ('two', 4*GB, 0))
+        cintf.controller.backend = cintf.backend = backend
+
+        cintf.create_deployment('foo')
+        service = cintf.set_service('foo', 'web', {'instances': 2})
+        assert sorted(i.host for i in service.instances) == ['one', 'two']
+
+    def test_host_fails(self, cintf, responses):
+        """Instances go to the hosts that are left."""
+        backend, (one, two) = make_backend(
+            responses, 'spread', ('one', 4*GB, 3), ('two', 4*GB, 0))
+        cintf.controller.backend = cintf.backend = backend
+
+        cintf.create_deployment('foo')
+        service = cintf.set_service('foo', 'web', {})
+        assert service.instances[0].host == 'two'
+
+        two.available = False
+        backend.refresh(force=True)
+        cintf.set_service('foo', 'web', {}, force=True)
+        assert service.instances[0].host == 'one'
+
+    def test_failed_prepare(self, cintf, responses):
+        """The memory reserved for a container that could not be created
+        is free again."""
+        backend, (one,) = make_backend(responses, 'spread', ('one', 4*GB, 0))
+        cintf.controller.backend = cintf.backend = backend
+
+        cintf.create_deployment('foo')
+        backend.refresh()
+        one.available = False
+        with pytest.raises(Exception):
+            cintf.set_service('foo', 'web', {})
+        assert backend.hosts[0].placed == {}
+        assert backend.hosts[0].containers == 0
+
+    def test_volumes_stay_on_host(self, cintf, responses):
+        backend, (one, two) = make_backend(
+            responses, 'spread', ('one', 4*GB, 0), ('two', 4*GB, 1))
+        cintf.controller.backend = cintf.backend = backend
+
+        cintf.create_deployment('foo')
+        definition = {'volumes': {'data': '/data'}}
+        service = cintf.set_service('foo', 'db', definition)
+        assert service.instances[0].host == 'one'
+
+        # Spreading would choose the other host now
+        one.other_containers = 5
+        backend.refresh(force=True)
+        cintf.set_service('foo', 'db', definition, force=True)
+        assert service.instances[0].host == 'one'
+
+        # Rather than moving, we fail, and keep the running instance
+        one.available = False
+        backend.refresh(force=True)
+        with pytest.raises(DeployError):
+            cintf.set_service('foo', 'db', definition, force=True)
+        assert len(service.instances) == 1
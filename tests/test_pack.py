@@ -0,0 +1,59 @@
+import time
+from gevent.monkey import get_original
+import mock
+import transaction
+from deploylib.daemon.pack import PackScheduler
+
+
+controller_plugins = []
+
+
+class TestPackScheduler(object):
+
+    def test_from_environ(self, controller, tmpdir):
+        packer = PackScheduler.from_environ(
+            controller._zodb_obj, str(tmpdir.join('db')),
+            environ={'PACK_GROWTH': '100', 'PACK_INTERVAL': '0'})
+        assert packer.growth == 100
+        assert packer.interval == 0
+        assert packer.start() is None
+
+    def test_triggers(self, controller, tmpdir):
+        packer = PackScheduler(
+            controller._zodb_obj, str(tmpdir.join('db')), growth=1000,
+            max_age=60)
+        packer.last_size = packer.size()
+        assert not packer.should_pack()
+
+        # Has not grown enough, but for a long time
+        packer.last_size -= 10
+        assert not packer.should_pack()
+        assert packer.should_pack(now=time.time() + 120)
+
+        packer.last_size -= 1000
+        assert packer.should_pack()
+
+    def test_pack(self, cintf, tmpdir):
+        deployment = cintf.create_deployment('foo')
+        for i in range(20):
+            deployment.globals = {'i': i}
+            transaction.commit()
+
+        packer = cintf.controller.packer
+        packer.history = 0
+        freed = packer.pack()
+
+        assert freed > 0
+        assert packer.stats['packs'] == 1
+        assert packer.stats['size'] == packer.size()
+        assert packer.stats['last_pack_duration'] >= 0
+        assert not packer.should_pack()
+
+    def test_pack_in_thread(self, controller, tmpdir):
+        """The hub is not blocked while packing."""
+        get_ident = get_original('thread', 'get_ident')
+        threads = []
+        db = mock.Mock()
+        db.pack.side_effect = lambda t: threads.append(get_ident())
+        PackScheduler(db, str(tmpdir.join('db'))).pack()
+        assert threads and threads[0] != get_ident()
@@ -1,9 +1,17 @@
 from io import BytesIO
-import subprocess
+import json
+import struct
+from subprocess import check_output
+import tarfile
+import gevent
 import mock
 import pytest
+import transaction
 from werkzeug.datastructures import FileStorage
 from deploylib.client.service import Service
+from deploylib.daemon.api import create_app
+from deploylib.daemon.context import ctx
+from deploylib.daemon.controller import DeployError
 from deploylib.daemon.controller import canonical_definition
 from deploylib.plugins.app import AppPlugin, LocalAppPlugin
 from deploylib.plugins.shelf import ShelfPlugin
@@ -20,18 +28,18 @@ def install_shelf(cintf):
 
 
 @pytest.fixture(autouse=True)
-def patch_build(request):
-    # Mock subprocess calls used by container build
-    fake_popen = mock.NonCallableMagicMock()
-    fake_popen.stdout = BytesIO("foo")
-    fake_popen.returncode = 0
-    subprocess_patcher = mock.patch(
-        "subprocess.Popen", side_effect=[fake_popen])
-    subprocess_patcher.start()
+def patch_build(cintf):
+    # Mock the docker calls used by the slug build
+    docker = cintf.backend.client
+    docker.attach_socket.return_value = mock.Mock()
+    docker.attach.side_effect = lambda *a, **kw: iter(['fo', 'o\nbar'])
+    return docker
 
-    def end():
-        subprocess_patcher.stop()
-    request.addfinalizer(end)
+
+def built_slugs(docker):
+    """The slug urls the slugbuilder was run with."""
+    return [kw['command'][0] for _, _, kw in
+            docker.create_container.mock_calls]
 
 
 class TestAppPlugin(object):
@@ -73,9 +81,9 @@ class TestAppPlugin(object):
         cintf.provide_data(
             'foo', 'bar',  {'app': FileStorage()}, {'app': {'version': 42}})
 
-        # docker build was called
-        assert len(subprocess.Popen.mock_calls) == 1
-        assert 'http://shelf' in subprocess.Popen.mock_calls[0][1][0]
+        # slugbuilder was run
+        [slug_url] = built_slugs(cintf.backend.client)
+        assert slug_url.startswith('http://system-shelf/slugs/foo/bar:42-')
         # Service no longer held
         assert not service.held
         assert not service.held_version   # was cleared
@@ -101,8 +109,8 @@ class TestAppPlugin(object):
             'foo', 'bar',  {'app': FileStorage()}, {'app': {'version': 99}})
 
         # Another slug was built
-        assert len(subprocess.Popen.mock_calls) == 1
-        assert 'http://shelf' in subprocess.Popen.mock_calls[0][1][0]
+        [slug_url] = built_slugs(cintf.backend.client)
+        assert slug_url.startswith('http://system-shelf/slugs/foo/bar:99-')
         # And deployed as a new version
         assert len(service.versions) == 2
         assert service.versions[0].definition ==service.versions[1].definition
@@ -122,7 +130,7 @@ class TestAppPlugin(object):
         service = cintf.set_service('foo', 'bar', {'git': '.', 'foo': 1})
 
         # No slug was built
-        assert len(subprocess.Popen.mock_calls) == 0
+        assert built_slugs(cintf.backend.client) == []
         # But the new one was deployed as a new version
         assert len(service.versions) == 2
         assert service.versions[1].definition == \
@@ -130,6 +138,291 @@ class TestAppPlugin(object):
         assert service.versions[1].globals ==service.versions[0].globals
         assert service.versions[1].data['app_version_id'] == service.versions[0].data['app_version_id']
 
+    def test_upload_is_streamed(self, cintf):
+        """The uploaded code is copied into the builder as it is read.
+        """
+        deployment = cintf.create_deployment('foo')
+        service = deployment.set_service('bar')
+        service.hold('bla', service.derive(canonical_definition('bar', {'git': '.'})[1]))
+
+        docker = cintf.backend.client
+        body = 'x' * 100000 + 'y'
+        stream = BytesIO(body)
+        cintf.provide_data('foo', 'bar', {'app': stream}, {'app': {'version': 1}})
+
+        stdin = docker.attach_socket.return_value
+        assert docker.create_container.call_args[1]['stdin_open']
+        assert len(stdin.sendall.mock_calls) == 2
+        assert ''.join(c[1][0] for c in stdin.sendall.mock_calls) == body
+        assert stdin.close.called
+        # Output is logged by line
+        logs = [i['log'] for i in ctx.filter('log')]
+        assert logs[:3] == ['Pulling flynn/slugbuilder', 'foo', 'bar']
+        # The builder is removed once done
+        assert docker.remove_container.called
+        assert not docker.kill.called
+
+    def test_build_failure(self, cintf):
+        deployment = cintf.create_deployment('foo')
+        service = deployment.set_service('bar')
+        service.hold('bla', service.derive(canonical_definition('bar', {'git': '.'})[1]))
+
+        docker = cintf.backend.client
+        docker.wait.return_value = 1
+        with pytest.raises(DeployError):
+            cintf.provide_data(
+                'foo', 'bar', {'app': BytesIO('')}, {'app': {'version': 1}})
+        assert docker.remove_container.called
+        assert service.held
+
+
+class TestSlugIndex(object):
+
+    def deploy(self, cintf, deploy_id, tree='t1', version=1, env=None,
+               deps=None, **kwargs):
+        service = cintf.create_deployment(deploy_id).set_service('bar')
+        definition = dict({'git': '.', 'env': env or {}}, **kwargs)
+        service.hold('bla', service.derive(
+            canonical_definition('bar', definition)[1]))
+        cintf.provide_data(
+            deploy_id, 'bar', {'app': BytesIO('code')},
+            {'app': {'version': version, 'tree': tree, 'deps': deps}})
+        return service
+
+    def test_reuse_across_deployments(self, cintf, responses):
+        """The same code is only built once.
+        """
+        docker = cintf.backend.client
+        staging = self.deploy(cintf, 'staging')
+        [slug_url] = built_slugs(docker)
+
+        responses.add(responses.HEAD, slug_url, status=200)
+        production = self.deploy(cintf, 'production')
+        # Nothing was built
+        assert len(built_slugs(docker)) == 1
+        assert production.versions[-1].data['slug'] == \
+               staging.versions[-1].data['slug']
+        assert ctx.filter('job')[-1]['job'].startswith('using existing slug')
+
+        # The slugrunner uses the slug of the staging deployment
+        runcfg = cintf.backend.start.call_args[0][0]
+        assert runcfg['env']['SLUG_URL'] == slug_url
+
+    def test_different_tree(self, cintf):
+        self.deploy(cintf, 'staging', tree='t1')
+        self.deploy(cintf, 'production', tree='t2')
+        assert len(built_slugs(cintf.backend.client)) == 2
+
+    def test_build_env(self, cintf, responses):
+        """Only the buildpack, and the variables named in ``build_env``,
+        keep slugs apart.
+        """
+        docker = cintf.backend.client
+        self.deploy(cintf, 'staging', env={'DB': 'a'})
+        [slug_url] = built_slugs(docker)
+        responses.add(responses.HEAD, slug_url, status=200)
+        self.deploy(cintf, 'production', env={'DB': 'b'})
+        assert len(built_slugs(docker)) == 1
+
+        self.deploy(cintf, 'other', env={'DB': 'b', 'BUILDPACK_URL': 'x'})
+        assert len(built_slugs(docker)) == 2
+
+        self.deploy(cintf, 'staging2', env={'DB': 'a'}, build_env=['DB'])
+        self.deploy(cintf, 'production2', env={'DB': 'b'}, build_env=['DB'])
+        assert len(built_slugs(docker)) == 4
+
+    def test_migration(self, controller, cintf):
+        """The index is created for databases from before it existed."""
+        cintf.db.slug_index = None
+        controller.migrate(cintf._db_obj.root)
+        assert cintf.db.slug_index.get('t', 'f') is None
+
+    def test_build_cache(self, cintf):
+        """Builds share the cache if their dependencies are the same.
+        """
+        docker = cintf.backend.client
+        cache_dirs = lambda: [c[2]['binds'].keys()[0]
+                              for c in docker.start.mock_calls]
+        self.deploy(cintf, 'staging', env={'DB': 'a'}, deps='d1')
+        self.deploy(cintf, 'production', env={'DB': 'b'}, deps='d1')
+        self.deploy(cintf, 'other', env={'DB': 'b'}, deps='d2')
+        staging, production, other = cache_dirs()
+        assert staging == production
+        assert other != staging
+
+        # Without knowing the dependencies, each service has its own
+        self.deploy(cintf, 'a', env={'DB': 'c'})
+        self.deploy(cintf, 'b', env={'DB': 'd'})
+        assert len(set(cache_dirs())) == 4
+
+    def test_slug_gone(self, cintf, responses):
+        """If shelf no longer has the slug, it is built again.
+        """
+        self.deploy(cintf, 'staging')
+        [slug_url] = built_slugs(cintf.backend.client)
+        responses.add(responses.HEAD, slug_url, status=404)
+        self.deploy(cintf, 'production')
+        assert len(built_slugs(cintf.backend.client)) == 2
+
+
+class TestNegotiation(object):
+
+    @pytest.fixture
+    def repo(self, tmpdir):
+        return self.init(tmpdir.mkdir('repo'))
+
+    def init(self, repo):
+        with repo.as_cwd():
+            check_output('git init -q && git config user.email a@b && '
+                         'git config user.name a', shell=True)
+        return repo
+
+    def service(self, repo):
+        service = Service({'git': repo.strpath})
+        service.filename = repo.strpath
+        return service
+
+    def commit(self, repo, filename, content):
+        repo.join(filename).write(content)
+        with repo.as_cwd():
+            check_output('git add . && git commit -q -m %s' % filename,
+                         shell=True)
+
+    def deploy(self, app, cintf, repo, deploy_id):
+        service = cintf.create_deployment(deploy_id).set_service('bar')
+        service.hold('bla', service.derive(
+            canonical_definition('bar', {'git': '.'})[1]))
+
+        negotiate = lambda name, data: \
+            cintf.negotiate_data(deploy_id, 'bar', name, data)
+        filedata = app.get_plugin(LocalAppPlugin).provide_data(
+            self.service(repo), 'git', negotiate)
+        body, data = filedata['app']
+        self.uploaded = ''.join(body)
+        cintf.provide_data(deploy_id, 'bar', {'app': BytesIO(self.uploaded)},
+                           {'app': data})
+        return data
+
+    def pack_size(self):
+        """The number of objects in the pack that was uploaded."""
+        assert self.uploaded[:4] == 'PACK'
+        return struct.unpack('>I', self.uploaded[8:12])[0]
+
+    def sent_code(self, docker):
+        """The files of the tarball the builder was given."""
+        stdin = docker.attach_socket.return_value
+        tarball = ''.join(c[1][0] for c in stdin.sendall.mock_calls)
+        stdin.reset_mock()
+        return sorted(tarfile.open(fileobj=BytesIO(tarball)).getnames())
+
+    def test_pack(self, app, cintf, repo):
+        """The code is sent as a pack with what the server is missing,
+        and the server archives it itself.
+        """
+        docker = cintf.backend.client
+        self.commit(repo, 'a', 'foo')
+        data = self.deploy(app, cintf, repo, 'staging')
+        assert data['format'] == 'pack'
+        assert self.sent_code(docker) == ['a']
+
+        # Another commit: only it is sent
+        self.commit(repo, 'b', 'bar')
+        bases = cintf.negotiate_data('staging', 'bar', 'app', {})['bases']
+        assert len(bases) == 1
+        data = self.deploy(app, cintf, repo, 'production')
+        assert data['format'] == 'pack'
+        assert self.sent_code(docker) == ['a', 'b']
+
+    def test_pack_without_history(self, app, cintf, repo):
+        """Neither the first pack nor later ones contain the history
+        of the commit.
+        """
+        docker = cintf.backend.client
+        self.commit(repo, 'a', 'foo')
+        self.commit(repo, 'a', 'bar')
+        self.commit(repo, 'b', 'baz')
+        self.deploy(app, cintf, repo, 'staging')
+        # The commit, its tree and the two files
+        assert self.pack_size() == 4
+        assert self.sent_code(docker) == ['a', 'b']
+
+        # The old content of a is not in the tree the server has: it is
+        # sent again, along with the commit and its tree.
+        self.commit(repo, 'a', 'foo')
+        self.deploy(app, cintf, repo, 'production')
+        assert self.pack_size() == 3
+        assert self.sent_code(docker) == ['a', 'b']
+
+    def test_have(self, app, cintf, repo, responses):
+        """Nothing is sent if the server has a slug of the code.
+        """
+        docker = cintf.backend.client
+        self.commit(repo, 'a', 'foo')
+        self.deploy(app, cintf, repo, 'staging')
+        [slug_url] = built_slugs(docker)
+
+        responses.add(responses.HEAD, slug_url, status=200)
+        data = self.deploy(app, cintf, repo, 'production')
+        assert data['format'] == 'none'
+        assert len(built_slugs(docker)) == 1
+        assert cintf.db.deployments['production'].services['bar'].versions
+
+    def test_api(self, controller, cintf):
+        cintf.create_deployment('foo').set_service('bar')
+        transaction.commit()
+
+        with create_app(controller).test_client() as c:
+            rep = c.post('/negotiate', content_type='application/json',
+                         data=json.dumps({'deploy_id': 'foo',
+                                          'service_name': 'bar',
+                                          'file': 'app',
+                                          'data': {'tree': 'abc'}}))
+            answer = json.loads(rep.get_data())
+        assert answer == {'have': False, 'bases': [],
+                          'formats': ['tar', 'pack', 'none']}
+
+    def test_dependency_hash(self, app, repo):
+        self.commit(repo, 'a', 'foo')
+        provide = lambda: app.get_plugin(LocalAppPlugin).provide_data(
+            self.service(repo), 'git')['app'][1]['deps']
+        assert provide() is None
+
+        self.commit(repo, 'Gemfile.lock', 'rails')
+        deps = provide()
+        assert deps
+        self.commit(repo, 'b', 'bar')
+        assert provide() == deps
+        self.commit(repo, 'Gemfile.lock', 'rails 2')
+        assert provide() != deps
+
+    def test_no_negotiation(self, app, repo):
+        """Servers that cannot negotiate get a tarball."""
+        self.commit(repo, 'a', 'foo')
+        body, data = app.get_plugin(LocalAppPlugin).provide_data(
+            self.service(repo), 'git', lambda name, data: None)['app']
+        assert not 'format' in data
+        tarball = tarfile.open(fileobj=BytesIO(''.join(body)))
+        assert tarball.getnames() == ['a']
+
+    def test_two_repos(self, app, repo, tmpdir):
+        """The code of several services can be read at the same time;
+        the working directory is not changed for it.
+        """
+        other = self.init(tmpdir.mkdir('other'))
+        self.commit(repo, 'a', 'foo')
+        self.commit(other, 'b', 'bar')
+
+        def provide(repo):
+            body, data = app.get_plugin(LocalAppPlugin).provide_data(
+                self.service(repo), 'git')['app']
+            return tarfile.open(fileobj=BytesIO(''.join(body))).getnames()
+
+        with mock.patch('deploylib.client.utils.directory',
+                        side_effect=AssertionError):
+            threads = [gevent.spawn(provide, r) for r in (repo, other)]
+            gevent.joinall(threads, raise_error=True)
+        assert [t.value for t in threads] == [['a'], ['b']]
+
 
 class TestLocalAppPlugin(object):
 
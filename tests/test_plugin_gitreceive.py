@@ -60,6 +60,8 @@ class TestGitReceive(object):
         service = cintf.set_service('foo', 'bar', {
             'git': '.'
         })
+        # Read-only requests do not commit the test transaction for us
+        transaction.commit()
 
         app = create_app(controller)
 
@@ -89,6 +91,25 @@ class TestGitReceive(object):
                         data={'tarball': (StringIO(''), '')})
             assert 'building slug for bar, version 123' in rep.get_data()
 
+    def test_push_stream(self, cintf, controller):
+        """The tarball can be the body of the request.
+        """
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {'git': '.'})
+        transaction.commit()
+
+        app = create_app(controller)
+        with app.test_client() as c:
+            rep = c.post('/gitreceive/push-data',
+                        query_string={'name': 'foo/bar', 'version': '123'},
+                        data='tarball')
+            output = rep.get_data()
+            assert 'building slug for bar, version 123' in output
+            # Timing spans are not shown to git
+            assert not '"span"' in output
+        stdin = controller.backend.client.attach_socket.return_value
+        assert ''.join(c[1][0] for c in stdin.sendall.mock_calls) == 'tarball'
+
     def test_add_remote(self, tmpdir, cintf):
         with tmpdir.mkdir('repo').as_cwd():
             check_output('git init', shell=True)
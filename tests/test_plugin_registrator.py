@@ -0,0 +1,125 @@
+import mock
+import pytest
+import transaction
+from deploylib.daemon.discovery import ConsulDiscovery
+from deploylib.plugins.consul_registrator import RegistratorAmbassadorConsul
+
+
+controller_plugins = [RegistratorAmbassadorConsul]
+
+
+@pytest.fixture
+def consul(controller):
+    controller._discovery = ConsulDiscovery('localhost')
+    client = controller._discovery._client = mock.Mock()
+    client.agent.services.return_value = {}
+    return client
+
+
+def registered(consul):
+    return {c[2]['service_id']: (c[1][0], c[2]['address'], c[2]['port'])
+            for c in consul.agent.service.register.mock_calls}
+
+
+class TestCatalogSync(object):
+
+    def test_register(self, cintf, consul):
+        cintf.create_deployment('foo')
+        service = cintf.set_service('foo', 'bar', {})
+
+        port = service.instances[0].ports[''][1]
+        assert registered(consul) == {
+            'hafez:foo-bar-1-1': ('foo-bar', '127.0.0.1', port)}
+        assert len(consul.agent.services.mock_calls) == 1
+
+    def test_replace(self, cintf, consul):
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        transaction.commit()
+
+        consul.agent.services.return_value = {
+            'hafez:foo-bar-1-1': {
+                'Service': 'foo-bar', 'Address': '127.0.0.1', 'Port': 1},
+            'other': {'Service': 'other', 'Address': '', 'Port': 1}}
+        consul.agent.service.register.reset_mock()
+        cintf.set_service('foo', 'bar', {}, force=True)
+        transaction.commit()
+
+        assert registered(consul).keys() == ['hafez:foo-bar-2-1']
+        assert consul.agent.service.deregister.mock_calls == [
+            mock.call(service_id='hafez:foo-bar-1-1')]
+
+    def test_start_first(self, cintf, consul):
+        """The new instance is registered, and the old one deregistered,
+        before the old one is drained and stopped."""
+        cintf.create_deployment('foo')
+        definition = {'rollout': {'strategy': 'start-first', 'check': 'none'}}
+        service = cintf.set_service('foo', 'bar', definition)
+        consul.agent.services.return_value = {
+            'hafez:foo-bar-1-1': {
+                'Service': 'foo-bar', 'Address': '127.0.0.1',
+                'Port': service.instances[0].ports[''][1]}}
+        consul.agent.service.register.reset_mock()
+
+        on_terminate = []
+        cintf.backend.terminate.side_effect = lambda *a, **kw: \
+            on_terminate.append((
+                registered(consul).keys(),
+                consul.agent.service.deregister.mock_calls[:]))
+        cintf.set_service('foo', 'bar', definition, force=True)
+
+        assert on_terminate == [(
+            ['hafez:foo-bar-2-1'],
+            [mock.call(service_id='hafez:foo-bar-1-1')])]
+
+    def test_sync_all(self, cintf, consul, controller):
+        plugin = controller.get_plugin(RegistratorAmbassadorConsul)
+        cintf.create_deployment('foo')
+        service = cintf.set_service('foo', 'bar', {})
+        port = service.instances[0].ports[''][1]
+
+        consul.agent.services.return_value = {
+            'hafez:gone': {'Service': 'gone', 'Address': '', 'Port': 1}}
+        plugin.sync_all(cintf.db, controller.discovery)
+        assert registered(consul) == {
+            'hafez:foo-bar-1-1': ('foo-bar', '127.0.0.1', port)}
+        # A stale registration survives the first sync
+        assert not consul.agent.service.deregister.called
+
+        plugin.sync_all(cintf.db, controller.discovery)
+        assert consul.agent.service.deregister.mock_calls == [
+            mock.call(service_id='hafez:gone')]
+        transaction.abort()
+
+    def test_sync_periodically(self, cintf, consul, controller):
+        """The periodic sync only reads the database."""
+        plugin = controller.get_plugin(RegistratorAmbassadorConsul)
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        transaction.commit()
+        consul.agent.service.register.reset_mock()
+
+        with mock.patch.object(controller, 'interface',
+                               wraps=controller.interface) as interface, \
+                mock.patch('gevent.sleep', side_effect=StopIteration):
+            with pytest.raises(StopIteration):
+                plugin._sync_periodically(controller)
+        assert interface.mock_calls == [mock.call(read_only=True)]
+        assert 'hafez:foo-bar-1-1' in registered(consul)
+
+    def test_instance_down(self, cintf, consul, controller):
+        plugin = controller.get_plugin(RegistratorAmbassadorConsul)
+        plugin.monitor = controller.monitor
+        cintf.create_deployment('foo')
+        service = cintf.set_service('foo', 'bar', {})
+        transaction.commit()
+        instance = service.instances[0]
+
+        consul.agent.services.return_value = {
+            'hafez:foo-bar-1-1': {
+                'Service': 'foo-bar', 'Address': '127.0.0.1', 'Port': 1}}
+        controller.monitor.index.values()[0].status = 'down'
+        plugin.on_instance_down(service, instance)
+        transaction.commit()
+        assert consul.agent.service.deregister.mock_calls == [
+            mock.call(service_id='hafez:foo-bar-1-1')]
@@ -1,3 +1,6 @@
+import gevent
+import mock
+from deploylib.daemon.context import ctx
 from deploylib.plugins.setup_require import RequiresPlugin
 
 
@@ -30,3 +33,100 @@ class TestRequires(object):
 
         cintf.set_resource('foo', 's2', 5)
         assert not service1.held
+
+    def test_parallel_setup(self, cintf):
+        """Services with requirements are set up after the others when
+        running concurrently.
+        """
+        deployment = cintf.create_deployment('foo')
+
+        cintf.set_services('foo', {
+            's1': {'require': 's2'},
+            's2': {'require': 's3'},
+            's3': {},
+            's4': {},
+        }, concurrency=4)
+
+        services = cintf.db.deployments['foo'].services
+        assert sorted(services.keys()) == ['s1', 's2', 's3', 's4']
+        assert not any(s.held for s in services.values())
+
+    def test_long_chain(self, cintf):
+        """Releasing a long chain of requirements does not recurse.
+        """
+        deployment = cintf.create_deployment('foo')
+
+        for i in range(300):
+            cintf.set_service('foo', 's%d' % i, {'require': 's%d' % (i+1)})
+        assert all(s.held for s in deployment.services.values())
+
+        cintf.set_service('foo', 's300', {})
+        assert not any(s.held for s in deployment.services.values())
+        assert not deployment.requires
+
+    def test_index(self, cintf):
+        """Held services are indexed by what they are waiting for.
+        """
+        deployment = cintf.create_deployment('foo')
+
+        cintf.set_service('foo', 's1', {'require': ['s2', 's3']})
+        assert list(deployment.requires['s2']) == ['s1']
+        assert list(deployment.requires['s3']) == ['s1']
+
+        cintf.set_service('foo', 's2', {})
+        assert deployment.services['s1'].held
+        assert not 's2' in deployment.requires
+
+        cintf.set_resource('foo', 's3', True)
+        assert not deployment.services['s1'].held
+
+    def test_index_migration(self, controller, cintf):
+        """The index is built for deployments which do not have one.
+        """
+        deployment = cintf.create_deployment('foo')
+        cintf.set_service('foo', 's1', {'require': ['s2', 's3']})
+        cintf.set_resource('foo', 's3', True)
+        deployment.requires = None
+        deployment.data['Requires'] = {}
+
+        controller.migrate(cintf._db_obj.root)
+        assert list(deployment.requires) == ['s2']
+        assert not 'Requires' in deployment.data
+
+        cintf.set_service('foo', 's2', {})
+        assert not deployment.services['s1'].held
+
+    def test_parallel_release(self, cintf):
+        """Independent services waiting for the same requirement are
+        released concurrently.
+        """
+        deployment = cintf.create_deployment('foo')
+        for name in ('a', 'b', 'c'):
+            cintf.set_service('foo', name, {'require': 'db'})
+        cintf.set_service('foo', 'd', {'require': ['a', 'b']})
+
+        # Keep track of how many services are being started at once
+        running = []
+        def start(*args, **kwargs):
+            running.append(running[-1] + 1 if running else 1)
+            gevent.sleep(0.01)
+            running.append(running[-1] - 1)
+            return mock.DEFAULT
+        cintf.controller.backend.start.side_effect = start
+
+        cintf.concurrency = 3
+        cintf.set_resource('foo', 'db', True)
+
+        services = cintf.db.deployments['foo'].services
+        assert not any(s.held for s in services.values())
+        # a, b and c together, then d on its own
+        assert max(running) == 3
+        assert len(running) == 8
+
+    def test_cycle(self, cintf):
+        deployment = cintf.create_deployment('foo')
+        cintf.set_service('foo', 's1', {'require': 's2'})
+        cintf.set_service('foo', 's2', {'require': 's1'})
+
+        logs = [i['log'] for i in ctx.filter('log')]
+        assert any(l.endswith('s2 -> s1 -> s2') for l in logs)
@@ -1,3 +1,5 @@
+import docker.errors
+import mock
 import pytest
 from deploylib.plugins.sdutil import SdutilPlugin
 from tests.conftest import get_last_runcfg
@@ -6,11 +8,19 @@ from tests.conftest import get_last_runcfg
 controller_plugins = [SdutilPlugin]
 
 
+@pytest.fixture
+def sdutil_download(responses):
+    responses.add(
+        responses.GET, 'https://sdutil.s3.amazonaws.com/sdutil.linux',
+        body='binary')
+    return responses
+
+
 @pytest.fixture(autouse=True)
 def default_image_inspect(cintf):
     # sdutil will try to get entrypoint/cmd from image
-    cintf.backend.client.inspect_image.return_value = {
-        'config': {'Entrypoint': ['/imgentry'], 'Cmd': ['imgcmd']}
+    cintf.backend.image_info.return_value = {
+        'id': 'image-id', 'entrypoint': ['/imgentry'], 'cmd': ['imgcmd']
     }
 
 
@@ -60,7 +70,7 @@ class TestSdutilPlugin(object):
         assert runcfg_used['cmd'] == [
             'expose', '-d', 'DEP:foo:dep', '/entry', 'a-command']
 
-    def test_image_rebuild(self, cintf):
+    def test_image_rebuild(self, cintf, sdutil_download):
         """Test insertion of sdutil.
         """
         cintf.create_deployment('foo')
@@ -79,3 +89,40 @@ class TestSdutilPlugin(object):
         runcfg_used = get_last_runcfg(cintf)
         assert runcfg_used['image'] == 'built-id'
         assert runcfg_used['entrypoint'] == ['/sdutil']
+
+    def test_image_cached(self, cintf, sdutil_download):
+        """The image with sdutil inside is only built once.
+        """
+        cintf.create_deployment('foo')
+        definition = {'image': 'bar', 'sdutil': {'register': True}}
+        cintf.set_service('foo', 'bar', definition)
+        cintf.set_service('foo', 'bar', definition, force=True)
+        cintf.set_service('foo', 'baz', definition)
+
+        assert len(cintf.backend.client.build.mock_calls) == 1
+        assert get_last_runcfg(cintf)['image'] == 'built-id'
+        assert len(sdutil_download.calls) == 1
+
+    def test_image_removed(self, cintf, sdutil_download):
+        """A built image that is gone from docker is built again, rather
+        than pulled.
+        """
+        plugin = cintf.get_plugin(SdutilPlugin)
+        backend = cintf.backend
+        plugin.add_to_image(backend, 'bar')
+        backend.client.inspect_image.side_effect = \
+            docker.errors.APIError('missing', mock.Mock())
+        plugin.add_to_image(backend, 'bar')
+
+        assert len(backend.client.build.mock_calls) == 2
+        assert backend.client.inspect_image.mock_calls[0][1] == ('built-id',)
+        assert [c[1] for c in backend.image_info.mock_calls] == [('bar',)] * 2
+
+    def test_image_per_host(self, cintf, sdutil_download):
+        """With several docker hosts, the image is built on each."""
+        plugin = cintf.get_plugin(SdutilPlugin)
+        backend = cintf.backend
+        assert plugin.add_to_image(backend, 'bar', 'one')[0] == 'built-id'
+        plugin.add_to_image(backend, 'bar', 'two')
+        plugin.add_to_image(backend, 'bar', 'one')
+        assert len(backend.client.build.mock_calls) == 2
@@ -0,0 +1,119 @@
+import os
+import stat
+import pytest
+from deploylib.daemon.backend import create_backend
+from deploylib.plugins.systemd import SystemdPlugin, SystemdBackend
+
+
+controller_plugins = [SystemdPlugin]
+mock_backend = False
+
+
+@pytest.fixture
+def systemctl(request, tmpdir):
+    """A stand-in for systemctl and systemd-run, which log their
+    arguments."""
+    log = tmpdir.join('systemctl.log')
+    script = tmpdir.join('systemctl')
+    script.write('#!/bin/sh\necho "$(basename $0) $@" >> %s\n'
+                 'test "$1" != is-active\n' % log)
+    script.chmod(stat.S_IRWXU)
+    script.copy(tmpdir.join('systemd-run'), mode=True)
+
+    env = {'SYSTEMCTL': str(script),
+           'SYSTEMD_RUN': str(tmpdir.join('systemd-run')),
+           'SYSTEMD_DIR': str(tmpdir.mkdir('systemd'))}
+    old = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    def restore():
+        for k, v in old.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+    request.addfinalizer(restore)
+
+    def calls():
+        if not log.exists():
+            return []
+        return log.read().splitlines()
+    return calls
+
+
+@pytest.fixture
+def units(systemctl, controller, cintf, tmpdir):
+    backend = SystemdBackend(None)
+    backend.client = controller.backend.client
+    controller.backend = cintf.backend = backend
+    return tmpdir.join('systemd')
+
+
+@pytest.mark.usefixtures('mock_backend_docker')
+class TestSystemd(object):
+
+    def test_units(self, cintf, units, systemctl):
+        cintf.create_deployment('foo')
+        assert units.join('foo.target').exists()
+        assert units.join('docker-deploy.target.wants', 'foo.target').check(
+            link=True)
+
+        cintf.set_service('foo', 'bar', {})
+        cintf.set_service('foo', 'baz', {})
+        assert units.join('foo-bar-1-1.service').exists()
+        assert units.join('foo.target.wants', 'foo-bar-1-1.service').check(
+            link=True)
+        assert systemctl() == []
+
+        # One reload for all the units
+        cintf.flush()
+        assert systemctl() == [
+            'systemctl daemon-reload',
+            'systemctl start foo-bar-1-1.service foo-baz-1-1.service']
+
+    def test_replace(self, cintf, units, systemctl):
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        cintf.flush()
+        cintf.set_service('foo', 'bar', {}, force=True)
+        cintf.flush()
+
+        assert systemctl()[2:] == [
+            'systemctl is-active foo-bar-1-1.service',
+            'systemctl daemon-reload',
+            'systemctl start foo-bar-2-1.service']
+        assert not units.join('foo-bar-1-1.service').exists()
+        assert not units.join('foo.target.wants', 'foo-bar-1-1.service').check(
+            link=True)
+
+    def test_per_request(self, cintf, controller, units, systemctl):
+        """Each request only starts the units it created."""
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        other = controller.interface()
+        try:
+            other.flush()
+        finally:
+            other.close()
+        assert systemctl() == []
+
+        cintf.flush()
+        assert systemctl()[-1] == 'systemctl start foo-bar-1-1.service'
+
+    def test_transient(self, cintf, units, systemctl):
+        cintf.backend.transient = True
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        cintf.flush()
+
+        # Only the deployment target needs to be loaded
+        calls = systemctl()
+        assert calls[0].startswith(
+            'systemd-run --unit=foo-bar-1-1.service --property=PartOf=foo.target')
+        assert calls[1:] == ['systemctl daemon-reload']
+        assert not units.join('foo-bar-1-1.service').exists()
+
+
+def test_create_backend():
+    assert isinstance(create_backend('systemd', None), SystemdBackend)
+    with pytest.raises(ValueError):
+        create_backend('runit', None)
@@ -50,3 +50,75 @@ class TestUpstart(object):
         cintf.set_service('foo', 'bar', {}, force=True)
         assert upstart.join('foo-bar-2-1.conf').exists()
         assert not upstart.join('foo-bar-1-1.conf').exists()
+
+
+class FakeControl(object):
+
+    def __init__(self):
+        self.jobs = {}
+        self.calls = []
+
+    def status(self, name):
+        return self.jobs.get(name)
+
+    def start(self, name):
+        self.calls.append(('start', name))
+        self.jobs[name] = True
+
+    def stop(self, name):
+        self.calls.append(('stop', name))
+        self.jobs[name] = False
+
+
+@pytest.mark.usefixtures('mock_backend_docker')
+class TestUpstartControl(object):
+
+    def test_start_stop(self, cintf, controller, upstart):
+        control = controller.backend.upstart = FakeControl()
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        cintf.set_service('foo', 'bar', {}, force=True)
+
+        assert control.calls == [
+            ('start', 'foo-bar-1-1'), ('stop', 'foo-bar-1-1'),
+            ('start', 'foo-bar-2-1')]
+        assert not upstart.join('foo-bar-1-1.conf').exists()
+
+        # The container is stopped via docker, and waited for
+        client = controller.backend.client
+        assert client.stop.mock_calls[0][1] == ('abc', 10)
+        assert client.wait.called
+
+    def test_initctl(self):
+        from deploylib.plugins import upstart as module
+        with mock.patch.object(module, 'check_output') as check_output:
+            check_output.return_value = 'foo start/running, process 1\n'
+            assert module.InitctlControl().status('foo') is True
+            assert check_output.mock_calls[0][1][0] == [
+                'initctl', 'status', 'foo']
+
+    def test_control_selection(self):
+        from deploylib.plugins.upstart import upstart_control, InitctlControl
+        assert isinstance(upstart_control({'UPSTART_CONTROL': 'initctl'}),
+                          InitctlControl)
+        # Falls back if there is no D-Bus
+        assert isinstance(upstart_control({'UPSTART_DBUS_ADDRESS': 'x:'}),
+                          InitctlControl)
+
+    def test_dbus_does_not_block(self):
+        """The blocking D-Bus calls are made in another thread, and
+        upstart replies once the job has started or stopped.
+        """
+        from gevent.monkey import get_original
+        from deploylib.plugins.upstart import DBusControl
+        get_ident = get_original('thread', 'get_ident')
+        control = DBusControl.__new__(DBusControl)
+        control.dbus = mock.Mock()
+        job = mock.Mock()
+        threads = []
+        job.Start.side_effect = lambda *a, **kw: threads.append(get_ident())
+        control._job = lambda name: job
+
+        control.start('foo')
+        assert job.Start.mock_calls[0][1][1] is True
+        assert threads and threads[0] != get_ident()
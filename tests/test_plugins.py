@@ -46,3 +46,85 @@ def test(cintf, controller):
     assert len(my_plugin.globals_calls) == 2  # once for each service
 
 
+
+
+def test_manifest():
+    """All plugins defined in the plugin modules are in the manifest."""
+    import inspect
+    import os
+    from importlib import import_module
+    from flask import Blueprint
+    from deploylib import plugins
+    from deploylib.plugins import Plugin, LocalPlugin, BUILTIN_PLUGINS
+
+    found = set()
+    for name in os.listdir(os.path.dirname(plugins.__file__)):
+        if not name.endswith('.py') or name == '__init__.py':
+            continue
+        module = import_module('deploylib.plugins.%s' % name[:-3])
+        for attr_name, attr in vars(module).items():
+            if inspect.isclass(attr):
+                if not issubclass(attr, (Plugin, LocalPlugin)) or \
+                        attr in (Plugin, LocalPlugin) or \
+                        attr.__module__ != module.__name__ or \
+                        vars(attr).get('abstract'):
+                    continue
+            elif not isinstance(attr, Blueprint):
+                continue
+            found.add('%s:%s' % (module.__name__, attr_name))
+
+    assert found == set(BUILTIN_PLUGINS)
+
+
+def test_abstract_and_entry_points(monkeypatch):
+    """Abstract plugin classes are skipped, their subclasses are not;
+    an entry point that fails to load is warned about."""
+    import warnings
+    import mock
+    import pkg_resources
+    from deploylib import plugins
+    from deploylib.plugins import LocalPlugin, find_plugins
+
+    class Base(LocalPlugin):
+        abstract = True
+
+    class Concrete(Base):
+        pass
+
+    broken = mock.Mock()
+    broken.load.side_effect = ImportError('no such module')
+    good = mock.Mock()
+    good.load.return_value = Concrete
+    monkeypatch.setattr(pkg_resources, 'iter_entry_points',
+                        lambda group: [broken, good])
+    monkeypatch.setattr(plugins, 'BUILTIN_PLUGINS', [])
+    monkeypatch.setattr(plugins, '_loaded', None)
+    monkeypatch.setattr(plugins, '_registry', {})
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        assert find_plugins(Base) == [Concrete]
+    assert 'no such module' in str(caught[0].message)
+
+
+def test_priority(controller):
+    """Hooks are run by descending priority."""
+    calls = []
+    class Low(object):
+        priority = 10
+        def foo(self):
+            calls.append('low')
+    class High(object):
+        def foo(self):
+            calls.append('high')
+    class NoHook(object):
+        pass
+
+    controller.plugins[:] = [Low(), NoHook()]
+    controller.run_plugins('foo')
+    controller.plugins.append(High())
+    controller.run_plugins('foo')
+
+    assert calls == ['low', 'high', 'low']
+    assert controller.hook_stats[('foo', 'Low')][0] == 2
+    assert controller.hook_stats[('foo', 'High')][0] == 1
@@ -0,0 +1,99 @@
+import pytest
+import transaction
+from deploylib.daemon.ports import (
+    PortAllocator, NoFreePortError, listening_ports)
+
+
+controller_plugins = []
+
+
+class TestPortAllocator(object):
+
+    def test_allocate(self):
+        ports = PortAllocator()
+        first = ports.allocate('10.0.0.1', 'foo-web-1-1')
+        assert 10000 <= first <= 65000
+        # Deterministic, but never the same port twice
+        assert PortAllocator().allocate('10.0.0.1', 'foo-web-1-1') == first
+        assert ports.allocate('10.0.0.1', 'foo-web-1-1') != first
+        # Hosts are separate
+        assert ports.allocate('10.0.0.2', 'foo-web-1-1') == first
+
+    def test_quarantine(self):
+        ports = PortAllocator()
+        ports.first = ports.last = 10000
+        assert ports.allocate('ip', 'a', now=100) == 10000
+        with pytest.raises(NoFreePortError):
+            ports.allocate('ip', 'b', now=100)
+
+        assert ports.release('ip', 10000, now=100)
+        assert not ports.release('ip', 10000, now=100)
+        with pytest.raises(NoFreePortError):
+            ports.allocate('ip', 'b', quarantine=60, now=130)
+        assert ports.allocate('ip', 'b', quarantine=60, now=161) == 10000
+
+    def test_expired_are_forgotten(self):
+        ports = PortAllocator()
+        for port in (10000, 10001):
+            ports.reserve('ip', port, 'a')
+        ports.release('ip', 10000, now=100)
+        ports.release('ip', 10001, now=161)
+        # Releasing does not touch the other ports
+        assert len(ports.released) == 2
+
+        assert ports.prune(quarantine=60, now=161) == 1
+        assert list(ports.released.keys()) == [('ip', 10001)]
+
+    def test_bound(self):
+        ports = PortAllocator()
+        ports.first, ports.last = 10000, 10001
+        assert ports.allocate('ip', 'a', bound=set([10000])) == 10001
+        with pytest.raises(NoFreePortError):
+            ports.allocate('ip', 'a', bound=set([10000]))
+
+    def test_listening_ports(self, tmpdir):
+        tmpdir.join('tcp').write(
+            '  sl  local_address rem_address   st\n'
+            '   0: 00000000:1F90 00000000:0000 0A\n'
+            '   1: 0100007F:2710 0100007F:9C40 01\n')
+        assert listening_ports(str(tmpdir)) == set([8080])
+        assert listening_ports(str(tmpdir.join('missing'))) == set()
+
+
+class TestControllerPorts(object):
+
+    def test_released_on_stop(self, cintf):
+        cintf.controller.port_quarantine = 0
+        cintf.create_deployment('foo')
+        service = cintf.set_service('foo', 'bar', {})
+        ip, port = service.instances[0].ports['']
+        assert cintf.db.ports.assigned[(ip, port)] == 'foo-bar-1-1'
+
+        cintf.set_service('foo', 'bar', {}, force=True)
+        new_port = service.instances[0].ports[''][1]
+        assert new_port != port
+        assert list(cintf.db.ports.assigned.keys()) == [(ip, new_port)]
+        assert (ip, port) in cintf.db.ports.released
+        assert cintf.db.ports.stats() == {
+            ip: {'assigned': 1, 'quarantined': 1}}
+
+    def test_migration(self, controller, cintf):
+        cintf.create_deployment('foo')
+        service = cintf.set_service('foo', 'bar', {})
+        ip, port = service.instances[0].ports['']
+        cintf.db.ports = None
+        controller.migrate(cintf._db_obj.root)
+
+        assert cintf.db.ports.assigned[(ip, port)] == \
+            service.instances[0].id
+
+    def test_prune(self, controller, cintf):
+        controller.port_quarantine = 0
+        cintf.create_deployment('foo')
+        cintf.set_service('foo', 'bar', {})
+        cintf.set_service('foo', 'bar', {}, force=True)
+        transaction.commit()
+
+        assert controller.prune_ports() == 1
+        cintf._db_obj.sync()
+        assert not cintf.db.ports.released